@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Connection reuse benchmark: one-shot requests vs pooled HivClient.
+
+    Builds the same cluster against the local stand-in server twice, first
+    with a fresh connection per request (the old module-level requests.get /
+    requests.post behaviour) and then with a shared HivClient, and reports
+    requests, TCP connections accepted by the server and wall time.
+
+    Run with:  python benchmarks/bench_client.py
+"""
+
+import os
+import sys
+import time
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'tests'))
+
+from alamos_extract.client import HivClient  # noqa: E402
+from alamos_extract.load_data import Cluster  # noqa: E402
+from alamos_extract.registry import PatientRegistry  # noqa: E402
+from stand_in import StandInData, StandInServer  # noqa: E402
+
+
+class OneShotClient(HivClient):
+    """Client that opens a new connection for every request, like requests.get."""
+    def request(self, url, data=None, headers=None):
+        if data:
+            response = requests.post(url, data=data, headers=headers, timeout=self.timeout)
+        else:
+            response = requests.get(url, headers=headers, timeout=self.timeout)
+        response.raise_for_status()
+        return response
+
+
+def run(client_cls, server, repeat):
+    server.n_connections = server.n_requests = 0
+    client = client_cls(base_url=server.base_url)
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        # fresh registry, so every repeat downloads its patients
+        Cluster(700, client=client, registry=PatientRegistry()).load()
+    elapsed = time.perf_counter() - t0
+    client.close()
+    return server.n_requests, server.n_connections, elapsed
+
+
+def main(repeat=5):
+    data = StandInData(n_clusters=1, patients_per_cluster=20, seqs_per_patient=30)
+    with StandInServer(data, page_size=10) as server:
+        print('{:<12} {:>9} {:>12} {:>9}'.format('client', 'requests', 'connections', 'seconds'))
+        for name, cls in [('one-shot', OneShotClient), ('HivClient', HivClient)]:
+            n_req, n_conn, elapsed = run(cls, server, repeat)
+            print('{:<12} {:>9} {:>12} {:>9.3f}'.format(name, n_req, n_conn, elapsed))
+
+
+if __name__ == '__main__':
+    main()
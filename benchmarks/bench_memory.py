@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Memory footprint of the accession/timepoint table: text vs typed schema.
+
+    Records the timepoint pages of a multi-patient cluster from the local
+    stand-in server, builds the cluster's accession table with and without
+    the typed schema (load_data._apply_schema), and reports deep memory
+    usage per row for each column.
+
+    Run with:  python benchmarks/bench_memory.py [patients] [seqs_per_patient] [--object-strings]
+
+    --object-strings stores text as Python objects, as pandas < 3 (or pandas 3
+    without pyarrow) does, instead of Arrow-backed strings.
+"""
+
+import argparse
+import os
+import sys
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'tests'))
+
+from alamos_extract import tables  # noqa: E402
+from alamos_extract.client import HivClient  # noqa: E402
+from alamos_extract.load_data import (_TIMEPOINT_COLS, _concat_results, _content_pager,  # noqa: E402
+                                      _process_results_df, _timepoints_path)
+from stand_in import StandInData, StandInServer  # noqa: E402
+
+
+def record_pages(n_patients, seqs_per_patient):
+    data = StandInData(n_clusters=1, patients_per_cluster=n_patients, seqs_per_patient=seqs_per_patient)
+    with StandInServer(data, page_size=100) as server, HivClient(base_url=server.base_url) as client:
+        return [content for patient_id in data.clusters[700]['patients']
+                for content in _content_pager(client.url(_timepoints_path(patient_id)), client=client)]
+
+
+def build(pages, typed):
+    df_list = []
+    for content in pages:
+        df, ncbi, blast_urls = tables.read_results_table(content)
+        df_list.append(_process_results_df(df, list(_TIMEPOINT_COLS), ncbi, blast_urls, typed=typed))
+    if typed:
+        return _concat_results(df_list)
+    return pd.concat(df_list, axis=0, ignore_index=True)
+
+
+def main(n_patients=8, seqs_per_patient=500):
+    pages = record_pages(n_patients, seqs_per_patient)
+    text = build(pages, typed=False)
+    typed = build(pages, typed=True)
+    n_rows = len(typed)
+    text_mem = text.memory_usage(deep=True, index=False)
+    typed_mem = typed.memory_usage(deep=True, index=False)
+    print('{} rows from {} patients'.format(n_rows, n_patients))
+    print('{:<28} {:>10} {:>10} {:>9}  {}'.format('column', 'text B/row', 'typed B/row', 'saved', 'typed dtype'))
+    for col in typed.columns:
+        before, after = text_mem[col] / n_rows, typed_mem[col] / n_rows
+        if before != after:
+            print('{:<28} {:>10.1f} {:>10.1f} {:>8.0%}  {}'.format(
+                col, before, after, 1 - after / before, typed[col].dtype))
+    before, after = text_mem.sum() / n_rows, typed_mem.sum() / n_rows
+    print('{:<28} {:>10.1f} {:>10.1f} {:>8.0%}'.format('total', before, after, 1 - after / before))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('patients', nargs='?', type=int, default=8)
+    parser.add_argument('seqs_per_patient', nargs='?', type=int, default=500)
+    parser.add_argument('--object-strings', action='store_true')
+    args = parser.parse_args()
+    if args.object_strings:
+        pd.set_option('future.infer_string', False)
+    main(args.patients, args.seqs_per_patient)
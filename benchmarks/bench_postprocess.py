@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Results table post-processing: per-row apply vs vectorized extraction.
+
+    Builds synthetic parsed results tables of 1k to 1M rows and times the
+    previous per-row implementation (patient_comb apply, NCBI title loop,
+    blast URL apply) against load_data._process_results_df without the
+    typed schema, then times load_data._apply_schema as a stage of its own.
+
+    Run with:  python benchmarks/bench_postprocess.py [max_rows]
+"""
+
+import re
+import sys
+import time
+
+import pandas as pd
+
+from alamos_extract.load_data import _FIEBIG_STAGES, _INT_COLS, _TIMEPOINT_COLS, _apply_schema, _process_results_df
+
+NCBI_TITLE = 'Start: {}  Stop: {}. Link to NCBI sequence viewer'
+BLAST_URL = '/cgi-bin/BASIC_BLAST/basic_blast_pg.cgi?SSAM_SE_id={}'
+
+
+def synthetic_table(n_rows):
+    """Table as returned by the parser, plus its NCBI links and blast URLs."""
+    cols = list(_TIMEPOINT_COLS)
+    df = pd.DataFrame({i: ['x'] * n_rows for i in range(len(cols))})
+    df[0] = [str(i) for i in range(1, n_rows + 1)]
+    df[cols.index('patient_comb')] = ['P{}({})'.format(i % 97, 9000 + i % 97) for i in range(n_rows)]
+    # cells as read_html leaves them: numbers or blanks, known Fiebig stages
+    for col in _INT_COLS:
+        df[cols.index(col)] = [None if i % 5 == 0 else float(1990 + i % 3000) for i in range(n_rows)]
+    stages = list(_FIEBIG_STAGES) + [None]
+    df[cols.index('fiebig_stage')] = [stages[i % len(stages)] for i in range(n_rows)]
+    for col, values in (('subtype', ['B', 'C', 'A1', '01_AE']), ('country', ['US', 'ZA', 'TH']),
+                        ('genomic_region', ['ENV', 'GAG', 'POL']), ('organism', ['HIV-1'])):
+        df[cols.index(col)] = [values[i % len(values)] for i in range(n_rows)]
+    ncbi = [(NCBI_TITLE.format(i, i + 9000), 'https://www.ncbi.nlm.nih.gov/nuccore/AB{}'.format(i))
+            for i in range(n_rows)]
+    blast_urls = [BLAST_URL.format(149000 + i) for i in range(n_rows)]
+    return df, cols, ncbi, blast_urls
+
+
+def legacy_process(df, col_headers, ncbi, blast_urls):
+    """Post-processing as it was before vectorization."""
+    def get_patient_ids(patient_comb):
+        r = re.match(r'([^\(]*)\(([^\)]*)\)', patient_comb.strip())
+        patient_code, patient_id = r.groups()
+        return patient_code, int(patient_id.strip())
+
+    def process_ncbi_title(title, href):
+        match = re.match(r'Start: (\d+)\s+Stop: (\d+). Link to NCBI sequence viewer', title)
+        return (':'.join(match.groups()) if match else title), href
+
+    df.columns = col_headers
+    patient_codes, patient_ids = zip(*df.patient_comb.apply(get_patient_ids))
+    df.insert(2, 'patient_id', patient_ids)
+    df.insert(3, 'patient_code', patient_codes)
+    df['pos'], df['ncbi_url'] = zip(*[process_ncbi_title(title, href) for title, href in ncbi])
+    ssam_ids = pd.Series(blast_urls).apply(lambda url: re.findall(r'_SE_id=(\d+)', url)[0])
+    df.insert(5, 'blast_ssam_se_id', ssam_ids.values)
+    return df
+
+
+def vector_process(df, col_headers, ncbi, blast_urls):
+    return _process_results_df(df, col_headers, ncbi, blast_urls, typed=False)
+
+
+def timeit(fn, n_rows, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        df, cols, ncbi, blast_urls = synthetic_table(n_rows)
+        t0 = time.perf_counter()
+        fn(df, cols, ncbi, blast_urls)
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def time_schema(n_rows, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        df = vector_process(*synthetic_table(n_rows))
+        t0 = time.perf_counter()
+        _apply_schema(df)
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def main(max_rows=1000000):
+    print('{:>9} {:>11} {:>11} {:>8} {:>11}'.format('rows', 'apply s', 'vector s', 'speedup', 'schema s'))
+    n_rows = 1000
+    while n_rows <= max_rows:
+        repeat = 3 if n_rows < 100000 else 1
+        t_old = timeit(legacy_process, n_rows, repeat)
+        t_new = timeit(vector_process, n_rows, repeat)
+        t_schema = time_schema(n_rows, repeat)
+        print('{:>9} {:>11.4f} {:>11.4f} {:>7.1f}x {:>11.4f}'.format(
+            n_rows, t_old, t_new, t_old / t_new, t_schema))
+        n_rows *= 10
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Peak memory of search_db vs streamed iter_search on a large result set.
+
+    Serves a single cluster search of many records from the local stand-in
+    server and loads it in a fresh child process, either whole with search_db
+    or batch by batch with iter_search. Reports the child's peak RSS (which
+    includes libxml2's C allocations) and the tracemalloc peak of Python
+    objects.
+
+    Run with:  python benchmarks/bench_stream.py [n_records]
+"""
+
+import multiprocessing
+import os
+import resource
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'tests'))
+
+from alamos_extract.client import HivClient  # noqa: E402
+from alamos_extract.load_data import iter_search, search_db  # noqa: E402
+from stand_in import StandInData, StandInServer  # noqa: E402
+
+
+def run_case(name, base_url, max_rec, queue):
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    with HivClient(base_url=base_url) as client:
+        if name == 'search_db':
+            n_rows = len(search_db(max_rec=max_rec, cluster_name='SC_cluster_700', client=client))
+        else:
+            n_rows = sum(len(df) for df in iter_search(max_rec=max_rec, cluster_name='SC_cluster_700',
+                                                       batch_size=1000, client=client))
+    seconds = time.perf_counter() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    rss_growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before
+    queue.put((n_rows, seconds, rss_growth * 1024, peak))
+
+
+def main(n_records=20000):
+    data = StandInData(n_clusters=1, patients_per_cluster=10, seqs_per_patient=n_records // 10)
+    ctx = multiprocessing.get_context('fork')
+    with StandInServer(data, page_size=n_records) as server:
+        print('{:<12} {:>8} {:>9} {:>14} {:>16}'.format(
+            'method', 'rows', 'seconds', 'RSS growth MiB', 'py peak MiB'))
+        for name in ('search_db', 'iter_search'):
+            queue = ctx.Queue()
+            proc = ctx.Process(target=run_case, args=(name, server.base_url, n_records, queue))
+            proc.start()
+            n_rows, seconds, rss, peak = queue.get()
+            proc.join()
+            print('{:<12} {:>8} {:>9.2f} {:>14.1f} {:>16.1f}'.format(
+                name, n_rows, seconds, rss / 2 ** 20, peak / 2 ** 20))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Parse throughput: bs4 + read_html round trip vs single-pass lxml extractor.
+
+    Records results, cluster and patient pages from the local stand-in server,
+    then parses each page repeatedly with both implementations and reports
+    pages/s and rows/s.
+
+    Run with:  python benchmarks/bench_tables.py
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'tests'))
+
+from alamos_extract import tables  # noqa: E402
+from alamos_extract.client import HivClient  # noqa: E402
+from alamos_extract.load_data import (_TIMEPOINT_COLS, _content_pager, _get_df_from_content,  # noqa: E402
+                                      _get_df_from_soup, _get_soup_from_content, _parse_cluster,
+                                      _parse_patient_info, _timepoints_path)
+from stand_in import StandInData, StandInServer  # noqa: E402
+
+
+def record_pages():
+    data = StandInData(n_clusters=1, patients_per_cluster=2, seqs_per_patient=500)
+    with StandInServer(data, page_size=100) as server, HivClient(base_url=server.base_url) as client:
+        results = list(_content_pager(client.url(_timepoints_path(9000)), client=client))
+        cluster = client.fetch(client.url('cluster.comp?clu_id=700'))
+        patient = client.fetch(client.url('patient.comp?pat_id=9000'))
+    return results, cluster, patient
+
+
+def timeit(fn, pages, repeat):
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        for page in pages:
+            fn(page)
+    return (time.perf_counter() - t0) / repeat
+
+
+def main(repeat=5):
+    results, cluster, patient = record_pages()
+    n_rows = sum(len(_get_df_from_content(p, list(_TIMEPOINT_COLS))) for p in results)
+    cases = [
+        ('results', results,
+         lambda p: _get_df_from_soup(_get_soup_from_content(p), list(_TIMEPOINT_COLS)),
+         lambda p: _get_df_from_content(p, list(_TIMEPOINT_COLS))),
+        ('cluster', [cluster],
+         lambda p: _parse_cluster(_get_soup_from_content(p)),
+         tables.read_cluster_page),
+        ('patient', [patient],
+         lambda p: _parse_patient_info(_get_soup_from_content(p), 9000),
+         lambda p: tables.read_patient_page(p, 9000)),
+    ]
+    print('{:<9} {:>12} {:>12} {:>8}'.format('page', 'bs4 pages/s', 'lxml pages/s', 'speedup'))
+    for name, pages, old, new in cases:
+        t_old = timeit(old, pages, repeat)
+        t_new = timeit(new, pages, repeat)
+        print('{:<9} {:>12.1f} {:>12.1f} {:>7.1f}x'.format(
+            name, len(pages) / t_old, len(pages) / t_new, t_old / t_new))
+    print('results: {} rows over {} pages'.format(n_rows, len(results)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Benchmark fixtures: replay server and timings checked against stored baselines.
+
+    Each benchmark's best-of-N wall time and request count are compared with
+    baselines.json. A benchmark fails if it takes longer than tolerance x its
+    baseline (plus a small absolute allowance for timer noise), or sends more
+    requests than its baseline.
+
+    Run with:  pytest benchmarks/
+    Re-baseline on the reference machine with:  pytest benchmarks/ --update-baselines
+"""
+
+import json
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'tests'))
+
+from replay import ReplayServer  # noqa: E402
+
+__author__ = "Stephen Gaffney"
+__copyright__ = "Stephen Gaffney"
+__license__ = "gpl3"
+
+BASELINES = os.path.join(os.path.dirname(__file__), 'baselines.json')
+# per-request latency and jitter of the replay server, in seconds
+LATENCY = 0.005
+JITTER = 0.002
+# seconds allowed above tolerance x baseline, for timer noise on short stages
+NOISE_SECONDS = 0.005
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup('benchmarks')
+    group.addoption('--update-baselines', action='store_true',
+                    help="write measured timings to baselines.json instead of checking them")
+    group.addoption('--bench-tolerance', type=float, default=float(os.environ.get('BENCH_TOLERANCE', 1.5)),
+                    help="fail benchmarks slower than this multiple of their baseline (default 1.5, "
+                         "or $BENCH_TOLERANCE)")
+    group.addoption('--bench-rounds', type=int, default=5, help="rounds per benchmark; the best is kept")
+
+
+class BenchRecorder:
+    """Times benchmarks and checks them against baselines."""
+    def __init__(self, config):
+        self.update = config.getoption('update_baselines')
+        self.tolerance = config.getoption('bench_tolerance')
+        self.rounds = config.getoption('bench_rounds')
+        self.baselines = {}
+        if os.path.exists(BASELINES):
+            with open(BASELINES) as f:
+                self.baselines = json.load(f)
+        self.results = {}
+
+    def __call__(self, name, func, server=None, rounds=None):
+        """Run func rounds times and check the best time against the baseline for name.
+
+        Args:
+            server (ReplayServer): if given, also check the requests each round sends.
+
+        Returns:
+            result: return value of the last round.
+        """
+        times = []
+        n_requests = None
+        for _ in range(rounds or self.rounds):
+            requests_before = server.n_requests if server is not None else 0
+            t0 = time.perf_counter()
+            result = func()
+            times.append(time.perf_counter() - t0)
+            if server is not None:
+                n_requests = server.n_requests - requests_before
+        measured = {'seconds': round(min(times), 5)}
+        if n_requests is not None:
+            measured['requests'] = n_requests
+        self.results[name] = measured
+        if not self.update:
+            self._check(name, measured)
+        return result
+
+    def _check(self, name, measured):
+        baseline = self.baselines.get(name)
+        if baseline is None:
+            pytest.skip("No baseline for {}; run with --update-baselines".format(name))
+        limit = baseline['seconds'] * self.tolerance + NOISE_SECONDS
+        if measured['seconds'] > limit:
+            pytest.fail("{}: {:.4f} s is slower than baseline {:.4f} s x {}".format(
+                name, measured['seconds'], baseline['seconds'], self.tolerance))
+        if measured.get('requests', 0) > baseline.get('requests', float('inf')):
+            pytest.fail("{}: {} requests, baseline {}".format(name, measured['requests'], baseline['requests']))
+
+    def save(self):
+        baselines = dict(self.baselines)
+        baselines.update(self.results)
+        with open(BASELINES, 'w') as f:
+            json.dump(baselines, f, indent=1, sort_keys=True)
+            f.write('\n')
+
+
+def pytest_configure(config):
+    config._bench_recorder = BenchRecorder(config)
+
+
+def pytest_sessionfinish(session):
+    recorder = session.config._bench_recorder
+    if recorder.update and recorder.results:
+        recorder.save()
+
+
+@pytest.fixture
+def bench(request):
+    return request.config._bench_recorder
+
+
+@pytest.fixture(scope='session')
+def replay():
+    with ReplayServer(latency=LATENCY, jitter=JITTER) as server:
+        yield server
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    End-to-end and per-stage benchmarks against the recorded corpus.
+
+    End-to-end benchmarks run the public API against the replay server
+    (see conftest.LATENCY); stage benchmarks time fetching, parsing and
+    post-processing separately, parsing recorded page bodies directly.
+"""
+
+import pytest
+
+from alamos_extract import tables
+from alamos_extract.client import HivClient
+from alamos_extract.load_data import Cluster, extract_patient_accession_timepoints, load_cluster, search_db, \
+    _TIMEPOINT_COLS, _cluster_path, _content_pager, _process_results_df, _search_form, _timepoints_path
+from alamos_extract.registry import PatientRegistry
+
+__author__ = "Stephen Gaffney"
+__copyright__ = "Stephen Gaffney"
+__license__ = "gpl3"
+
+CLUSTER_ID = 701
+PATIENT_ID = 9000
+CLUSTER_NAME = 'SC_cluster_701'
+MAX_REC = 200
+
+
+@pytest.fixture
+def client(replay):
+    with HivClient(base_url=replay.base_url, retries=0) as client:
+        yield client
+
+
+def _recorded(replay, path_part, page=0):
+    """Recorded body of the page-th page whose request path contains path_part."""
+    for (_, entry_page), entry in replay.entries.items():
+        if entry_page == page and path_part in entry['key'][1]:
+            return entry['body']
+    raise KeyError(path_part)
+
+
+def _recorded_search(replay, form, page=0):
+    key = sorted([k, str(v)] for k, v in form.items())
+    for (_, entry_page), entry in replay.entries.items():
+        if entry_page == page and entry['key'][2] == key:
+            return entry['body']
+    raise KeyError(form)
+
+
+def test_load_cluster(bench, replay, client):
+    data = bench('load_cluster', lambda: load_cluster(CLUSTER_ID, client=client), server=replay)
+    assert data['cluster_name'] == CLUSTER_NAME
+
+
+def test_load_cluster_stages(bench, replay, client):
+    url = client.url(_cluster_path(CLUSTER_ID))
+    bench('load_cluster.fetch', lambda: client.fetch(url), server=replay)
+    content = _recorded(replay, _cluster_path(CLUSTER_ID))
+    bench('load_cluster.parse', lambda: tables.read_cluster_page(content))
+
+
+@pytest.mark.parametrize('max_workers', [None, 4])
+def test_cluster(bench, replay, client, max_workers):
+    name = 'Cluster' if max_workers is None else 'Cluster[max_workers={}]'.format(max_workers)
+    cluster = bench(name, lambda: Cluster(CLUSTER_ID, client=client, max_workers=max_workers,
+                                          registry=PatientRegistry(maxsize=0)).load(), server=replay)
+    assert len(cluster.patient_dict) == 4
+
+
+def test_search_db(bench, replay, client):
+    df = bench('search_db', lambda: search_db(max_rec=MAX_REC, client=client), server=replay)
+    assert len(df) == MAX_REC
+    df = bench('search_db[cluster_name]', lambda: search_db(cluster_name=CLUSTER_NAME, client=client),
+               server=replay)
+    assert len(df) > 0
+
+
+def test_search_db_stages(bench, replay):
+    form, cols = _search_form(MAX_REC, 'HIV-1', 'A1*', 'GENOME', None)
+    content = _recorded_search(replay, form)
+    df, ncbi, blast_urls = bench('search_db.parse', lambda: tables.read_results_table(content))
+    bench('search_db.postprocess', lambda: _process_results_df(df.copy(), cols, ncbi, blast_urls))
+
+
+def test_extract_patient_accession_timepoints(bench, replay, client):
+    df = bench('extract_patient_accession_timepoints',
+               lambda: extract_patient_accession_timepoints(PATIENT_ID, client=client), server=replay)
+    assert len(df) == 60
+
+
+def test_extract_patient_accession_timepoints_stages(bench, replay, client):
+    url = client.url(_timepoints_path(PATIENT_ID))
+    pages = bench('extract_patient_accession_timepoints.fetch', lambda: list(_content_pager(url, client=client)),
+                  server=replay)
+    assert len(pages) > 1
+    parsed = bench('extract_patient_accession_timepoints.parse',
+                   lambda: [tables.read_results_table(content) for content in pages])
+    bench('extract_patient_accession_timepoints.postprocess',
+          lambda: [_process_results_df(df.copy(), list(_TIMEPOINT_COLS), ncbi, blast_urls)
+                   for df, ncbi, blast_urls in parsed])
@@ -1,11 +1,17 @@
 # -*- coding: utf-8 -*-
-from pkg_resources import get_distribution, DistributionNotFound
 
-try:
-    # Change here if project is renamed and does not equal the package name
-    dist_name = 'alamos-extract'
-    __version__ = get_distribution(dist_name).version
-except DistributionNotFound:
-    __version__ = 'unknown'
-finally:
-    del get_distribution, DistributionNotFound
+
+def __getattr__(name):
+    # __version__ is read from the installed distribution metadata on first
+    # use, so importing the package (e.g. for the CLI) stays cheap
+    if name == '__version__':
+        from importlib.metadata import PackageNotFoundError, version
+        try:
+            # Change here if project is renamed and does not equal the package name
+            dist_name = 'alamos-extract'
+            value = version(dist_name)
+        except PackageNotFoundError:
+            value = 'unknown'
+        globals()['__version__'] = value
+        return value
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
@@ -16,12 +16,22 @@ also be used as template for Python modules.
 Note: This skeleton file can be safely removed if not needed!
 """
 
+import os
 import sys
 import argparse
 import logging
+import threading
 
-from alamos_extract import __version__
-from alamos_extract.load_data import load_cluster, search_db, Cluster
+# Only modules without heavy dependencies are imported here, so --version,
+# --help and argument errors don't pay for pandas, requests, bs4 and lxml.
+# Those load in run_command, once a subcommand actually runs.
+from alamos_extract import profiling
+from alamos_extract.bulk import ENGINES
+from alamos_extract.cache import ResponseCache, default_cache_dir
+from alamos_extract.export import DEFAULT_PARTITION_COLS, FORMATS, write_table
+from alamos_extract.harvest import harvest_clusters, parse_id_ranges, write_cluster
+from alamos_extract.index import DEFAULT_DB, KINDS, open_index
+from alamos_extract.ratelimit import ENDPOINTS, RateLimiter
 from alamos_extract.form_dicts import region_dict, subtype_dict, virus_dict
 
 
@@ -34,6 +44,28 @@ _logger = logging.getLogger(__name__)
 REGION_CHOICES = tuple(region_dict)
 SUBTYPE_CHOICES = tuple(subtype_dict)
 VIRUS_CHOICES = tuple(virus_dict)
+CACHE_TTL = 7 * 24 * 3600  # seconds
+CACHE_MAX_BYTES = 1024 ** 3
+
+
+def __getattr__(name):
+    # load_data functions used to be imported here; load them on first use
+    if name in ('load_cluster', 'search_db', 'Cluster'):
+        from alamos_extract import load_data
+        return getattr(load_data, name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+class VersionAction(argparse.Action):
+    """--version, looking up the installed version only when requested."""
+    def __init__(self, option_strings, dest=argparse.SUPPRESS, default=argparse.SUPPRESS,
+                 help="show program's version number and exit"):
+        super().__init__(option_strings=option_strings, dest=dest, default=default, nargs=0, help=help)
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        from alamos_extract import __version__
+        parser._print_message('alamos-extract {ver}\n'.format(ver=__version__), sys.stdout)
+        parser.exit()
 
 
 def parse_args(args):
@@ -49,11 +81,39 @@ def parse_args(args):
         description="Los Alamos HIV Database cluster/patient extractor.")
     parser.add_argument(
         '--version',
-        action='version',
-        version='alamos-extract {ver}'.format(ver=__version__))
+        action=VersionAction)
+    parser.add_argument('--cache-dir', default=default_cache_dir(),
+                        help='Response cache directory (default: %(default)s)')
+    parser.add_argument('--no-cache', action='store_true', help='Do not read or write the response cache')
+    parser.add_argument('--refresh', action='store_true',
+                        help='Re-download all pages, replacing cached responses')
+    parser.add_argument('--rate', type=float, default=None,
+                        help='Maximum requests per second to the database (default: no cap)')
+    parser.add_argument('--max-in-flight', type=int, default=None,
+                        help='Upper bound for concurrent requests; within it, concurrency adapts to '
+                             'server latency and errors (default: connection pool size)')
+    parser.add_argument('--endpoint-limit', action='append', default=[], type=parse_endpoint_limit,
+                        metavar='ENDPOINT=RATE[:MAX_IN_FLIGHT]',
+                        help='Limits for one endpoint ({}), repeatable'.format(', '.join(ENDPOINTS)))
+    parser.add_argument('--no-throttle', action='store_true',
+                        help='Disable client-side rate limiting and adaptive concurrency')
+    parser.add_argument('--engine', default='html', choices=ENGINES,
+                        help="How search and timepoint results are fetched: 'html' scrapes the paged "
+                             "result grids, 'download' requests one tab-delimited download and falls back "
+                             "to the grids if the server sends none (default: %(default)s)")
+    parser.add_argument('--profile', metavar='OUT_JSON', default=None,
+                        help='Write a Chrome trace of per-stage timings and requests to OUT_JSON, '
+                             'and print a summary table')
     subparsers = parser.add_subparsers(help='sub-command help', dest='subparser')
+    output = argparse.ArgumentParser(add_help=False)
+    output.add_argument('-f', '--format', default='tsv', choices=FORMATS,
+                        help='Output file format (default: %(default)s)')
+    timepoints = argparse.ArgumentParser(add_help=False)
+    timepoints.add_argument('--no-timepoints', dest='timepoints', action='store_false',
+                            help="Skip the paged timepoint tables; write the patient pages' accession "
+                                 "listing instead")
 
-    parser_c = subparsers.add_parser('cluster', help='Cluster search help')
+    parser_c = subparsers.add_parser('cluster', help='Cluster search help', parents=[output, timepoints])
     parser_c.add_argument(
         'cluster_id',
         metavar='cluster_id',
@@ -61,15 +121,92 @@ def parse_args(args):
         type=int,
         default=701
     )
+    parser_c.add_argument('-j', '--max-workers', default=1, type=int,
+                          help='Number of patient pages to fetch concurrently')
+
+    parser_b = subparsers.add_parser('clusters', help='Batch download of many clusters',
+                                     parents=[output, timepoints])
+    parser_b.add_argument('cluster_ids', type=parse_id_ranges,
+                          help="Cluster IDs and ranges, e.g. '1-900,1200'")
+    parser_b.add_argument('-o', '--out-dir', default='.', help='Output directory')
+    parser_b.add_argument('-j', '--max-workers', default=4, type=int,
+                          help='Number of clusters to download concurrently')
+    parser_b.add_argument('--journal', default=None,
+                          help='Checkpoint journal (default: OUT_DIR/clusters_journal.jsonl)')
+    parser_b.add_argument('--partition-by', nargs='?', const=','.join(DEFAULT_PARTITION_COLS),
+                          type=lambda s: tuple(s.split(',')), default=None,
+                          help='Write accessions as a hive-partitioned dataset in OUT_DIR/accessions, '
+                               'partitioned by these columns (default: %(const)s)')
+
+    parser_w = subparsers.add_parser('sync', help='Sync clusters into a local SQLite warehouse')
+    parser_w.add_argument('cluster_ids', nargs='?', type=parse_id_ranges, default=[],
+                          help="Cluster IDs and ranges, e.g. '1-900,1200'")
+    parser_w.add_argument('--db', default=None,
+                          help='Warehouse file (default: alamos_extract.sqlite in the current directory)')
+    parser_w.add_argument('--cluster-name', action='append', default=[],
+                          help='Also sync sequence search results for this cluster name (repeatable)')
+    parser_w.add_argument('-m', '--max-rec', default=100, type=int,
+                          help='Max row count per cluster name search (default: %(default)s)')
+    parser_w.add_argument('-j', '--max-workers', default=4, type=int,
+                          help='Number of pages to fetch concurrently')
+    parser_w.add_argument('--max-age', type=float, default=None,
+                          help='Skip clusters and patients synced less than this many seconds ago')
 
     # max_rec=100, virus='HIV-1', subtype='A1*', region='GENOME'
-    parser_s = subparsers.add_parser('cluster_name', help='Cluster name search')
+    parser_s = subparsers.add_parser('cluster_name', help='Cluster name search', parents=[output])
     parser_s.add_argument('cluster_name', default=None, help='Cluster name (not integer ID)')
     parser_s.add_argument('-t', '--virus', nargs='?', default='HIV-1', help='Virus', choices=VIRUS_CHOICES)
     parser_s.add_argument('-s', '--subtype', nargs='?', default='any', help='Subtype', choices=SUBTYPE_CHOICES)
     parser_s.add_argument('-r', '--region', nargs='?', default='any', help='Region', choices=REGION_CHOICES)
     parser_s.add_argument('-m', '--maxrows', nargs='?', default=100, type=int, help='Max row count')
 
+    parser_g = subparsers.add_parser('search', help='Sequence searches over combinations of choices',
+                                     parents=[output])
+    parser_g.add_argument('-t', '--virus', nargs='+', default=['HIV-1'], choices=VIRUS_CHOICES, metavar='VIRUS',
+                          help='Viruses (default: HIV-1)')
+    parser_g.add_argument('-s', '--subtype', nargs='+', default=['any'], choices=SUBTYPE_CHOICES,
+                          metavar='SUBTYPE', help='Subtypes, e.g. A1 B CRF01_AE (default: any)')
+    parser_g.add_argument('-r', '--region', nargs='+', default=['any'], choices=REGION_CHOICES, metavar='REGION',
+                          help="Genomic regions, e.g. 'complete genome' gp120 (default: any)")
+    parser_g.add_argument('-m', '--maxrows', default=100, type=int, help='Max row count per combination')
+    parser_g.add_argument('-j', '--max-workers', default=4, type=int,
+                          help='Number of searches to run concurrently')
+    parser_g.add_argument('-o', '--out', default='search_grid', help='Output file stem (default: %(default)s)')
+
+    parser_n = subparsers.add_parser('network', help='Clusters and patients linked to a seed cluster',
+                                     parents=[output, timepoints])
+    parser_n.add_argument('cluster_id', type=int, help='Seed cluster ID')
+    parser_n.add_argument('--depth', default=1, type=int,
+                          help='Patient hops to follow from the seed cluster (default: %(default)s)')
+    parser_n.add_argument('--max-clusters', default=None, type=int, help='Stop adding clusters beyond this many')
+    parser_n.add_argument('--max-patients', default=None, type=int, help='Stop adding patients beyond this many')
+    parser_n.add_argument('-j', '--max-workers', default=4, type=int,
+                          help='Number of pages to fetch concurrently')
+    parser_n.add_argument('-o', '--out', default=None,
+                          help='Output path prefix (default: network_CLUSTER_ID)')
+
+    parser_l = subparsers.add_parser('lookup', help='Look up accessions, patients and clusters in the '
+                                                    'synced warehouse, without network access')
+    parser_l.add_argument('terms', nargs='+',
+                          help='Accessions, se_ids, patient ids or codes, cluster ids or names')
+    parser_l.add_argument('--kind', default=None, choices=KINDS, help='Only match this kind of key')
+    parser_l.add_argument('--db', default=None,
+                          help='Warehouse file (default: {} in the current directory)'.format(DEFAULT_DB))
+    parser_l.add_argument('--index', default=None, help='Index file (default: DB.index)')
+    parser_l.add_argument('--rebuild', action='store_true',
+                          help='Rebuild the index (it is rebuilt automatically when the warehouse is newer)')
+
+    parser_v = subparsers.add_parser('serve', help='Local HTTP/JSON lookup service with warm caches')
+    parser_v.add_argument('--host', default='127.0.0.1', help='Address to listen on (default: %(default)s)')
+    parser_v.add_argument('--port', default=8707, type=int, help='Port to listen on (default: %(default)s)')
+    parser_v.add_argument('--max-entries', default=256, type=int,
+                          help='Lookup results kept in memory (default: %(default)s)')
+    parser_v.add_argument('--refresh-after', default=3600, type=float,
+                          help='Reload frequently used results in the background once they are this many '
+                               'seconds old (default: %(default)s)')
+    parser_v.add_argument('-j', '--max-workers', default=4, type=int,
+                          help='Number of patient pages to fetch concurrently per cluster')
+
     parser.add_argument(
         '-v',
         '--verbose',
@@ -84,7 +221,28 @@ def parse_args(args):
         help="set loglevel to DEBUG",
         action='store_const',
         const=logging.DEBUG)
-    return parser.parse_args(args)
+    args = parser.parse_args(args)
+    if getattr(args, 'partition_by', None) and args.format == 'tsv':
+        parser.error('--partition-by needs a columnar --format (parquet, feather or arrow)')
+    if getattr(args, 'partition_by', None) and not args.timepoints:
+        parser.error('--partition-by needs the timepoint tables, not --no-timepoints')
+    return args
+
+
+def parse_endpoint_limit(spec):
+    """Parse 'ENDPOINT=RATE[:MAX_IN_FLIGHT]' into (endpoint, Throttle kwargs)."""
+    try:
+        endpoint, limits = spec.split('=', 1)
+        rate, _, max_in_flight = limits.partition(':')
+        kwargs = {'rate': float(rate) if rate else None}
+        if max_in_flight:
+            kwargs['max_concurrency'] = int(max_in_flight)
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected ENDPOINT=RATE[:MAX_IN_FLIGHT], got {!r}".format(spec))
+    if endpoint not in ENDPOINTS:
+        raise argparse.ArgumentTypeError("unknown endpoint {!r}, choose from {}".format(
+            endpoint, ', '.join(ENDPOINTS)))
+    return endpoint, kwargs
 
 
 def setup_logging(loglevel):
@@ -98,6 +256,29 @@ def setup_logging(loglevel):
                         format=logformat, datefmt="%Y-%m-%d %H:%M:%S")
 
 
+def make_client(args, **kwargs):
+    """Build HivClient with the response cache configured by command line args."""
+    from alamos_extract.client import HivClient
+
+    cache = None
+    if not args.no_cache:
+        cache = ResponseCache(args.cache_dir, ttl=CACHE_TTL, max_bytes=CACHE_MAX_BYTES)
+    limiter = None
+    if not args.no_throttle:
+        max_in_flight = args.max_in_flight or kwargs.get('pool_maxsize', 10)
+        kwargs['pool_maxsize'] = max(max_in_flight, kwargs.get('pool_maxsize', 10))
+        limiter = RateLimiter(rate=args.rate, max_concurrency=max_in_flight,
+                              endpoints=dict(args.endpoint_limit))
+    return HivClient(cache=cache, refresh=args.refresh, limiter=limiter, **kwargs)
+
+
+def print_progress(progress):
+    """Show grid search progress on one terminal line."""
+    if sys.stderr.isatty():
+        sys.stderr.write('\r' + progress.format())
+        sys.stderr.flush()
+
+
 def main(args):
     """Main entry point allowing external calls
 
@@ -106,19 +287,38 @@ def main(args):
     """
     args = parse_args(args)
     setup_logging(args.loglevel)
+    if not args.profile:
+        run_command(args)
+        return
+    profiler = profiling.enable()
+    try:
+        run_command(args)
+    finally:
+        profiling.disable()
+        profiler.write(args.profile)
+        print(profiler.format_summary(), file=sys.stderr)
+        print('Profile written to {}'.format(args.profile), file=sys.stderr)
+
+
+def run_command(args):
+    """Run the subcommand selected by parsed command line args."""
+    if args.subparser == 'lookup':
+        # answered from the index alone, before loading pandas and the scrapers
+        run_lookup(args)
+        return
+    from alamos_extract.load_data import search_db, Cluster
+    from alamos_extract.warehouse import DEFAULT_PATH, Warehouse, summarize_counts, sync_clusters, sync_search
 
     if args.subparser == 'cluster':
         cluster_id = args.cluster_id
         _logger.debug("Parsing cluster ID {}".format(cluster_id))
-        c = Cluster(cluster_id)
-        path_accession = 'cluster_{}_accessions.tsv'.format(cluster_id)
-        path_clinical = 'cluster_{}_clinical.tsv'.format(cluster_id)
-        c.acc_df.to_csv(path_accession, sep='\t', index=False)
-        c.desc_df.to_csv(path_clinical, sep='\t', index=True)
+        client = make_client(args, pool_maxsize=max(10, args.max_workers))
+        c = Cluster(cluster_id, client=client, max_workers=args.max_workers, engine=args.engine)
+        path_accession, path_clinical = write_cluster(c, fmt=args.format, timepoints=args.timepoints)
 
         patient_names = ', '.join(c.comb_patients.keys())
         n_patients = len(c.patient_dict)
-        n_accessions = len(c.acc_df)
+        n_accessions = len(c.acc_df if args.timepoints else c.accession_list_df)
 
         # data = load_cluster(cluster_id)
         print('Cluster: {}'.format(c.cluster_name))
@@ -128,25 +328,153 @@ def main(args):
         print('Clinical data written to {}'.format(path_clinical))
         print('Accession data written to {}'.format(path_accession))
 
+    elif args.subparser == 'clusters':
+        client = make_client(args, pool_maxsize=max(10, args.max_workers))
+        summary = harvest_clusters(args.cluster_ids, out_dir=args.out_dir, client=client,
+                                   max_workers=args.max_workers, journal_path=args.journal,
+                                   fmt=args.format, partition_cols=args.partition_by,
+                                   timepoints=args.timepoints, engine=args.engine)
+        print('{} clusters written to {}, {} failed, {} skipped (already done).'.format(
+            summary['completed'], args.out_dir, len(summary['failed']), summary['skipped']))
+        print('{:.1f} s, {:.2f} clusters/s, {} pages fetched, {} cache hits.'.format(
+            summary['seconds'], summary['clusters_per_second'], summary['pages_fetched'],
+            summary['cache_hits']))
+        print('{} patient tables downloaded, {} reused for patients in several clusters.'.format(
+            summary['patient_tables_fetched'], summary['patient_tables_reused']))
+        if summary['failed']:
+            print('Failed cluster IDs: {}'.format(', '.join(str(i) for i in sorted(summary['failed']))))
+
+    elif args.subparser == 'sync':
+        # cached pages would hide upstream changes; revalidation keeps unchanged pages cheap
+        sync_args = argparse.Namespace(**dict(vars(args), refresh=True))
+        client = make_client(sync_args, pool_maxsize=max(10, args.max_workers))
+        db = args.db or DEFAULT_PATH
+        with Warehouse(db) as warehouse:
+            report = sync_clusters(args.cluster_ids, warehouse, client=client,
+                                   max_workers=args.max_workers, max_age=args.max_age)
+            for cluster_name in args.cluster_name:
+                _, counts = sync_search(warehouse, client=client, max_rec=args.max_rec, virus=virus_dict['HIV-1'],
+                                        subtype=subtype_dict['any'], region=None, cluster_name=cluster_name)
+                for table, table_counts in counts.items():
+                    for k, v in table_counts.items():
+                        report['counts'].setdefault(table, dict.fromkeys(table_counts, 0))[k] += v
+        total = summarize_counts(report['counts'])
+        print('{} clusters, {} patients, {} searches synced to {} ({} skipped as fresh) in {:.1f} s.'.format(
+            report['clusters'], report['patients'], len(args.cluster_name), db, report['skipped'],
+            report['seconds']))
+        for entity, status in report['entities'].items():
+            print('{}: {new} new, {changed} changed, {unchanged} unchanged.'.format(
+                entity.capitalize(), **status))
+        print('Rows: {inserted} inserted, {updated} updated, {deleted} deleted, {unchanged} unchanged.'.format(
+            **total))
+        if report['not_modified']:
+            print('{} pages revalidated without download (304 Not Modified).'.format(report['not_modified']))
+        if report['failed']:
+            print('Failed: {}'.format(', '.join(sorted(report['failed']))))
+
+    elif args.subparser == 'search':
+        from alamos_extract.grid import search_grid
+
+        client = make_client(args, pool_maxsize=max(10, args.max_workers))
+        progress = None
+
+        def show(tracker):
+            nonlocal progress
+            progress = tracker
+            print_progress(tracker)
+
+        try:
+            df = search_grid(args.virus, args.subtype, args.region, max_rec=args.maxrows, client=client,
+                             max_workers=args.max_workers, progress=show)
+        finally:
+            if sys.stderr.isatty():
+                sys.stderr.write('\n')
+        df = df.drop(columns=['blast', 'blast2'], errors='ignore')
+        out_path = write_table(df, args.out, fmt=args.format, index=False)
+        stats = progress.stats()  # called back at least once per search
+        print('{} searches: {} sequences ({} rows before removing duplicates) in {} pages.'.format(
+            stats['queries'], len(df), stats['rows'], stats['pages']))
+        print('{:.1f} s, {:.0f} rows/s, {:.1f} pages/s.'.format(
+            stats['seconds'], stats['rows_per_second'], stats['pages_per_second']))
+        print('Search results written to {}'.format(out_path))
+
+    elif args.subparser == 'network':
+        from alamos_extract.network import expand_network, write_network
+
+        client = make_client(args, pool_maxsize=max(10, args.max_workers))
+        network = expand_network(args.cluster_id, depth=args.depth, max_clusters=args.max_clusters,
+                                 max_patients=args.max_patients, client=client, max_workers=args.max_workers,
+                                 engine=args.engine)
+        paths = write_network(network, args.out or 'network_{}'.format(args.cluster_id), fmt=args.format,
+                              timepoints=args.timepoints)
+        print('{} clusters and {} patients within {} hops of cluster {}{}.'.format(
+            len(network.clusters), len(network.patients), args.depth, args.cluster_id,
+            ' (limits reached, more are linked)' if network.truncated else ''))
+        print('Expanded in {:.1f} s; {} pages fetched in total, {} cache hits.'.format(
+            network.seconds, client.n_requests, client.n_cache_hits))
+        for name, label in (('graphml', 'GraphML'), ('nodes', 'Nodes'), ('edges', 'Edges'),
+                            ('accessions', 'Accessions')):
+            print('{} written to {}'.format(label, paths[name]))
+
+    elif args.subparser == 'serve':
+        from alamos_extract.service import LookupServer, LookupService
+
+        pool_maxsize = max(10, args.max_workers)
+        disk_cache = None
+        if not args.no_cache:
+            disk_cache = ResponseCache(os.path.join(args.cache_dir, 'service'), ttl=CACHE_TTL,
+                                       max_bytes=CACHE_MAX_BYTES)
+        refresh_args = argparse.Namespace(**dict(vars(args), refresh=True))
+        service = LookupService(make_client(args, pool_maxsize=pool_maxsize),
+                                refresh_client=make_client(refresh_args, pool_maxsize=pool_maxsize),
+                                maxsize=args.max_entries, disk_cache=disk_cache,
+                                refresh_after=args.refresh_after, max_workers=args.max_workers,
+                                engine=args.engine)
+        service.start_refresher(interval=min(60, args.refresh_after))
+        with LookupServer(service, args.host, args.port) as server:
+            print('Serving lookups on {} (Ctrl-C to stop)'.format(server.url))
+            try:
+                threading.Event().wait()
+            except KeyboardInterrupt:
+                pass
+
     elif args.subparser == 'cluster_name':
         cluster_name = args.cluster_name
         virus = virus_dict[args.virus]
         subtype = subtype_dict[args.subtype]
         df = search_db(max_rec=args.maxrows, virus=virus,
                        subtype=subtype, cluster_name=args.cluster_name,
-                       region=None)
+                       region=None, client=make_client(args), engine=args.engine)
         df.drop(['blast', 'blast2'], axis=1, inplace=True)
         clusters = list(df['cluster_comb'].unique())
         n_clusters = len(clusters)
         if n_clusters == 1:
             clusters = clusters[0]
         _logger.info("%d clusters identified: %s", n_clusters, clusters)
-        tsv_path = f'cluster_{cluster_name}_info.tsv'
-        df.to_csv(tsv_path, sep='\t', index=False)
-        _logger.info(f"Cluster sequence metadata saved to {tsv_path}.")
+        out_path = write_table(df, f'cluster_{cluster_name}_info', fmt=args.format)
+        _logger.info(f"Cluster sequence metadata saved to {out_path}.")
     _logger.info("Script complete.")
 
 
+def run_lookup(args):
+    """Print index records matching each term as JSON lines; exit 1 if a term matches nothing."""
+    import json
+
+    with open_index(args.db or DEFAULT_DB, args.index, rebuild=args.rebuild) as index:
+        missing = []
+        for term in args.terms:
+            hits = [(args.kind, index.get(args.kind, term))] if args.kind else index.find(term)
+            hits = [(kind, record) for kind, record in hits if record is not None]
+            if not hits:
+                missing.append(term)
+            for kind, record in hits:
+                for r in record if isinstance(record, list) else [record]:
+                    print(json.dumps(dict(term=term, kind=kind, **r)))
+    if missing:
+        print('No match for {}'.format(', '.join(missing)), file=sys.stderr)
+        sys.exit(1)
+
+
 def run():
     """Entry point for console_scripts
     """
@@ -0,0 +1,221 @@
+"""asyncio counterparts to the :mod:`alamos_extract.load_data` public functions.
+
+Requests go through an :class:`AsyncHivClient` (built on aiohttp) whose
+semaphore bounds the number of requests in flight, so thousands of lookups
+can be scheduled from one process. Page parsing reuses the load_data parsers
+and runs in worker threads so it never blocks the event loop.
+
+Requires the optional ``aiohttp`` dependency (``pip install alamos-extract[async]``).
+
+Example:
+    >>> async with AsyncHivClient(max_concurrency=50) as client:
+    ...     clusters = await asyncio.gather(*[Cluster.create(i, client=client) for i in ids])
+"""
+
+import asyncio
+import contextlib
+import logging
+from collections import OrderedDict
+from urllib.parse import urljoin
+
+from alamos_extract import load_data, tables
+from alamos_extract.client import BASE_URL
+
+try:
+    import aiohttp
+except ImportError:  # pragma: no cover
+    aiohttp = None
+
+__author__ = "Stephen Gaffney"
+__copyright__ = "Stephen Gaffney"
+__license__ = "gpl3"
+
+_logger = logging.getLogger(__name__)
+
+RETRY_STATUSES = (500, 502, 503, 504)
+
+
+class AsyncHivClient:
+    """aiohttp client for HIV Database pages with bounded fan-out.
+
+    Args:
+        base_url (str): prefix for the database's search components.
+        timeout (float): total timeout per request, in seconds.
+        retries (int): retries for connection errors, timeouts and 5xx responses.
+        backoff_factor (float): retry delay is backoff_factor * 2 ** attempt seconds.
+        max_concurrency (int): maximum requests in flight across all hosts.
+        limit_per_host (int): maximum open connections per host.
+        verify (bool): verify TLS certificates.
+    """
+    def __init__(self, base_url=BASE_URL, timeout=120, retries=3, backoff_factor=0.5,
+                 max_concurrency=100, limit_per_host=10, verify=False):
+        if aiohttp is None:
+            raise ImportError("The asyncio API requires aiohttp: pip install alamos-extract[async]")
+        self.base_url = base_url
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self._timeout = aiohttp.ClientTimeout(total=timeout)
+        self._limit_per_host = limit_per_host
+        self._verify = verify
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._session = None
+
+    def url(self, path):
+        """Resolve a search component path against base_url."""
+        return urljoin(self.base_url, path)
+
+    @property
+    def session(self):
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit_per_host=self._limit_per_host,
+                                             ssl=None if self._verify else False)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self._timeout)
+        return self._session
+
+    async def fetch(self, url, data=None):
+        """Get raw page content, using POST request if data supplied.
+
+        The concurrency slot is only held while a request is in flight, not
+        during the backoff before a retry.
+        """
+        for attempt in range(self.retries + 1):
+            async with self._semaphore:
+                try:
+                    if data:
+                        request = self.session.post(url, data=_form_strings(data))
+                    else:
+                        request = self.session.get(url)
+                    async with request as response:
+                        if response.status in RETRY_STATUSES and attempt < self.retries:
+                            _logger.debug("HTTP %d from %s, retrying", response.status, url)
+                        else:
+                            response.raise_for_status()
+                            return await response.read()
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                    if attempt == self.retries:
+                        raise
+                    _logger.debug("Connection error for %s, retrying", url)
+            await asyncio.sleep(self.backoff_factor * 2 ** attempt)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+@contextlib.asynccontextmanager
+async def _client_scope(client):
+    """Use client if given, otherwise a temporary AsyncHivClient."""
+    if client is not None:
+        yield client
+    else:
+        async with AsyncHivClient() as client:
+            yield client
+
+
+def _form_strings(data):
+    # aiohttp only encodes str values in form data
+    return {k: str(v) for k, v in data.items()}
+
+
+async def soup_pager(url, data=None, client=None):
+    """Async iterator over the soups of a paged results table. See content_pager."""
+    async for content in content_pager(url, data=data, client=client):
+        yield await asyncio.to_thread(load_data._get_soup_from_content, content)
+
+
+async def content_pager(url, data=None, client=None):
+    """Async iterator over the raw pages of a paged results table.
+
+    The next page is requested as soon as its paging controls are found in
+    the raw bytes, so it downloads while the caller parses the current page.
+    """
+    async with _client_scope(client) as client:
+        content = await client.fetch(url, data=data)
+        pending = None
+        try:
+            while True:
+                new_data = load_data._next_page_data_from_content(content, data)
+                if new_data is None:
+                    yield content
+                    return
+                pending = asyncio.ensure_future(client.fetch(url, data=new_data))
+                yield content
+                content = await pending
+                pending = None
+        finally:
+            # the caller stopped early: don't leave the next page downloading
+            if pending is not None and not pending.done():
+                pending.cancel()
+
+
+async def load_cluster(cluster_id, client=None):
+    """Async version of :func:`alamos_extract.load_data.load_cluster`."""
+    async with _client_scope(client) as client:
+        content = await client.fetch(client.url(load_data._cluster_path(cluster_id)))
+        return await asyncio.to_thread(tables.read_cluster_page, content)
+
+
+async def search_db(max_rec=100, virus='HIV-1', subtype='A1*', region='GENOME',
+                    cluster_name=None, client=None):
+    """Async version of :func:`alamos_extract.load_data.search_db`."""
+    async with _client_scope(client) as client:
+        url = client.url('search.comp')
+        test_form, main_cols = load_data._search_form(max_rec, virus, subtype, region, cluster_name)
+        if cluster_name is not None:
+            df_list = []
+            ind = 0
+            async for content in content_pager(url, data=test_form, client=client):
+                ind += 1
+                _logger.info("Loading page %d for cluster %s", ind, cluster_name)
+                df_list.append(await asyncio.to_thread(load_data._get_df_from_content, content, main_cols))
+            return load_data._concat_results(df_list)
+        content = await client.fetch(url, data=test_form)
+        return await asyncio.to_thread(load_data._get_df_from_content, content, main_cols)
+
+
+async def extract_patient_info(patient_id, client=None):
+    """Async version of :func:`alamos_extract.load_data.extract_patient_info`."""
+    async with _client_scope(client) as client:
+        url = client.url(load_data._patient_path(patient_id))
+        content = await client.fetch(url)
+        return await asyncio.to_thread(tables.read_patient_page, content, patient_id)
+
+
+async def extract_patient_accession_timepoints(patient_id, client=None):
+    """Async version of :func:`alamos_extract.load_data.extract_patient_accession_timepoints`."""
+    async with _client_scope(client) as client:
+        url = client.url(load_data._timepoints_path(patient_id))
+        main_cols = list(load_data._TIMEPOINT_COLS)
+        df_list = []
+        async for content in content_pager(url, client=client):
+            if df_list:
+                _logger.info("Loading page {} for patient {}".format(len(df_list) + 1, patient_id))
+            df_list.append(await asyncio.to_thread(load_data._get_df_from_content, content, main_cols))
+        return load_data._concat_timepoint_pages(df_list)
+
+
+async def load_patient(patient_id, patient_code=None, client=None):
+    """Build a :class:`alamos_extract.load_data.Patient`, fetching both pages concurrently."""
+    data, accession_df = await asyncio.gather(extract_patient_info(patient_id, client),
+                                              extract_patient_accession_timepoints(patient_id, client))
+    return load_data.Patient.from_data(patient_id, patient_code, data, accession_df)
+
+
+async def create_cluster(cluster_id, client=None, cls=load_data.Cluster):
+    """Build a Cluster, fetching all patients concurrently. See :meth:`Cluster.create`."""
+    async with _client_scope(client) as client:
+        cluster = cls.__new__(cls)
+        cluster.cluster_id = cluster_id
+        cluster._set_header(await load_cluster(cluster_id, client))
+        patients = await asyncio.gather(*[load_patient(patient_id, patient_code, client)
+                                          for patient_code, patient_id in cluster.comb_patients.items()])
+    cluster.patient_dict = OrderedDict((p.patient_id, p) for p in patients)
+    await asyncio.to_thread(cluster._build_tables)
+    return cluster
@@ -0,0 +1,184 @@
+"""Tab-delimited bulk downloads of search and timepoint results.
+
+Besides the paged HTML grid, the search interface can return a whole result
+set as one tab-delimited download. :func:`search_download` and
+:func:`timepoints_download` request that format and read it with the C CSV
+parser into the same typed DataFrame the HTML scraper in
+:mod:`alamos_extract.load_data` builds: same columns, in the same order,
+with the same dtypes. There are no Next-page round trips and no HTML to
+parse. The links the grid carries are rebuilt from the exported fields.
+
+When the response is not a tab-delimited table (e.g. an HTML error page),
+these functions return no table but hand back the page, and the callers fall
+back to the HTML scraper. A server that ignores the download field answers
+with the grid's first page, which the scraper then starts from. Such pages
+are never cached as downloads.
+
+The download field and value and the column headers are modelled on the
+search interface, not taken from a live download. DOWNLOAD_FIELD,
+DOWNLOAD_FORMAT and DOWNLOAD_HEADERS are the defaults; pass field, value and
+headers to override them for one call, or assign the module attributes.
+
+pandas and requests are imported on first use, so the command line can
+import ENGINES without them.
+"""
+
+import io
+import logging
+
+from alamos_extract import profiling
+
+__author__ = "Stephen Gaffney"
+__copyright__ = "Stephen Gaffney"
+__license__ = "gpl3"
+
+_logger = logging.getLogger(__name__)
+
+ENGINES = ('html', 'download')
+DOWNLOAD_FIELD = 'download_format'
+DOWNLOAD_FORMAT = 'tab'
+NCBI_URL = 'http://www.ncbi.nlm.nih.gov/nuccore/{}?report=graph'
+
+# Download column header -> results table column
+DOWNLOAD_HEADERS = {
+    'SE id': 'blast_ssam_se_id',
+    'Accession': 'accession',
+    'Name': 'seq_name',
+    'Patient Id': 'patient_id',
+    'Patient Code': 'patient_code',
+    'Subtype': 'subtype',
+    'Country': 'country',
+    'Sampling Year': 'sampling_year',
+    'Cluster': 'cluster_comb',
+    'Days from first sample': 'days_from_first_sample',
+    'Fiebig stage': 'fiebig_stage',
+    'Days from treatment end': 'days_from_treatment_end',
+    'Days from treatment start': 'days_from_treatment_start',
+    'Days from infection': 'days_from_infection',
+    'Days from seroconversion': 'days_from_seroconversion',
+    'Genomic Region': 'genomic_region',
+    'Sequence Length': 'seq_length',
+    'Organism': 'organism',
+    'Start': 'pos_start',
+    'Stop': 'pos_stop',
+}
+# Grid columns holding only links or images
+_LINK_COLS = ('blast', 'blast2')
+_DERIVED_COLS = ('row_id', 'patient_comb', 'pos', 'ncbi_url') + _LINK_COLS
+
+
+def check_engine(engine):
+    if engine not in ENGINES:
+        raise ValueError("Unknown engine {!r}, choose from {}".format(engine, ', '.join(ENGINES)))
+
+
+def search_download(url, form, main_cols, client, field=None, value=None, headers=None):
+    """Search results as one download.
+
+    Args:
+        url (str): search.comp URL.
+        form (dict): search form, as built by load_data._search_form.
+        main_cols (list): the HTML grid's column headers for this search.
+        client (HivClient): HTTP client to use.
+        field, value (str): form field and value requesting the download
+            (default: DOWNLOAD_FIELD and DOWNLOAD_FORMAT).
+        headers (dict): download column header -> results table column
+            (default: DOWNLOAD_HEADERS).
+
+    Returns:
+        df (pandas.DataFrame): the results, or None if the server did not
+            send a table.
+        page (bytes): the server's reply if it was not a table, e.g. the
+            first page of the HTML grid, else None.
+    """
+    data = dict(form)
+    data[field or DOWNLOAD_FIELD] = value or DOWNLOAD_FORMAT
+    return _download(url, data, main_cols, client, headers)
+
+
+def timepoints_download(url, main_cols, client, field=None, value=None, headers=None):
+    """Patient timepoint table as one download. Arguments and returns as for search_download."""
+    download_url = '{}&{}={}'.format(url, field or DOWNLOAD_FIELD, value or DOWNLOAD_FORMAT)
+    return _download(download_url, None, main_cols, client, headers)
+
+
+def _download(url, data, main_cols, client, headers):
+    import requests
+
+    try:
+        content = client.fetch(url, data=data, accept=is_download)
+    except requests.HTTPError as e:
+        _logger.info("Download from %s failed (%s), using the HTML pages", url, e)
+        return None, None
+    if not is_download(content):
+        _logger.info("%s sent no tab-delimited download, using the HTML pages", url)
+        return None, content
+    return read_download(content, main_cols, headers), None
+
+
+def is_download(content):
+    """Whether content looks like a tab-delimited table rather than a page."""
+    head = content.lstrip()[:4096]
+    return not head.startswith(b'<') and b'\t' in head.split(b'\n', 1)[0]
+
+
+@profiling.traced('parse')
+def read_download(content, main_cols, headers=None):
+    """Typed DataFrame from a tab-delimited download, as the HTML scraper builds it.
+
+    Args:
+        content (bytes): the download.
+        main_cols (list): the HTML grid's column headers, fixing which
+            columns the result has and their order.
+        headers (dict): download column header -> results table column
+            (default: DOWNLOAD_HEADERS).
+
+    Returns:
+        df (pd.DataFrame): results table with a fresh RangeIndex.
+
+    Raises:
+        ValueError: the download lacks a column of main_cols.
+    """
+    import pandas as pd
+
+    # deferred: load_data imports this module on first use of the download engine
+    from alamos_extract.load_data import _apply_schema
+
+    raw = pd.read_csv(io.BytesIO(content), sep='\t', dtype=str, keep_default_na=False, na_values=[''])
+    raw = raw.rename(columns=DOWNLOAD_HEADERS if headers is None else headers)
+    if 'accession_id' in main_cols:
+        raw = raw.rename(columns={'accession': 'accession_id'})
+    columns = _result_columns(main_cols)
+    missing = [c for c in columns if c not in _DERIVED_COLS and c not in raw.columns]
+    if missing:
+        raise ValueError("Download lacks columns: {}".format(', '.join(missing)))
+    n = len(raw)
+    derived = {
+        'row_id': pd.Series([str(i) for i in range(1, n + 1)], dtype=str),
+        'patient_comb': raw['patient_code'] + '(' + raw['patient_id'] + ')',
+        'pos': raw['pos_start'] + ':' + raw['pos_stop'],
+        'ncbi_url': pd.Series([NCBI_URL.format(acc) for acc in raw[_accession_col(main_cols)]], dtype=str),
+    }
+    for col in _LINK_COLS:
+        derived[col] = pd.Series([None] * n, dtype=str)
+    df = pd.DataFrame({c: derived[c] if c in derived else raw[c] for c in columns})
+    for col in ('patient_id', 'blast_ssam_se_id'):
+        df[col] = df[col].astype('int64')
+    for col in ('pos_start', 'pos_stop'):
+        df[col] = pd.to_numeric(df[col]).astype('Int64')
+    return _apply_schema(df)
+
+
+def _accession_col(main_cols):
+    return 'accession_id' if 'accession_id' in main_cols else 'accession'
+
+
+def _result_columns(main_cols):
+    """Column order of load_data._process_results_df for grid headers main_cols."""
+    columns = list(main_cols)
+    if 'blast2' not in columns:
+        columns.insert(2, 'blast2')
+    columns.insert(2, 'patient_id')
+    columns.insert(3, 'patient_code')
+    columns.insert(5, 'blast_ssam_se_id')
+    return columns + ['pos', 'pos_start', 'pos_stop', 'ncbi_url']
@@ -0,0 +1,186 @@
+"""Persistent on-disk cache of raw HIV Database responses.
+
+Entries are keyed by a hash of request method, URL, canonicalised form data
+and (for paged result tables) the page number, and stored zlib-compressed in a
+two-level directory tree under ``cache_dir``. Server-side result ``id`` values
+are never part of a key, since they expire with the search session.
+
+Entries may carry HTTP validators (ETag, Last-Modified). Expired entries with
+validators are kept so the client can revalidate them with a conditional
+request instead of downloading the page again.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from collections import namedtuple
+
+__author__ = "Stephen Gaffney"
+__copyright__ = "Stephen Gaffney"
+__license__ = "gpl3"
+
+_logger = logging.getLogger(__name__)
+
+# Form fields that belong to a server-side paging session rather than the query
+SESSION_FIELDS = ('id', 'action Next.x', 'action Next.y')
+
+_HEADER = struct.Struct('<d')  # creation time (entries without metadata)
+_MAGIC = b'AXC1'
+_HEADER_META = struct.Struct('<4sdI')  # magic, creation time, metadata length
+_SUFFIX = '.z'
+
+CacheEntry = namedtuple('CacheEntry', ['content', 'meta', 'created', 'expired'])
+
+
+def default_cache_dir():
+    """User cache directory, honouring XDG_CACHE_HOME."""
+    root = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(root, 'alamos_extract')
+
+
+def request_key(url, data=None, page=None):
+    """Hash of method + url + canonicalised form data (+ page number).
+
+    Form values are compared as strings and session fields are dropped, so
+    equivalent searches share a key.
+    """
+    form = sorted((str(k), str(v)) for k, v in (data or {}).items() if k not in SESSION_FIELDS)
+    method = 'POST' if data else 'GET'
+    payload = json.dumps([method, url, form, page], separators=(',', ':'))
+    return hashlib.sha256(payload.encode('utf8')).hexdigest()
+
+
+class ResponseCache:
+    """Compressed response store with TTL expiry and LRU size cap.
+
+    Args:
+        cache_dir (str): directory for cache files, created if missing.
+        ttl (float): seconds after which an entry expires. None never expires.
+        max_bytes (int): evict least recently used entries beyond this total
+            compressed size. None for no limit.
+    """
+    def __init__(self, cache_dir=None, ttl=None, max_bytes=None):
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._size = None
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + _SUFFIX)
+
+    def get(self, key):
+        """Cached content for key, or None if missing or expired."""
+        entry = self.get_entry(key)
+        if entry is None or entry.expired:
+            return None
+        return entry.content
+
+    def get_entry(self, key):
+        """CacheEntry for key, or None if missing.
+
+        Expired entries are returned (with expired=True) only if they have
+        metadata to revalidate with; otherwise they are removed.
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                raw = f.read()
+        except FileNotFoundError:
+            return None
+        meta = {}
+        if raw[:len(_MAGIC)] == _MAGIC:
+            _, created, meta_len = _HEADER_META.unpack_from(raw)
+            start = _HEADER_META.size + meta_len
+            meta = json.loads(raw[_HEADER_META.size:start].decode('utf8'))
+        else:
+            (created,) = _HEADER.unpack_from(raw)
+            start = _HEADER.size
+        expired = self.ttl is not None and time.time() - created > self.ttl
+        if expired and not meta:
+            self._remove(path)
+            return None
+        try:
+            content = zlib.decompress(raw[start:])
+        except zlib.error:
+            _logger.warning("Discarding corrupt cache entry %s", path)
+            self._remove(path)
+            return None
+        if not expired:
+            try:
+                os.utime(path)  # mtime records last use, for LRU eviction
+            except FileNotFoundError:
+                pass
+        return CacheEntry(content, meta, created, expired)
+
+    def set(self, key, content, meta=None):
+        """Store content, with optional JSON-serialisable metadata such as HTTP validators."""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if meta:
+            meta_raw = json.dumps(meta, sort_keys=True).encode('utf8')
+            header = _HEADER_META.pack(_MAGIC, time.time(), len(meta_raw)) + meta_raw
+        else:
+            header = _HEADER.pack(time.time())
+        raw = header + zlib.compress(content)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(raw)
+        with self._lock:
+            old_size = os.path.getsize(path) if os.path.exists(path) else 0
+            os.replace(tmp_path, path)
+            if self._size is not None:
+                self._size += len(raw) - old_size
+        if self.max_bytes is not None:
+            self._evict()
+
+    def _entries(self):
+        for dirpath, _, filenames in os.walk(self.cache_dir):
+            for name in filenames:
+                if name.endswith(_SUFFIX):
+                    path = os.path.join(dirpath, name)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    yield path, stat.st_size, stat.st_mtime
+
+    @property
+    def size(self):
+        """Total compressed size of cache entries in bytes."""
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self._entries())
+            return self._size
+
+    def _evict(self):
+        if self.size <= self.max_bytes:
+            return
+        with self._lock:
+            entries = sorted(self._entries(), key=lambda e: e[2])
+            total = sum(size for _, size, _ in entries)
+            for path, size, _ in entries:
+                if total <= self.max_bytes:
+                    break
+                self._remove(path)
+                total -= size
+            self._size = total
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        else:
+            self._size = None
+
+    def clear(self):
+        for path, _, _ in list(self._entries()):
+            self._remove(path)
@@ -0,0 +1,299 @@
+"""Reusable HTTP client for the Los Alamos HIV Sequence Database.
+
+All page fetches in :mod:`alamos_extract.load_data` go through a
+:class:`HivClient`, which wraps a single :class:`requests.Session` so that
+connections to hiv.lanl.gov are pooled and kept alive between requests.
+"""
+
+import contextlib
+import logging
+import threading
+import time
+import warnings
+from urllib.parse import urljoin
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from alamos_extract import profiling
+from alamos_extract.cache import request_key
+from alamos_extract.ratelimit import OVERLOAD_STATUSES, parse_retry_after
+
+__author__ = "Stephen Gaffney"
+__copyright__ = "Stephen Gaffney"
+__license__ = "gpl3"
+
+_logger = logging.getLogger(__name__)
+
+BASE_URL = 'https://www.hiv.lanl.gov/components/sequence/HIV/search/'
+
+
+class HivClient:
+    """Pooled, keep-alive HTTP client for HIV Database pages.
+
+    Args:
+        base_url (str): prefix for the database's search components. Relative
+            paths such as ``'cluster.comp?clu_id=701'`` are resolved against it.
+        timeout (float or tuple): requests timeout, as (connect, read) seconds.
+        retries (int): retries for connection errors, timeouts, 429 and 5xx
+            responses, with exponential backoff (or the server's Retry-After).
+            A request gives up its limiter slot while it waits to retry.
+        backoff_factor (float): retry delay is backoff_factor * 2 ** attempt
+            seconds.
+        pool_maxsize (int): maximum number of connections kept per host. Extra
+            concurrent requests wait for a free connection.
+        verify (bool): verify TLS certificates.
+        cache (ResponseCache): optional on-disk response cache.
+        refresh (bool): ignore cached responses, but still store new ones.
+        limiter (RateLimiter): optional rate and adaptive concurrency limits
+            for requests (see alamos_extract.ratelimit).
+    """
+    def __init__(self, base_url=BASE_URL, timeout=(10, 120), retries=3,
+                 backoff_factor=0.5, pool_maxsize=10, verify=False, cache=None,
+                 refresh=False, limiter=None):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.verify = verify
+        self.cache = cache
+        self.refresh = refresh
+        self.limiter = limiter
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.n_requests = 0
+        self.n_cache_hits = 0
+        self.n_not_modified = 0
+        self.bytes_received = 0
+        self._stats_lock = threading.Lock()
+        # retried in request() and stream(), so no limiter slot is held while waiting
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize,
+                              max_retries=0, pool_block=True)
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({'Accept-Encoding': 'gzip, deflate',
+                                     'Connection': 'keep-alive'})
+
+    def url(self, path):
+        """Resolve a search component path against base_url."""
+        return urljoin(self.base_url, path)
+
+    def cache_key(self, url, data=None, page=None):
+        """Cache key for a request, or None if it can't be cached.
+
+        Requests carrying a server-side result id are only cacheable by page
+        number of the originating query (see _soup_pager).
+        """
+        if self.cache is None or (page is None and data and 'id' in data):
+            return None
+        return request_key(url, data, page)
+
+    def lookup(self, key):
+        """Cached content for key, or None."""
+        if key is None or self.refresh:
+            return None
+        content = self.cache.get(key)
+        if content is not None:
+            with self._stats_lock:
+                self.n_cache_hits += 1
+        return content
+
+    def fetch(self, url, data=None, cache_key=None, revalidate=True, accept=None):
+        """Get raw page content, using POST request if data supplied.
+
+        Expired or refreshed cache entries that carry an ETag or Last-Modified
+        validator are revalidated with a conditional request, and reused
+        without download if the server answers 304 Not Modified.
+
+        Args:
+            cache_key (str): cache key to use instead of one derived from url
+                and data, e.g. for pages of a paged result table.
+            revalidate (bool): send a conditional request for an expired or
+                refreshed entry. Pass False for pages that carry a server-side
+                result id, which must come from a live response.
+            accept (callable): if given, only content for which accept(content)
+                is true is read from or stored in the cache.
+
+        Returns:
+            content (bytes): decompressed response body.
+        """
+        if cache_key is None:
+            cache_key = self.cache_key(url, data)
+        entry = None
+        if cache_key is not None:
+            entry = self.cache.get_entry(cache_key)
+            if entry is not None and accept is not None and not accept(entry.content):
+                entry = None
+            if entry is not None and not entry.expired and not self.refresh:
+                with self._stats_lock:
+                    self.n_cache_hits += 1
+                profiling.instant('cache hit', 'cache', url=url)
+                return entry.content
+        if not revalidate:
+            entry = None
+        response = self.request(url, data, headers=_conditional_headers(entry))
+        if response.status_code == 304 and entry is not None:
+            _logger.debug("Not modified: %s", url)
+            with self._stats_lock:
+                self.n_not_modified += 1
+            content, meta = entry.content, entry.meta
+        else:
+            content, meta = response.content, _validators(response.headers)
+        if cache_key is not None and (accept is None or accept(content)):
+            self.cache.set(cache_key, content, meta)
+        return content
+
+    def fetch_live(self, url, data=None):
+        """Get raw page content from the server, bypassing the cache."""
+        return self.request(url, data).content
+
+    def request(self, url, data=None, headers=None):
+        """Send GET (or POST if data supplied) and return the requests.Response.
+
+        Raises:
+            requests.HTTPError: for 4xx and 5xx responses.
+        """
+        attempt = 0
+        while True:
+            slot = self.limiter.slot(url) if self.limiter is not None else contextlib.nullcontext()
+            try:
+                with profiling.span('http', 'network', method='POST' if data else 'GET', url=url) as span, slot:
+                    response = self._send(url, data, headers)
+                    span.set(status=response.status_code, bytes=len(response.content))
+                    if self.limiter is not None:
+                        slot.done(response.status_code, response.headers.get('Retry-After'))
+            except (requests.ConnectionError, requests.Timeout):
+                delay = self._retry_delay(attempt)
+                if delay is None:
+                    raise
+            else:
+                delay = self._retry_delay(attempt, response)
+                if delay is None:
+                    break
+            _logger.debug("Retrying %s in %.2f s", url, delay)
+            time.sleep(delay)
+            attempt += 1
+        response.raise_for_status()
+        with self._stats_lock:
+            self.n_requests += 1
+            self.bytes_received += len(response.content)
+        return response
+
+    def stream(self, url, data=None, chunk_size=64 * 1024):
+        """Iterate over chunks of the response body, bypassing the cache.
+
+        Used for large result pages that should not be held in memory whole.
+        The limiter slot is held until the body has been read. Requests are
+        retried as in request() until the body starts.
+
+        Raises:
+            requests.HTTPError: for 4xx and 5xx responses.
+        """
+        attempt = 0
+        while True:
+            slot = self.limiter.slot(url) if self.limiter is not None else contextlib.nullcontext()
+            started = False
+            try:
+                with profiling.span('http', 'network', method='POST' if data else 'GET', url=url,
+                                    stream=True) as span, slot:
+                    response = self._send(url, data, stream=True)
+                    with response:
+                        span.set(status=response.status_code)
+                        if self.limiter is not None:
+                            slot.done(response.status_code, response.headers.get('Retry-After'))
+                        delay = self._retry_delay(attempt, response)
+                        if delay is None and response.ok:
+                            started = True
+                            with self._stats_lock:
+                                self.n_requests += 1
+                            n_bytes = 0
+                            for chunk in response.iter_content(chunk_size=chunk_size):
+                                n_bytes += len(chunk)
+                                with self._stats_lock:
+                                    self.bytes_received += len(chunk)
+                                yield chunk
+                            span.set(bytes=n_bytes)
+            except (requests.ConnectionError, requests.Timeout):
+                delay = None if started else self._retry_delay(attempt)
+                if delay is None:
+                    raise
+            if delay is None:
+                break
+            _logger.debug("Retrying %s in %.2f s", url, delay)
+            time.sleep(delay)
+            attempt += 1
+        response.raise_for_status()
+
+    def _send(self, url, data=None, headers=None, stream=False):
+        # @TODO: find a way to get around "certificate verify failed" error without verify=False
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            if data:
+                return self.session.post(url, data=data, headers=headers, verify=self.verify,
+                                         timeout=self.timeout, stream=stream)
+            return self.session.get(url, headers=headers, verify=self.verify, timeout=self.timeout,
+                                    stream=stream)
+
+    def _retry_delay(self, attempt, response=None):
+        """Seconds to wait before retrying, or None if the attempt is final.
+
+        Args:
+            attempt (int): attempts made before this one.
+            response (requests.Response): the response, or None after a
+                connection error or timeout.
+        """
+        if attempt >= self.retries or (response is not None and response.status_code not in OVERLOAD_STATUSES):
+            return None
+        delay = self.backoff_factor * 2 ** attempt
+        if response is not None:
+            delay = max(delay, parse_retry_after(response.headers.get('Retry-After')) or 0)
+        return delay
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _conditional_headers(entry):
+    """If-None-Match/If-Modified-Since headers from a cache entry's validators."""
+    headers = {}
+    if entry is not None:
+        if 'etag' in entry.meta:
+            headers['If-None-Match'] = entry.meta['etag']
+        if 'last_modified' in entry.meta:
+            headers['If-Modified-Since'] = entry.meta['last_modified']
+    return headers or None
+
+
+def _validators(response_headers):
+    """Cache metadata from a response's ETag/Last-Modified headers."""
+    meta = {}
+    if 'ETag' in response_headers:
+        meta['etag'] = response_headers['ETag']
+    if 'Last-Modified' in response_headers:
+        meta['last_modified'] = response_headers['Last-Modified']
+    return meta or None
+
+
+_default_client = None
+_default_lock = threading.Lock()
+
+
+def get_default_client():
+    """Get the process-wide client used when no client is passed explicitly."""
+    global _default_client
+    with _default_lock:
+        if _default_client is None:
+            _default_client = HivClient()
+        return _default_client
+
+
+def set_default_client(client):
+    """Replace the process-wide client, e.g. to change base_url or timeouts."""
+    global _default_client
+    with _default_lock:
+        _default_client = client
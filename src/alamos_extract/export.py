@@ -0,0 +1,161 @@
+"""Write extracted tables as TSV or typed columnar files.
+
+Columnar formats (Parquet, Feather and the Arrow IPC file format) are written
+with an explicit schema: integer ids, positions, lengths and day offsets, and
+dictionary-encoded categorical text columns, so readers get typed columns
+without re-parsing text. Accession tables from batch runs can also be written
+as a hive-partitioned dataset (e.g. ``subtype=B/country=US/...``).
+
+Columnar output requires the optional ``pyarrow`` dependency
+(``pip install alamos-extract[columnar]``). pandas and pyarrow are imported
+when a table is first written, so the format constants can be imported
+cheaply (e.g. by the command line parser).
+"""
+
+import logging
+
+__author__ = "Stephen Gaffney"
+__copyright__ = "Stephen Gaffney"
+__license__ = "gpl3"
+
+_logger = logging.getLogger(__name__)
+
+FORMATS = ('tsv', 'parquet', 'feather', 'arrow')
+EXTENSIONS = {'tsv': '.tsv', 'parquet': '.parquet', 'feather': '.feather', 'arrow': '.arrow'}
+DEFAULT_PARTITION_COLS = ('subtype', 'country')
+
+# Columns written as 64-bit integers: ids, positions, lengths and day offsets
+INT_COLUMNS = (
+    'row_id', 'patient_id', 'blast_ssam_se_id', 'pos_start', 'pos_stop', 'seq_length',
+    'sampling_year', 'days_from_first_sample', 'days_from_treatment_end',
+    'days_from_treatment_start', 'days_from_infection', 'days_from_seroconversion',
+)
+# Low-cardinality text columns written dictionary encoded
+DICTIONARY_COLUMNS = ('subtype', 'country', 'genomic_region', 'organism', 'fiebig_stage')
+
+
+def _require_pyarrow(fmt):
+    """Import and return pyarrow, with its dataset, feather and parquet modules loaded."""
+    try:
+        import pyarrow
+        import pyarrow.dataset  # noqa: F401
+        import pyarrow.feather  # noqa: F401
+        import pyarrow.parquet  # noqa: F401
+    except ImportError:  # pragma: no cover
+        raise ImportError("{} output requires pyarrow: pip install alamos-extract[columnar]".format(fmt))
+    return pyarrow
+
+
+def output_path(stem, fmt='tsv'):
+    """File path for an output table stem in format fmt."""
+    return stem + EXTENSIONS[fmt]
+
+
+def arrow_schema(df):
+    """Explicit Arrow schema for the columns of an extracted table.
+
+    Columns in INT_COLUMNS are int64, DICTIONARY_COLUMNS are dictionary
+    encoded strings and all others are strings.
+    """
+    pa = _require_pyarrow('Columnar')
+    fields = []
+    for col in df.columns:
+        if col in INT_COLUMNS:
+            type_ = pa.int64()
+        elif col in DICTIONARY_COLUMNS:
+            type_ = pa.dictionary(pa.int32(), pa.string())
+        else:
+            type_ = pa.string()
+        fields.append(pa.field(str(col), type_))
+    return pa.schema(fields)
+
+
+def to_arrow_table(df, index=False):
+    """Convert an extracted table to a pyarrow Table with arrow_schema types.
+
+    Integer columns are parsed from text; values that are not integers are
+    written as null, with a warning.
+    """
+    import pandas as pd
+    pa = _require_pyarrow('Columnar')
+    if index:
+        df = df.reset_index()
+    df = df.rename(columns=str)
+    schema = arrow_schema(df)
+    arrays = []
+    for field in schema:
+        values = df[field.name]
+        if field.name in INT_COLUMNS:
+            ints = pd.to_numeric(values, errors='coerce')
+            n_bad = int((ints.isna() & values.notna()).sum())
+            if n_bad:
+                _logger.warning("%d non-integer values in column %s written as null", n_bad, field.name)
+            arrays.append(pa.array(ints.astype('Int64'), type=pa.int64()))
+            continue
+        array = pa.array(_text_values(values), type=pa.string())
+        if pa.types.is_dictionary(field.type):
+            array = array.dictionary_encode()
+        arrays.append(array)
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def _text_values(values):
+    import pandas as pd
+    return [None if pd.isna(v) else str(v) for v in values]
+
+
+def write_table(df, stem, fmt='tsv', index=False):
+    """Write df to stem + format extension.
+
+    Args:
+        df (pd.DataFrame): table to write.
+        stem (str): output path without extension.
+        fmt (str): one of FORMATS. 'feather' is compressed Feather v2,
+            'arrow' an uncompressed Arrow IPC file suited to memory mapping.
+        index (bool): include the DataFrame index.
+
+    Returns:
+        path (str): path written.
+    """
+    path = output_path(stem, fmt)
+    if fmt == 'tsv':
+        df.to_csv(path, sep='\t', index=index)
+        return path
+    table = to_arrow_table(df, index=index)
+    pa = _require_pyarrow(fmt)
+    if fmt == 'parquet':
+        pa.parquet.write_table(table, path)
+    elif fmt == 'feather':
+        pa.feather.write_feather(table, path)
+    elif fmt == 'arrow':
+        pa.feather.write_feather(table, path, compression='uncompressed')
+    else:
+        raise ValueError("Unknown output format: {}".format(fmt))
+    return path
+
+
+def write_partitioned(df, root, name, fmt='parquet', partition_cols=DEFAULT_PARTITION_COLS):
+    """Add df to a hive-partitioned dataset under root.
+
+    Each call writes its own files, named after name, so tables from many
+    clusters accumulate in one dataset. Null partition values go to hive's
+    default partition directory.
+
+    Returns:
+        root (str): dataset directory.
+    """
+    if fmt == 'tsv':
+        raise ValueError("Partitioned output needs a columnar format, not tsv")
+    pa = _require_pyarrow(fmt)
+    table = to_arrow_table(df)
+    # partition values become directory names, so they must be plain strings
+    for col in partition_cols:
+        i = table.schema.get_field_index(col)
+        table = table.set_column(i, col, table.column(col).cast(pa.string()))
+    partitioning = pa.dataset.partitioning(
+        pa.schema([(col, pa.string()) for col in partition_cols]), flavor='hive')
+    pa.dataset.write_dataset(
+        table, root, format='parquet' if fmt == 'parquet' else 'ipc', partitioning=partitioning,
+        basename_template=name + '-{i}' + EXTENSIONS[fmt],
+        existing_data_behavior='overwrite_or_ignore')
+    return root
@@ -0,0 +1,312 @@
+"""Concurrent sequence searches over grids of virus, subtype and region choices.
+
+:func:`search_grid` runs one search.comp query per combination of the given
+choices (names from :mod:`alamos_extract.form_dicts`), several at a time.
+Each query follows its own chain of result pages, so the server-side paging
+sessions of different queries never mix. The pages are parsed into typed
+tables, labelled with the query that found them, and merged; a sequence
+found by several queries (e.g. subtypes 'A' and 'A1') is kept once.
+
+:func:`search_partitioned` uses the same machinery to speed up one large
+search. Its result pages can only be fetched one after another, since each
+Next request needs the previous page's result id. The search is therefore
+split into disjoint sub-queries by subtype, which page concurrently. It
+only partitions when max_rec covers every match the site reports, so the
+merged rows are the rows the search itself would page through.
+"""
+
+import fnmatch
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import pandas as pd
+
+from alamos_extract import profiling
+from alamos_extract.client import get_default_client
+from alamos_extract.form_dicts import region_dict, subtype_dict, virus_dict
+from alamos_extract.load_data import (_concat_results, _content_pager, _get_df_from_content, _has_result_rows,
+                                      _next_page_data_from_content, _reported_total, _search_form)
+
+__author__ = "Stephen Gaffney"
+__copyright__ = "Stephen Gaffney"
+__license__ = "gpl3"
+
+_logger = logging.getLogger(__name__)
+
+PROVENANCE_COLS = ('query_virus', 'query_subtype', 'query_region', 'n_queries')
+DEDUP_COLS = ('accession', 'blast_ssam_se_id')
+PARTITION_BY = ('subtype',)
+
+
+def grid_queries(viruses=('HIV-1',), subtypes=('any',), regions=('any',)):
+    """All (virus, subtype, region) combinations of the given choice names, in order.
+
+    Raises:
+        ValueError: a name is not a key of virus_dict, subtype_dict or region_dict.
+    """
+    for field, choices, names in (('virus', viruses, virus_dict), ('subtype', subtypes, subtype_dict),
+                                  ('region', regions, region_dict)):
+        unknown = [c for c in choices if c not in names]
+        if unknown:
+            raise ValueError("Unknown {} choice(s): {}".format(field, ', '.join(map(repr, unknown))))
+    return list(itertools.product(*(list(dict.fromkeys(c)) for c in (viruses, subtypes, regions))))
+
+
+class GridProgress:
+    """Running totals of a grid search, updated from the worker threads.
+
+    Attributes:
+        n_queries (int): queries in the grid.
+        done (int): queries finished, including failed ones.
+        failed (dict): (virus, subtype, region) -> repr of the error.
+        pages, rows, bytes (int): result pages, rows and bytes received.
+    """
+    def __init__(self, n_queries):
+        self.n_queries = n_queries
+        self.done = 0
+        self.failed = {}
+        self.pages = 0
+        self.rows = 0
+        self.bytes = 0
+        self._t0 = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def add_page(self, n_rows, n_bytes):
+        with self._lock:
+            self.pages += 1
+            self.rows += n_rows
+            self.bytes += n_bytes
+
+    def finish(self, query, error=None):
+        with self._lock:
+            self.done += 1
+            if error is not None:
+                self.failed[query] = repr(error)
+
+    def stats(self):
+        """Totals plus elapsed seconds and pages and rows per second, as a dict."""
+        with self._lock:
+            seconds = time.perf_counter() - self._t0
+            return {'queries': self.n_queries, 'done': self.done, 'failed': len(self.failed),
+                    'pages': self.pages, 'rows': self.rows, 'bytes': self.bytes, 'seconds': seconds,
+                    'pages_per_second': self.pages / seconds if seconds else 0.0,
+                    'rows_per_second': self.rows / seconds if seconds else 0.0}
+
+    def format(self):
+        return '{done}/{queries} queries, {failed} failed, {pages} pages, {rows} rows, ' \
+               '{rows_per_second:.0f} rows/s, {pages_per_second:.1f} pages/s'.format(**self.stats())
+
+
+def search_grid(viruses=('HIV-1',), subtypes=('any',), regions=('any',), max_rec=100, client=None,
+                max_workers=4, progress=None):
+    """Search every combination of virus, subtype and region choices concurrently.
+
+    Args:
+        viruses, subtypes, regions (list): choice names, keys of virus_dict,
+            subtype_dict and region_dict.
+        max_rec (int): maximum records per query.
+        client (HivClient): HTTP client to use. Defaults to the shared client.
+        max_workers (int): number of queries run concurrently.
+        progress (callable): called with the GridProgress after each page
+            and each finished query, e.g. to display throughput.
+
+    Returns:
+        df (pandas.DataFrame): search_db's columns for the rows of all
+            queries, each sequence once, plus query_virus, query_subtype and
+            query_region (categoricals) of the first query in grid order that
+            found it and n_queries, the number of queries that found it.
+
+    Raises:
+        RuntimeError: a query failed. The remaining queries still run, and
+            their pages stay in the client's response cache for a rerun.
+    """
+    client = client or get_default_client()
+    queries = grid_queries(viruses, subtypes, regions)
+    tracker = GridProgress(len(queries))
+    labels = [pd.CategoricalDtype(list(dict.fromkeys(c))) for c in (viruses, subtypes, regions)]
+    url = client.url('search.comp')
+
+    def run(query):
+        virus, subtype, region = query
+        with profiling.span('grid query', 'search', query='/'.join(query)):
+            form, main_cols = _search_form(max_rec, virus_dict[virus], subtype_dict[subtype],
+                                           region_dict[region], None)
+            frames, _ = _search_pages(client, url, form, main_cols, max_rec, tracker, progress)
+        if not frames:
+            return None
+        df = _concat_results(frames).iloc[:max_rec].copy()
+        for col, value, dtype in zip(PROVENANCE_COLS, query, labels):
+            df[col] = pd.Categorical([value] * len(df), dtype=dtype)
+        return df
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {pool.submit(run, q): q for q in queries}
+        for future in as_completed(futures):
+            query = futures[future]
+            try:
+                results[query] = future.result()
+            except Exception as e:
+                _logger.error("Search %s failed: %r", '/'.join(query), e)
+                tracker.finish(query, e)
+            else:
+                tracker.finish(query)
+                _logger.info("Search %s done: %d rows [%d/%d]", '/'.join(query),
+                             0 if results[query] is None else len(results[query]), tracker.done, len(queries))
+            if progress is not None:
+                progress(tracker)
+    if tracker.failed:
+        raise RuntimeError("{} of {} grid searches failed: {}".format(
+            len(tracker.failed), len(queries),
+            '; '.join('{}: {}'.format('/'.join(q), e) for q, e in tracker.failed.items())))
+    return _merge([results[q] for q in queries if results[q] is not None])
+
+
+def _merge(frames):
+    """Concatenate query results in grid order, keeping each sequence's first row."""
+    if not frames:
+        return pd.DataFrame(columns=list(PROVENANCE_COLS))
+    df = _concat_results(frames)
+    key = list(DEDUP_COLS)
+    df['n_queries'] = df.groupby(key, sort=False)[key[0]].transform('size').astype('int64')
+    return df.drop_duplicates(subset=key, keep='first').reset_index(drop=True)
+
+
+def plan_partitions(subtype='', region='', by='subtype'):
+    """Split a search into disjoint sub-queries that page independently.
+
+    Args:
+        subtype, region (str): form values of the search (subtype_dict and
+            region_dict values, '' or None for any).
+        by (str): 'subtype' splits a search of any subtype into the subtype
+            groups of subtype_dict that no other choice covers (A but not
+            A1, CRFs, ...). Regions overlap, so they cannot partition a
+            search.
+
+    Returns:
+        parts (list): (subtype, region) form values of each sub-query.
+
+    Raises:
+        ValueError: unknown by, or the search is already restricted on it.
+    """
+    if by not in PARTITION_BY:
+        raise ValueError("Cannot partition by {!r}, choose from {}".format(by, ', '.join(PARTITION_BY)))
+    if subtype:
+        raise ValueError("Partitioning by subtype needs a search of any subtype, got {!r}".format(subtype))
+    return [(value, region) for value in _top_level_subtypes()]
+
+
+def _top_level_subtypes():
+    """subtype_dict values whose patterns no other choice covers, e.g. 'A* or ...' but not 'A1*'."""
+    patterns = {value: value.split(' or ') for value in subtype_dict.values() if value}
+    return [value for value, own in patterns.items()
+            if not any(fnmatch.fnmatchcase(own[0], p) for other, ps in patterns.items() if other != value
+                       for p in ps)]
+
+
+def search_partitioned(max_rec=100, virus='HIV-1', subtype='', region='', cluster_name=None, by='subtype',
+                       client=None, max_workers=4, progress=None):
+    """Run one search as concurrent sub-queries and merge them, as search_db would return it.
+
+    The first page of the whole search is fetched first, for the number of
+    matches it reports. If the matches fit on that page, or there are more
+    than max_rec of them, the search is paged serially from there: the site
+    lists the first max_rec matches in its own order, which sub-queries can't
+    reproduce. Otherwise each sub-query from plan_partitions follows its own
+    result pages, and the merged rows are kept in sub-query order.
+
+    If fewer rows than reported were found, e.g. for sequences of a subtype
+    outside subtype_dict, the search is paged serially instead, with a
+    warning. If the page reports no count, the merged rows are returned
+    unchecked, also with a warning.
+
+    Args:
+        virus, subtype, region, cluster_name: search fields, as for search_db.
+        by (str): 'subtype'. See plan_partitions.
+        max_workers (int): number of sub-queries paging concurrently.
+        progress (callable): called with a GridProgress after each page and
+            each finished sub-query.
+
+    Returns:
+        df (pandas.DataFrame): search_db's columns.
+    """
+    client = client or get_default_client()
+    url = client.url('search.comp')
+    parts = plan_partitions(subtype, region, by)
+    tracker = GridProgress(len(parts))
+    form, main_cols = _search_form(max_rec, virus, subtype, region, cluster_name)
+
+    pages = _content_pager(url, data=form, client=client, prefetch=False)
+    try:
+        first = next(pages)
+        total = _reported_total(first)
+        if _next_page_data_from_content(first, form) is None or (total is not None and total > max_rec):
+            _logger.info("Search reports %s matches for max_rec=%d; paging it serially", total, max_rec)
+            frames, _ = _parse_pages(itertools.chain([first], pages), main_cols, max_rec)
+            return _concat_results(frames) if frames else pd.DataFrame()
+    finally:
+        pages.close()
+
+    def run(part):
+        with profiling.span('partition', 'search', query='/'.join(part)):
+            part_form, _ = _search_form(max_rec, virus, *part, cluster_name)
+            try:
+                frames, _ = _search_pages(client, url, part_form, main_cols, max_rec, tracker, progress)
+            except Exception as e:
+                tracker.finish(part, e)
+                raise
+        tracker.finish(part)
+        if progress is not None:
+            progress(tracker)
+        return frames
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        frames = [df for frames in pool.map(run, parts) for df in frames]
+    df = _concat_results(frames).drop_duplicates(subset=list(DEDUP_COLS)).reset_index(drop=True) \
+        if frames else pd.DataFrame()
+    if total is None:
+        _logger.warning("Search page reports no match count; returning %d partitioned rows unchecked", len(df))
+    elif len(df) < total:
+        _logger.warning("Partitions by %s found %d of %d rows; paging the search serially", by, len(df), total)
+        frames, _ = _search_pages(client, url, form, main_cols, max_rec)
+        return _concat_results(frames) if frames else pd.DataFrame()
+    return df
+
+
+def _search_pages(client, url, form, main_cols, max_rec, tracker=None, progress=None):
+    """Parse one search's result pages, following its paging session until max_rec rows.
+
+    Returns:
+        frames (list): DataFrame of each page with result rows.
+        total (int): match count reported by the first page, or None.
+    """
+    pages = _content_pager(url, data=form, client=client)
+    try:
+        return _parse_pages(pages, main_cols, max_rec, tracker, progress)
+    finally:
+        pages.close()
+
+
+def _parse_pages(pages, main_cols, max_rec, tracker=None, progress=None):
+    """Parse result pages from an iterator of page contents until max_rec rows. Returns as _search_pages."""
+    frames = []
+    n_rows = 0
+    total = None
+    for ind, content in enumerate(pages):
+        if ind == 0:
+            total = _reported_total(content)
+        df = _get_df_from_content(content, list(main_cols)) if _has_result_rows(content) else None
+        page_rows = 0 if df is None else len(df)
+        if tracker is not None:
+            tracker.add_page(page_rows, len(content))
+        if progress is not None:
+            progress(tracker)
+        if df is not None:
+            frames.append(df)
+            n_rows += page_rows
+        if n_rows >= max_rec:
+            break
+    return frames, total
@@ -0,0 +1,196 @@
+"""Batch download of many clusters with a resumable checkpoint journal.
+
+Each finished cluster is written out immediately and recorded in a JSON-lines
+journal, so a killed run can be restarted with the same arguments and will
+skip clusters that already completed.
+"""
+
+import json
+import logging
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import islice
+
+from alamos_extract.export import output_path, write_partitioned, write_table
+from alamos_extract.registry import get_patient_registry
+
+__author__ = "Stephen Gaffney"
+__copyright__ = "Stephen Gaffney"
+__license__ = "gpl3"
+
+_logger = logging.getLogger(__name__)
+
+
+def parse_id_ranges(spec):
+    """Parse a cluster id specification such as '1-900,1200' into a sorted id list."""
+    ids = set()
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            start, stop = part.split('-', 1)
+            start, stop = int(start), int(stop)
+            if stop < start:
+                raise ValueError("Invalid cluster id range: {}".format(part))
+            ids.update(range(start, stop + 1))
+        else:
+            ids.add(int(part))
+    return sorted(ids)
+
+
+def cluster_paths(cluster_id, out_dir='.', fmt='tsv'):
+    """Output paths for a cluster's accession and clinical tables."""
+    path_accession = output_path(os.path.join(out_dir, 'cluster_{}_accessions'.format(cluster_id)), fmt)
+    path_clinical = output_path(os.path.join(out_dir, 'cluster_{}_clinical'.format(cluster_id)), fmt)
+    return path_accession, path_clinical
+
+
+def write_cluster(cluster, out_dir='.', fmt='tsv', partition_cols=None, timepoints=True):
+    """Write cluster accession and clinical tables.
+
+    Args:
+        fmt (str): output format, one of export.FORMATS.
+        partition_cols (tuple): if given, add accessions to the hive-partitioned
+            dataset <out_dir>/accessions instead of a per-cluster file.
+        timepoints (bool): write the accessions with timepoint information
+            (cluster.acc_df). If False, write the patient pages' accession
+            listing (cluster.accession_list_df) and skip the paged timepoint
+            tables; partition_cols is then not supported.
+
+    Returns:
+        paths (tuple): accession table (or dataset) and clinical table paths.
+    """
+    stem_accession = os.path.join(out_dir, 'cluster_{}_accessions'.format(cluster.cluster_id))
+    stem_clinical = os.path.join(out_dir, 'cluster_{}_clinical'.format(cluster.cluster_id))
+    acc_df = cluster.acc_df if timepoints else cluster.accession_list_df
+    if partition_cols:
+        if not timepoints:
+            raise ValueError("Partitioned output needs the timepoint tables")
+        path_accession = write_partitioned(acc_df, os.path.join(out_dir, 'accessions'),
+                                           'cluster_{}'.format(cluster.cluster_id), fmt, partition_cols)
+    else:
+        path_accession = write_table(acc_df, stem_accession, fmt, index=False)
+    path_clinical = write_table(cluster.desc_df, stem_clinical, fmt, index=True)
+    return path_accession, path_clinical
+
+
+def _n_accessions(cluster, timepoints=True):
+    return len(cluster.acc_df if timepoints else cluster.accession_list_df)
+
+
+class Journal:
+    """Append-only JSON-lines record of processed clusters."""
+    def __init__(self, path):
+        self.path = path
+        self.completed = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # partial line from an interrupted write
+                    if entry.get('status') == 'ok':
+                        self.completed.add(entry['cluster_id'])
+
+    def record(self, cluster_id, status, **info):
+        entry = dict(cluster_id=cluster_id, status=status, **info)
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        if status == 'ok':
+            self.completed.add(cluster_id)
+
+
+def harvest_clusters(cluster_ids, out_dir='.', client=None, max_workers=4, journal_path=None,
+                     fmt='tsv', partition_cols=None, timepoints=True, engine='html'):
+    """Build and write many clusters concurrently, skipping journaled ones.
+
+    Args:
+        cluster_ids (list): cluster IDs to download.
+        out_dir (str): directory for per-cluster output files.
+        client (HivClient): HTTP client to use. Defaults to the shared client.
+        max_workers (int): number of clusters built concurrently. At most
+            2 * max_workers clusters are submitted but not yet written.
+        journal_path (str): checkpoint journal, default
+            <out_dir>/clusters_journal.jsonl.
+        fmt (str): output format, one of export.FORMATS.
+        partition_cols (tuple): write accessions as a hive-partitioned dataset
+            by these columns. See write_cluster.
+        timepoints (bool): fetch and write the paged timepoint tables. See
+            write_cluster.
+        engine (str): 'html' or 'download', how timepoint tables are fetched.
+
+    Returns:
+        summary (dict): counts of completed, failed and skipped clusters,
+            elapsed seconds, clusters per second, pages fetched, cache hits,
+            and patient tables (pages and timepoint tables) downloaded and
+            reused from the patient registry.
+    """
+    # deferred so parse_id_ranges can be imported without pandas and requests
+    from alamos_extract.client import get_default_client
+    from alamos_extract.load_data import Cluster
+
+    client = client or get_default_client()
+    registry = get_patient_registry()
+    os.makedirs(out_dir, exist_ok=True)
+    journal = Journal(journal_path or os.path.join(out_dir, 'clusters_journal.jsonl'))
+    todo = [i for i in cluster_ids if i not in journal.completed]
+    n_skipped = len(cluster_ids) - len(todo)
+    if n_skipped:
+        _logger.info("Skipping %d clusters already in journal %s", n_skipped, journal.path)
+    requests_before = client.n_requests
+    hits_before = client.n_cache_hits
+    registry_before = registry.stats()
+    failures = {}
+    n_ok = 0
+    t0 = time.perf_counter()
+
+    def build(cluster_id):
+        start = time.perf_counter()
+        cluster = Cluster(cluster_id, client=client, engine=engine).load(timepoints=timepoints)
+        return cluster, time.perf_counter() - start
+
+    # a bounded window of submissions, so finished clusters can be freed once written
+    remaining = iter(todo)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {pool.submit(build, i): i for i in islice(remaining, 2 * max_workers)}
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                cluster_id = futures.pop(future)
+                for next_id in islice(remaining, 1):
+                    futures[pool.submit(build, next_id)] = next_id
+                try:
+                    cluster, seconds = future.result()
+                    write_cluster(cluster, out_dir, fmt, partition_cols, timepoints)
+                except Exception as e:
+                    _logger.error("Cluster %d failed: %r", cluster_id, e)
+                    failures[cluster_id] = repr(e)
+                    journal.record(cluster_id, 'failed', error=repr(e))
+                    continue
+                n_ok += 1
+                journal.record(cluster_id, 'ok', cluster_name=cluster.cluster_name,
+                               n_patients=len(cluster.patient_dict),
+                               n_accessions=_n_accessions(cluster, timepoints), seconds=round(seconds, 3))
+                _logger.info("Cluster %d (%s) done [%d/%d]", cluster_id, cluster.cluster_name,
+                             n_ok + len(failures), len(todo))
+            done = future = cluster = None  # nothing keeps a written cluster alive
+
+    elapsed = time.perf_counter() - t0
+    registry_after = registry.stats()
+    return {
+        'completed': n_ok,
+        'failed': failures,
+        'skipped': n_skipped,
+        'seconds': elapsed,
+        'clusters_per_second': n_ok / elapsed if elapsed else 0.0,
+        'pages_fetched': client.n_requests - requests_before,
+        'cache_hits': client.n_cache_hits - hits_before,
+        'patient_tables_fetched': registry_after['misses'] - registry_before['misses'],
+        'patient_tables_reused': (registry_after['hits'] + registry_after['coalesced']
+                                  - registry_before['hits'] - registry_before['coalesced']),
+    }
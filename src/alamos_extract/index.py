@@ -0,0 +1,296 @@
+"""Memory-mapped inverted index of accessions, patients and clusters (load_hiv lookup).
+
+:func:`build_index` reads everything synced into a warehouse (see
+:mod:`alamos_extract.warehouse`). That covers cluster pages, patient pages,
+timepoint tables and search results. From it, the function writes one file
+answering which sequence, patient and clusters a key belongs to. Keys are
+accessions, se_ids, patient ids, patient codes, cluster ids and cluster
+names.
+
+The file is an open-addressing hash table over JSON records:
+
+    header    magic, number of slots, number of keys, offset of the slots
+    records   key bytes and JSON value bytes, back to back
+    slots     (key hash, key offset, key length, value offset, value length)
+
+:class:`AccessionIndex` maps it read-only and answers a lookup by hashing the
+key and probing the slots in place. The work per lookup does not depend on
+the size of the index. Only the pages touched are read from disk, so opening
+an index and answering one lookup is fast even for large harvests. This
+module uses the standard library only, so ``load_hiv lookup`` starts without
+pandas or network code.
+"""
+
+import hashlib
+import json
+import logging
+import mmap
+import os
+import re
+import sqlite3
+import struct
+import tempfile
+from collections import defaultdict
+
+__author__ = "Stephen Gaffney"
+__copyright__ = "Stephen Gaffney"
+__license__ = "gpl3"
+
+_logger = logging.getLogger(__name__)
+
+KINDS = ('accession', 'se_id', 'patient_id', 'patient_code', 'cluster_id', 'cluster_name')
+INT_KINDS = ('se_id', 'patient_id', 'cluster_id')
+DEFAULT_DB = 'alamos_extract.sqlite'  # warehouse.DEFAULT_PATH, without importing pandas
+INDEX_SUFFIX = '.index'
+
+_MAGIC = b'ALXIDX01'
+_HEADER = struct.Struct('<8sQQQ')  # magic, n_slots, n_keys, slots offset
+_SLOT = struct.Struct('<QQIQI')  # key hash (0: empty), key offset, key length, value offset, value length
+_RE_CLUSTER_COMB = re.compile(r'([^,()]+?)\s*\((\d+)\)')
+
+
+def index_path(db_path):
+    """Default index file for a warehouse file."""
+    return db_path + INDEX_SUFFIX
+
+
+def _hash(key):
+    # nonzero, so a zero hash marks an empty slot
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little') | 1
+
+
+def _key(kind, value):
+    return '{}\0{}'.format(kind, value).encode('utf8')
+
+
+class AccessionIndex:
+    """Read-only, memory-mapped index written by build_index.
+
+    Args:
+        path (str): index file.
+
+    Raises:
+        ValueError: path is not an index file.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.n_slots, self.n_keys, self._slots_at = _HEADER.unpack_from(self._map, 0)
+        if magic != _MAGIC:
+            self._map.close()
+            raise ValueError("{} is not an alamos_extract index".format(path))
+
+    def get(self, kind, value):
+        """Record for one key, or None.
+
+        Args:
+            kind (str): one of KINDS.
+            value: the key, e.g. 'AB149000' for an accession or 149000 for a se_id.
+
+        Returns:
+            record: dict for accessions and se_ids (accession, se_id,
+            patient_id, patient_code, clusters), patient ids (patient_id,
+            patient_code, clusters, accessions), and cluster ids and names
+            (cluster_id, cluster_name, patients, n_accessions). For patient
+            codes, a list of patient records, since codes are only unique
+            within a cluster.
+        """
+        if kind not in KINDS:
+            raise ValueError("Unknown key kind {!r}, choose from {}".format(kind, ', '.join(KINDS)))
+        key = _key(kind, value)
+        h = _hash(key)
+        i = h % self.n_slots
+        while True:
+            slot_hash, key_at, key_len, value_at, value_len = _SLOT.unpack_from(
+                self._map, self._slots_at + i * _SLOT.size)
+            if slot_hash == 0:
+                return None
+            if slot_hash == h and self._map[key_at:key_at + key_len] == key:
+                return json.loads(self._map[value_at:value_at + value_len])
+            i = (i + 1) % self.n_slots
+
+    def find(self, term):
+        """All (kind, record) matches of a search term, trying every kind it could be."""
+        kinds = KINDS if str(term).isdigit() else [k for k in KINDS if k not in INT_KINDS]
+        hits = []
+        for kind in kinds:
+            record = self.get(kind, term)
+            if record is not None:
+                hits.append((kind, record))
+        return hits
+
+    def __len__(self):
+        return self.n_keys
+
+    def close(self):
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _collect(conn):
+    """Sequence, patient and cluster records from a warehouse connection."""
+    seqs = defaultdict(lambda: {'accession': None, 'patient_id': None, 'clusters': set()})
+    patients = defaultdict(lambda: {'patient_code': None, 'clusters': {}, 'accessions': {}})
+    clusters = defaultdict(lambda: {'cluster_name': None, 'patients': {}, 'se_ids': set()})
+
+    def rows(sql):
+        return conn.execute(sql).fetchall()
+
+    def add_seq(se_id, accession, patient_id=None, patient_code=None, cluster_ids=()):
+        seq = seqs[se_id]
+        seq['accession'] = seq['accession'] or accession
+        seq['clusters'].update(cluster_ids)
+        for cluster_id in cluster_ids:
+            clusters[cluster_id]['se_ids'].add(se_id)
+        if patient_id is not None:
+            seq['patient_id'] = patient_id
+            patient = patients[patient_id]
+            patient['patient_code'] = patient['patient_code'] or patient_code
+            patient['accessions'].setdefault(accession, se_id)
+
+    def add_comb(cluster_comb):
+        ids = []
+        for name, cluster_id in _RE_CLUSTER_COMB.findall(cluster_comb or ''):
+            cluster_id = int(cluster_id)
+            clusters[cluster_id]['cluster_name'] = clusters[cluster_id]['cluster_name'] or name
+            ids.append(cluster_id)
+        return ids
+
+    for cluster_id, name in rows('SELECT cluster_id, cluster_name FROM clusters'):
+        clusters[cluster_id]['cluster_name'] = name
+    for cluster_id, patient_id, code in rows('SELECT cluster_id, patient_id, patient_code FROM cluster_patients '
+                                             'ORDER BY cluster_id, position'):
+        clusters[cluster_id]['patients'][patient_id] = code
+        patients[patient_id]['patient_code'] = code
+        patients[patient_id]['clusters'][cluster_id] = clusters[cluster_id]['cluster_name']
+    for patient_id, cluster_id, name in rows('SELECT patient_id, cluster_id, cluster_name FROM patient_clusters '
+                                             'ORDER BY patient_id, position'):
+        patients[patient_id]['clusters'][cluster_id] = name
+        clusters[cluster_id]['cluster_name'] = clusters[cluster_id]['cluster_name'] or name
+    for cluster_id, se_id, accession in rows('SELECT cluster_id, se_id, accession FROM cluster_accessions '
+                                             'ORDER BY cluster_id, position'):
+        add_seq(se_id, accession, cluster_ids=[cluster_id])
+    for patient_id, se_id, accession in rows('SELECT patient_id, se_id, accession FROM patient_accessions '
+                                             'ORDER BY patient_id, position'):
+        add_seq(se_id, accession, patient_id)
+    for table, accession_col in (('timepoints', 'accession_id'), ('search_results', 'accession')):
+        for se_id, accession, patient_id, code, comb in rows(
+                'SELECT blast_ssam_se_id, {}, patient_id, patient_code, cluster_comb FROM {} '
+                'WHERE blast_ssam_se_id IS NOT NULL ORDER BY rowid'.format(accession_col, table)):
+            add_seq(se_id, accession, patient_id, code, add_comb(comb))
+    return seqs, patients, clusters
+
+
+def _records(seqs, patients, clusters):
+    """(keys, value) pairs, one per distinct record."""
+    def cluster_list(ids):
+        return [{'cluster_id': i, 'cluster_name': clusters[i]['cluster_name']} for i in sorted(ids)]
+
+    codes = defaultdict(list)
+    for patient_id, patient in sorted(patients.items()):
+        for cluster_id, name in patient['clusters'].items():
+            clusters[cluster_id]['patients'].setdefault(patient_id, patient['patient_code'])
+            clusters[cluster_id]['cluster_name'] = clusters[cluster_id]['cluster_name'] or name
+        record = {'patient_id': patient_id, 'patient_code': patient['patient_code'],
+                  'clusters': cluster_list(patient['clusters']),
+                  'accessions': [{'accession': a, 'se_id': s} for a, s in patient['accessions'].items()]}
+        if patient['patient_code'] is not None:
+            codes[patient['patient_code']].append(record)
+        yield [('patient_id', patient_id)], record
+    for code, records in codes.items():
+        yield [('patient_code', code)], records
+    for se_id, seq in sorted(seqs.items()):
+        patient_id = seq['patient_id']
+        cluster_ids = seq['clusters'] or (patients[patient_id]['clusters'] if patient_id is not None else ())
+        record = {'accession': seq['accession'], 'se_id': se_id, 'patient_id': patient_id,
+                  'patient_code': patients[patient_id]['patient_code'] if patient_id is not None else None,
+                  'clusters': cluster_list(cluster_ids)}
+        keys = [('se_id', se_id)]
+        if seq['accession']:
+            keys.append(('accession', seq['accession']))
+        yield keys, record
+    for cluster_id, cluster in sorted(clusters.items()):
+        record = {'cluster_id': cluster_id, 'cluster_name': cluster['cluster_name'],
+                  'patients': [{'patient_id': p, 'patient_code': c} for p, c in cluster['patients'].items()],
+                  'n_accessions': len(cluster['se_ids'])}
+        keys = [('cluster_id', cluster_id)]
+        if cluster['cluster_name']:
+            keys.append(('cluster_name', cluster['cluster_name']))
+        yield keys, record
+
+
+def build_index(db_path=DEFAULT_DB, path=None):
+    """Write the index of a warehouse's accessions, patients and clusters.
+
+    Args:
+        db_path (str): warehouse file, as written by load_hiv sync.
+        path (str): index file, replaced atomically. Defaults to db_path + '.index'.
+
+    Returns:
+        index (AccessionIndex): the new index, opened.
+
+    Raises:
+        FileNotFoundError: db_path does not exist.
+    """
+    if not os.path.exists(db_path):
+        raise FileNotFoundError("No warehouse at {}; run load_hiv sync first".format(db_path))
+    path = path or index_path(db_path)
+    conn = sqlite3.connect('file:{}?mode=ro'.format(db_path), uri=True)
+    try:
+        seqs, patients, clusters = _collect(conn)
+    finally:
+        conn.close()
+    data = bytearray()
+    entries = {}
+    for keys, value in _records(seqs, patients, clusters):
+        raw = json.dumps(value, separators=(',', ':')).encode('utf8')
+        value_at = _HEADER.size + len(data)
+        data += raw
+        for kind, key in keys:
+            key = _key(kind, key)
+            if key in entries:
+                continue  # e.g. an accession listed with two se_ids: keep the first
+            entries[key] = (_HEADER.size + len(data), value_at, len(raw))
+            data += key
+    n_slots = 8
+    while n_slots < 2 * len(entries):
+        n_slots *= 2
+    slots = bytearray(n_slots * _SLOT.size)
+    for key, (key_at, value_at, value_len) in entries.items():
+        h = _hash(key)
+        i = h % n_slots
+        while _SLOT.unpack_from(slots, i * _SLOT.size)[0]:
+            i = (i + 1) % n_slots
+        _SLOT.pack_into(slots, i * _SLOT.size, h, key_at, len(key), value_at, value_len)
+    header = _HEADER.pack(_MAGIC, n_slots, len(entries), _HEADER.size + len(data))
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    with os.fdopen(fd, 'wb') as f:
+        f.write(header)
+        f.write(data)
+        f.write(slots)
+    os.replace(tmp_path, path)
+    _logger.info("Indexed %d keys (%d sequences, %d patients, %d clusters) from %s in %s",
+                 len(entries), len(seqs), len(patients), len(clusters), db_path, path)
+    return AccessionIndex(path)
+
+
+def open_index(db_path=DEFAULT_DB, path=None, rebuild=False):
+    """Open a warehouse's index, building it first if missing or older than the warehouse."""
+    path = path or index_path(db_path)
+    if rebuild or _is_stale(path, db_path):
+        return build_index(db_path, path)
+    return AccessionIndex(path)
+
+
+def _is_stale(path, db_path):
+    if not os.path.exists(path):
+        return True
+    # recent writes may still sit in the write-ahead log
+    sources = [p for p in (db_path, db_path + '-wal') if os.path.exists(p)]
+    return any(os.path.getmtime(p) > os.path.getmtime(path) for p in sources)
@@ -14,15 +14,24 @@ Note on URLs:
     https://www.hiv.lanl.gov/components/sequence/HIV/search/patient.comp?pat_id=9008
 """
 
+import functools
+import hashlib
+import html
 import re
+import sys
+import time
+from io import StringIO
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import logging
-import warnings
 
 import bs4
-import requests
 import pandas as pd
 
+from alamos_extract import profiling, tables
+from alamos_extract.client import get_default_client
+from alamos_extract.registry import get_patient_registry
+
 __author__ = "Stephen Gaffney"
 __copyright__ = "Stephen Gaffney"
 __license__ = "gpl3"
@@ -30,17 +39,73 @@ __license__ = "gpl3"
 _logger = logging.getLogger(__name__)
 
 
-def load_cluster(cluster_id):
+_INPUT_TAG = re.compile(rb'<input\b[^>]*>', re.IGNORECASE)
+_TAG_ATTR = re.compile(rb'([\w:.-]+)\s*=\s*("[^"]*"|\'[^\']*\'|[^\s>]+)')
+_TABLE_REGION = re.compile(rb'<table\b.*</table>', re.IGNORECASE | re.DOTALL)
+_WHITESPACE = re.compile(rb'\s+')
+_RESULT_ROW_LINK = re.compile(rb'patient\.comp\?pat_id=')
+_REPORTED_TOTAL = re.compile(rb'(\d[\d,]*)\s+sequences?\s+found', re.IGNORECASE)
+# Results table columns, applied per value and column-wise with Series.str.extract
+_RE_PATIENT_COMB = re.compile(r'^\s*([^(]*)\(\s*(\d+)\s*\)')
+_RE_NCBI_POS = re.compile(r'^Start: (\d+)\s+Stop: (\d+). Link to NCBI sequence viewer')
+_RE_SSAM_SE_ID = re.compile(r'_SE_id=(\d+)')
+
+# Typed schema applied to parsed results tables (see _apply_schema)
+_INT_COLS = (
+    'sampling_year', 'seq_length', 'days_from_first_sample', 'days_from_treatment_end',
+    'days_from_treatment_start', 'days_from_infection', 'days_from_seroconversion',
+)
+_CATEGORY_COLS = ('subtype', 'country', 'genomic_region', 'organism')
+_FIEBIG_STAGES = ('I', 'I/II', 'II', 'II/III', 'III', 'III/IV', 'IV', 'IV/V', 'V', 'V/VI', 'VI')
+_INTERNED_COLS = ('accession_id', 'accession', 'patient_code')
+
+_TIMEPOINT_COLS = (
+    'row_id',
+    'blast',
+    'patient_comb',
+    'accession_id',
+    'seq_name',
+    'subtype',
+    'country',
+    'sampling_year',
+    'days_from_first_sample',
+    'fiebig_stage',
+    'days_from_treatment_end',
+    'days_from_treatment_start',
+    'days_from_infection',
+    'days_from_seroconversion',
+    'genomic_region',
+    'seq_length',
+    'organism',
+)
+
+
+def load_cluster(cluster_id, client=None):
     """Obtains cluster name, description, patient names+ids, and accession names+ids.
 
     The IDs are required for URLs.
 
     Args:
         cluster_id (int): a cluster ID (as in URL id)
+        client (HivClient): HTTP client to use. Defaults to the shared client.
 
     Returns:
         data (dict): Dictionary of 'cluster name', 'description', 'patients', 'accessions'.
     """
+    client = client or get_default_client()
+    url = client.url(_cluster_path(cluster_id))
+    return tables.read_cluster_page(client.fetch(url))
+
+
+def _cluster_path(cluster_id):
+    return 'cluster.comp?clu_id={}'.format(cluster_id)
+
+
+def _parse_cluster(soup):
+    """Extract cluster name, description, patients and accessions from cluster page soup.
+
+    bs4 reference implementation of tables.read_cluster_page.
+    """
     cluster_name_str = 'Cluster Name'
     patient_url_format = r"patient.comp\?pat_id=(\d+)"  # includes backslash escape
     genbank_url_format = r"query_one.comp\?se_id=(\d+)"
@@ -51,9 +116,6 @@ def load_cluster(cluster_id):
                 'accessions': 'Accession(s)',
                 }
 
-    cluster_path = 'https://www.hiv.lanl.gov/components/sequence/HIV/search/cluster.comp?clu_id={}'
-    url = cluster_path.format(cluster_id)
-    soup = _get_soup_from_url(url)
     tables = soup('table')
 
     # Get main table
@@ -61,7 +123,7 @@ def load_cluster(cluster_id):
     assert(len(main_table) == 1), 'Failed to find main table: multiple have cluster name field'
     main_table = main_table[0]
 
-    df = pd.read_html(str(main_table))[0]
+    df = pd.read_html(StringIO(str(main_table)))[0]
     df = df.set_index([0]).transpose()
     cluster_str = df[col_dict['cluster_str']].iloc[0]
     desc = df[col_dict['desc']].iloc[0].strip(""" '" """)
@@ -97,14 +159,124 @@ def load_cluster(cluster_id):
 
 
 def search_db(max_rec=100, virus='HIV-1', subtype='A1*', region='GENOME',
-              cluster_name=None):
+              cluster_name=None, client=None, stream=False, partition_by=None, max_workers=4, engine='html'):
     """Builds dataframe of Sequence DB records for given field selections.
 
+    With stream=True, pages are parsed incrementally with iter_search rather
+    than held whole as parse trees, for large max_rec; the result then always
+    has a fresh RangeIndex.
+
+    With partition_by='subtype' (for a search of any subtype), the search is
+    split into disjoint sub-queries that page concurrently on max_workers
+    threads. See grid.search_partitioned.
+
+    With engine='download', the results are requested as one tab-delimited
+    download (see alamos_extract.bulk), with the same columns and a fresh
+    RangeIndex. If the server sends no download, the HTML pages are used.
+
+    stream, partition_by and engine='download' are alternative ways of
+    fetching the results, so at most one of them can be used.
+
     Returns:
         df (pandas.DataFrame): DataFrame with the following columns:
             row_id, blast, patient_id, accession, seq_name, subtype, country,
             sampling_year, genomic_region, seq_length, organism
+
+    Raises:
+        ValueError: unknown engine, or more than one of stream, partition_by
+            and engine='download'.
     """
+    if engine != 'html':
+        from alamos_extract import bulk
+        bulk.check_engine(engine)
+    modes = [name for name, used in (('stream', stream), ('partition_by', partition_by is not None),
+                                     ('engine={!r}'.format(engine), engine != 'html')) if used]
+    if len(modes) > 1:
+        raise ValueError("search_db options {} can't be combined".format(' and '.join(modes)))
+    if partition_by is not None:
+        from alamos_extract.grid import search_partitioned
+        return search_partitioned(max_rec=max_rec, virus=virus, subtype=subtype, region=region,
+                                  cluster_name=cluster_name, by=partition_by, client=client,
+                                  max_workers=max_workers)
+    if stream:
+        batches = iter_search(max_rec=max_rec, virus=virus, subtype=subtype, region=region,
+                              cluster_name=cluster_name, batch_size=10000, client=client)
+        return _concat_results(batches)
+    client = client or get_default_client()
+    url = client.url('search.comp')
+    test_form, main_cols = _search_form(max_rec, virus, subtype, region, cluster_name)
+    first = None
+    if engine != 'html':
+        df, first = bulk.search_download(url, test_form, main_cols, client)
+        if df is not None:
+            return df
+    if cluster_name is not None:
+        df_list = []
+        for ind, content in enumerate(_content_pager(url, data=test_form, client=client, first=first)):
+            _logger.info("Loading page %d for cluster %s", ind + 1, cluster_name)
+            temp = _get_df_from_content(content, col_headers=main_cols)
+            df_list.append(temp)
+        df = _concat_results(df_list)
+    else:
+        content = first if first is not None else client.fetch(url, data=test_form)
+        df = _get_df_from_content(content, col_headers=main_cols)
+    return df
+
+
+def iter_search(max_rec=100, virus='HIV-1', subtype='A1*', region='GENOME',
+                cluster_name=None, batch_size=1000, client=None):
+    """Stream Sequence DB records for given field selections in fixed-size batches.
+
+    Rows are parsed incrementally from the response body and each page's
+    parse tree is freed as it goes, so memory use stays flat however many
+    records are returned. Responses are not cached.
+
+    Yields:
+        df (pandas.DataFrame): up to batch_size rows with search_db's columns.
+    """
+    client = client or get_default_client()
+    url = client.url('search.comp')
+    test_form, main_cols = _search_form(max_rec, virus, subtype, region, cluster_name)
+    batch = []
+    parser = None
+    for parser, row in _stream_result_rows(url, test_form, client, follow_pages=cluster_name is not None):
+        batch.append(row)
+        if len(batch) == batch_size:
+            yield _results_batch_df(parser, batch, main_cols)
+            batch = []
+    if batch:
+        yield _results_batch_df(parser, batch, main_cols)
+
+
+def _stream_result_rows(url, data, client, follow_pages=True):
+    """Yield (parser, row) for each result row, following Next pages if requested."""
+    form = data
+    page = 1
+    while True:
+        parser = tables.ResultsStreamParser()
+        for chunk in client.stream(url, data=form):
+            for row in parser.feed(chunk):
+                yield parser, row
+        for row in parser.close():
+            yield parser, row
+        if not (follow_pages and (parser.has_next or parser.has_last)):
+            return
+        page += 1
+        _logger.info("Streaming page %d of %s", page, url)
+        form = _next_page_form(parser.page_id, data)
+
+
+def _results_batch_df(parser, rows, col_headers):
+    """DataFrame for a batch of streamed rows, processed as in _get_df_from_content."""
+    body = parser.pre_rows + [texts for texts, _, _ in rows]
+    df = tables.frame_from_rows(parser.head, body)
+    ncbi = [link for _, row_ncbi, _ in rows for link in row_ncbi]
+    blast_urls = [url for _, _, row_blast in rows for url in row_blast]
+    return _process_results_df(df, list(col_headers), ncbi, blast_urls)
+
+
+def _search_form(max_rec, virus, subtype, region, cluster_name):
+    """Build search.comp form data and the expected result table columns."""
     test_form = {
                  'slave': subtype,
                  'Genomic Region': region,
@@ -129,65 +301,249 @@ def search_db(max_rec=100, virus='HIV-1', subtype='A1*', region='GENOME',
         'seq_length',
         'organism',
     ]
-    url = 'https://www.hiv.lanl.gov/components/sequence/HIV/search/search.comp'
     if cluster_name is not None:
         test_form.update({'value cluster clu_name 1': cluster_name})
         main_cols.insert(2, 'blast2')
         main_cols.insert(9, 'cluster_comb')
-        df_list = []
-        for ind, soup in enumerate(_soup_pager(url, data=test_form)):
-            _logger.info("Loading page %d for cluster %s", ind + 1, cluster_name)
-            temp = _get_df_from_soup(soup, col_headers=main_cols)
-            df_list.append(temp)
-        df = pd.concat(df_list, axis=0, ignore_index=True)
-    else:
-        soup = _get_soup_from_url(url, data=test_form)
-        df = _get_df_from_soup(soup, col_headers=main_cols)
-    return df
+    return test_form, main_cols
 
 
 class Cluster:
-    """Holds patients."""
-    def __init__(self, cluster_id: int):
+    """Holds patients.
+
+    The cluster page is loaded on creation. Patient pages are fetched when
+    first needed: desc_df needs each patient's page, acc_df also their paged
+    timepoint tables. load() fetches them up front.
+
+    Patient pages are loaded through a PatientRegistry, so patients shared
+    with clusters built earlier in the process are not downloaded again.
+
+    Args:
+        cluster_id (int): a cluster ID (as in URL id)
+        client (HivClient): HTTP client to use. Defaults to the shared client.
+        max_workers (int): if greater than 1, fetch patient pages on a thread
+            pool of this size. Patient order is unchanged.
+        registry (PatientRegistry): patient registry to use. Defaults to the
+            process-wide registry.
+        engine (str): 'html' or 'download', how patients' timepoint tables
+            are fetched. See extract_patient_accession_timepoints.
+    """
+    max_workers = None
+
+    def __init__(self, cluster_id: int, client=None, max_workers=None, registry=None, engine='html'):
+        client = client or get_default_client()
+        if registry is None:
+            registry = get_patient_registry()
         self.cluster_id = cluster_id
-        data = load_cluster(cluster_id)
+        self.max_workers = max_workers
+        with profiling.span('Cluster', 'build', cluster_id=cluster_id):
+            self._set_header(load_cluster(cluster_id, client=client))
+        self.patient_dict = OrderedDict(
+            (patient_id, Patient(patient_id, patient_code, client=client, registry=registry, engine=engine))
+            for patient_code, patient_id in self.comb_patients.items())
+
+    @classmethod
+    async def create(cls, cluster_id: int, client=None):
+        """Build Cluster with the asyncio API, fetching all patients concurrently.
+
+        Args:
+            client (alamos_extract.aio.AsyncHivClient): async client to use.
+        """
+        from alamos_extract import aio
+        return await aio.create_cluster(cluster_id, client=client, cls=cls)
+
+    @classmethod
+    def from_warehouse(cls, cluster_id: int, warehouse):
+        """Build Cluster from a local warehouse (see load_hiv sync), without HTTP requests.
+
+        Args:
+            warehouse (alamos_extract.warehouse.Warehouse): synced warehouse.
+
+        Raises:
+            KeyError: cluster or one of its patients has not been synced.
+        """
+        cluster = cls.__new__(cls)
+        cluster.cluster_id = cluster_id
+        cluster._set_header(warehouse.load_cluster(cluster_id))
+        cluster.patient_dict = OrderedDict()
+        for patient_code, patient_id in cluster.comb_patients.items():
+            cluster.patient_dict[patient_id] = Patient.from_warehouse(patient_id, patient_code, warehouse)
+        cluster._build_tables()
+        return cluster
+
+    def _set_header(self, data):
         self.cluster_name = data['cluster_name']
         self.description = data['description']
         self.comb_patients = data['patients']  # not needed?
         self.comb_accessions = data['accessions']
-        self.patient_dict = OrderedDict()
-        for patient_code, patient_id in self.comb_patients.items():
-            patient = Patient(patient_id, patient_code)
-            self.patient_dict[patient_id] = patient
+        self._desc_df = None
+        self._acc_df = None
+
+    @property
+    def desc_df(self):
+        """Patient descriptions, one column per patient. Fetches patient pages."""
+        if self._desc_df is None:
+            self.load(timepoints=False)
+            self._build_desc_df()
+        return self._desc_df
+
+    @property
+    def acc_df(self):
+        """Accessions with timepoint information. Fetches patient timepoint tables."""
+        if self._acc_df is None:
+            self.load()
+            self._build_acc_df()
+        return self._acc_df
+
+    @property
+    def accession_list_df(self):
+        """Accessions listed on the patient pages, without the paged timepoint tables.
+
+        Returns:
+            df (pd.DataFrame): patient_id, accession_id and blast_ssam_se_id.
+        """
+        self.load(timepoints=False)
+        rows = [(patient_id, accession_id, se_id) for patient_id, patient in self.patient_dict.items()
+                for accession_id, se_id in patient.accession_list]
+        return pd.DataFrame(rows, columns=['patient_id', 'accession_id', 'blast_ssam_se_id'])
+
+    def load(self, timepoints=True):
+        """Fetch all patient pages not yet loaded, on max_workers threads.
+
+        Args:
+            timepoints (bool): also fetch the paged timepoint tables.
+
+        Returns:
+            self
+        """
+        patients = self.patient_dict.values()
+        tasks = [p._load_info for p in patients if p._info is None]
+        if timepoints:
+            tasks += [p._load_timepoints for p in patients if p._accession_df is None]
+        if not tasks:
+            return self
+        with profiling.span('Cluster.load', 'build', cluster_id=self.cluster_id, timepoints=timepoints):
+            if self.max_workers and self.max_workers > 1 and len(tasks) > 1:
+                with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+                    for future in [pool.submit(task) for task in tasks]:
+                        future.result()
+            else:
+                for task in tasks:
+                    task()
+        return self
+
+    def _build_tables(self):
+        self._build_desc_df()
+        self._build_acc_df()
+
+    def _build_desc_df(self):
+        desc_list = [patient.desc for patient in self.patient_dict.values()]
+        self._desc_df = pd.concat(desc_list, axis=1)
+        # desc_df.index.name = None
 
-        desc_list = []
+    def _build_acc_df(self):
         acc_list = []
         for patient_id, patient in self.patient_dict.items():
-            desc_list.append(patient.desc)
             # acc_df = pd.DataFrame.from_records(patient.accession_list, columns=['accession_name', 'accession_id'])
             # acc_df.insert(0, 'patient_id', patient_id)
             acc_list.append(patient.accession_df)
-        desc_df = pd.concat(desc_list, axis=1)
-        # desc_df.index.name = None
-        acc_df = pd.concat(acc_list, axis=0, ignore_index=True)
+        acc_df = _concat_results(acc_list)
         assert (acc_df.accession_id.value_counts().max() <= 1), "Duplicate accession issue."
-        self.desc_df = desc_df
-        self.acc_df = acc_df
+        self._acc_df = acc_df
 
 
 class Patient:
-    def __init__(self, patient_id, patient_code=None):
-        """Holds various patient attributes including accessions with timepoint information."""
+    """Holds various patient attributes including accessions with timepoint information.
+
+    Pages are fetched on first access: desc, accession_list and clusters come
+    from the patient page, accession_df from the paged timepoint table.
+
+    Args:
+        patient_id (int): a patient ID (as in URL id)
+        patient_code (str): the patient's code in the cluster it was listed in.
+        client (HivClient): HTTP client to use. Defaults to the shared client.
+        registry (PatientRegistry): patient registry to use. Defaults to the
+            process-wide registry.
+        engine (str): 'html' or 'download', how the timepoint table is fetched.
+    """
+    engine = 'html'
+
+    def __init__(self, patient_id, patient_code=None, client=None, registry=None, engine='html'):
         self.patient_id = patient_id
         self.patient_code = patient_code
-        data = extract_patient_info(patient_id)
-        self.desc = data['desc']
-        self.accession_list = data['accessions']
-        self.clusters = data['clusters']
-        self.accession_df = extract_patient_accession_timepoints(patient_id)
-        if len(self.accession_list) != len(self.accession_df):
-            values_df = set(self.accession_df.accession_id.values)
-            values_list = set([i[0] for i in self.accession_list])
+        self.engine = engine
+        self._client = client or get_default_client()
+        self._registry = registry if registry is not None else get_patient_registry()
+        self._info = None
+        self._accession_df = None
+
+    @classmethod
+    def from_data(cls, patient_id, patient_code, data, accession_df):
+        """Build Patient from already fetched extract_patient_info and timepoints results."""
+        patient = cls.__new__(cls)
+        patient.patient_id = patient_id
+        patient.patient_code = patient_code
+        patient._info = data
+        patient._accession_df = accession_df
+        patient._check_accessions()
+        return patient
+
+    @classmethod
+    def from_warehouse(cls, patient_id, patient_code, warehouse):
+        """Build Patient from a local warehouse (see load_hiv sync), without HTTP requests."""
+        return cls.from_data(patient_id, patient_code, warehouse.load_patient_info(patient_id),
+                             warehouse.load_timepoints(patient_id))
+
+    @property
+    def desc(self):
+        return self._load_info()['desc']
+
+    @property
+    def accession_list(self):
+        return self._load_info()['accessions']
+
+    @property
+    def clusters(self):
+        return self._load_info()['clusters']
+
+    @property
+    def accession_df(self):
+        return self._load_timepoints()
+
+    def _load_info(self):
+        if self._info is None:
+            with profiling.span('Patient', 'build', patient_id=self.patient_id, page='info'):
+                self._info = self._registered('info', extract_patient_info)
+            if self._accession_df is not None:
+                self._check_accessions()
+        return self._info
+
+    def _load_timepoints(self):
+        if self._accession_df is None:
+            with profiling.span('Patient', 'build', patient_id=self.patient_id, page='timepoints'):
+                self._accession_df = self._registered(
+                    'timepoints', functools.partial(extract_patient_accession_timepoints, engine=self.engine))
+            if self._info is not None:
+                self._check_accessions()
+        return self._accession_df
+
+    def _registered(self, page, load):
+        """Result of load(patient_id), through the registry.
+
+        Entries are keyed by server as well as patient id, and a refreshing client
+        reloads rather than reusing a held entry. Results are shared between
+        clusters and must not be modified in place.
+        """
+        client = self._client
+        return self._registry.get((client.base_url, page, self.patient_id),
+                                  lambda: load(self.patient_id, client=client), refresh=client.refresh)
+
+    def _check_accessions(self):
+        accession_list = self._info['accessions']
+        accession_df = self._accession_df
+        if len(accession_list) != len(accession_df):
+            values_df = set(accession_df.accession_id.values)
+            values_list = set([i[0] for i in accession_list])
             values_df_only = values_df.difference(values_list)
             values_list_only = values_list.difference(values_df)
             diff_list = []
@@ -198,19 +554,31 @@ class Patient:
             diff_str = ' '.join(diff_list)
             _logger.error(("Basic accession listing for patient {p} contains {nb} accessions, while timepoints table "
                            "lists {ne} accessions. {diffs}")
-                          .format(p=patient_id, nb=len(self.accession_list), ne=len(self.accession_df),
+                          .format(p=self.patient_id, nb=len(accession_list), ne=len(accession_df),
                                   diffs=diff_str))
 
 
-def extract_patient_info(patient_id: int):
+def extract_patient_info(patient_id: int, client=None):
     """Get patient info dictionary from patient_id.
 
     Returns:
         data (dict): Dictionary with keys: desc, accessions, clusters
     """
-    patient_info_url = "https://www.hiv.lanl.gov/components/sequence/HIV/search/patient.comp?pat_id={}".format(patient_id)
-    soup = _get_soup_from_url(patient_info_url)
-    ptables = pd.read_html(str(soup))
+    client = client or get_default_client()
+    patient_info_url = client.url(_patient_path(patient_id))
+    return tables.read_patient_page(client.fetch(patient_info_url), patient_id)
+
+
+def _patient_path(patient_id):
+    return "patient.comp?pat_id={}".format(patient_id)
+
+
+def _parse_patient_info(soup, patient_id):
+    """Extract desc, accessions and clusters from patient page soup.
+
+    bs4 reference implementation of tables.read_patient_page.
+    """
+    ptables = pd.read_html(StringIO(str(soup)))
 
     """tables:
         0: tools
@@ -226,14 +594,14 @@ def extract_patient_info(patient_id: int):
     accessions = []
     for a in acc_urls:
         accession_id = a.text.strip()
-        se_id = int(re.findall('se_id=(\d+)', a['href'])[0])
+        se_id = int(re.findall(r'se_id=(\d+)', a['href'])[0])
         accessions.append((accession_id, se_id))
 
     cluster_urls = soup(href=re.compile('cluster.comp'))
     clusters = []
     for a in cluster_urls:
         cluster_name = a.text.strip()
-        clu_id = int(re.findall('clu_id=(\d+)', a['href'])[0])
+        clu_id = int(re.findall(r'clu_id=(\d+)', a['href'])[0])
         clusters.append((cluster_name, clu_id))
 
     return {'desc': desc,
@@ -242,73 +610,199 @@ def extract_patient_info(patient_id: int):
             }
 
 
-def _soup_pager(url, data=None):
-    kwargs = {} if data is None else {'data': data}
-    soup = _get_soup_from_url(url, **kwargs)
-    yield soup
-    while _has_next_page_not_final(soup) or _has_next_page_is_final(soup):
-        page_id = _get_results_page_id(soup)
-        new_data = {} if data is None else data.copy()
-        new_data.update({'action Next.x': 1, 'action Next.y': 1, 'id': page_id})
-        soup = _get_soup_from_url(url, data=new_data)
-        yield soup
+def _soup_pager(url, data=None, client=None):
+    """Yield soups for each page of a paged results table. See _content_pager."""
+    for content in _content_pager(url, data=data, client=client):
+        yield _get_soup_from_content(content)
 
 
-def extract_patient_accession_timepoints(patient_id: int):
-    """Load large sequence accession table with timepoint information for patient_id."""
-    time_url = ("https://www.hiv.lanl.gov/components/sequence/HIV/search/d_search.comp"
-                "?ssam_pat_id={}&ssam_postfirstsample_days=*&ssam_poststarttreatment_days=*"
-                "&ssam_postendtreatment_days=*&ssam_postseroconv_days=*&ssam_postinfect_days=*&ssam_fiebig=*") \
-        .format(patient_id)
+def _content_pager(url, data=None, client=None, prefetch=True, first=None):
+    """Yield raw content for each page of a paged results table.
 
-    main_cols = [
-        'row_id',
-        'blast',
-        'patient_comb',
-        'accession_id',
-        'seq_name',
-        'subtype',
-        'country',
-        'sampling_year',
-        'days_from_first_sample',
-        'fiebig_stage',
-        'days_from_treatment_end',
-        'days_from_treatment_start',
-        'days_from_infection',
-        'days_from_seroconversion',
-        'genomic_region',
-        'seq_length',
-        'organism',
-    ]
+    Paging controls are found by scanning the raw page bytes, so with prefetch
+    the request for page N+1 is sent on a background thread before page N is
+    handed to the caller for parsing. Pages are always yielded in order.
+
+    Pages are cached by page number of the originating query. Result ids in
+    cached pages belong to expired server sessions, so if a cached chain ends
+    before the final page, the session is replayed live from the first page.
+    Pages not served from the cache are fetched in full, never revalidated: a
+    304 would hand back a stored page whose result id has expired.
+
+    first, if given, is the first page, already fetched live, e.g. the grid
+    a server sent instead of a requested download.
+    """
+    client = client or get_default_client()
+    page = 0
+    key = client.cache_key(url, data, page=page)
+    if first is not None:
+        content, live = first, True
+        if key is not None:
+            client.cache.set(key, first)
+    else:
+        content = client.lookup(key)
+        live = content is None
+        if live:
+            content = client.fetch(url, data=data, cache_key=key, revalidate=False)
+    executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+    try:
+        while True:
+            profiling.instant('page', 'page', url=url, page=page + 1, bytes=len(content))
+            new_data = _next_page_data_from_content(content, data)
+            if new_data is None:
+                yield content
+                return
+            page += 1
+            key = client.cache_key(url, data, page=page)
+            cached = None if live else client.lookup(key)
+            if cached is None and live and executor is not None:
+                pending = executor.submit(_timed_fetch, client, url, new_data, key)
+                yield content
+                t_wait = time.perf_counter()
+                content, t_fetch = pending.result()
+                t_wait = time.perf_counter() - t_wait
+                _logger.info("Prefetched page %d of %s: %.3f s of %.3f s request latency hidden",
+                             page + 1, url, max(t_fetch - t_wait, 0), t_fetch)
+                continue
+            yield content
+            if cached is not None:
+                content = cached
+            elif live:
+                content = client.fetch(url, data=new_data, cache_key=key, revalidate=False)
+            else:
+                _logger.debug("Page %d of %s not cached, replaying search session", page + 1, url)
+                content = _replay_pages(url, data, page, client)
+                live = True
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _timed_fetch(client, url, data, cache_key):
+    start = time.perf_counter()
+    content = client.fetch(url, data=data, cache_key=cache_key, revalidate=False)
+    return content, time.perf_counter() - start
+
+
+def _replay_pages(url, data, page, client):
+    """Fetch pages 0..page live, refreshing their cache entries, and return the last."""
+    content = client.fetch_live(url, data=data)
+    for ind in range(page + 1):
+        if ind:
+            new_data = _next_page_data_from_content(content, data)
+            content = client.fetch_live(url, data=new_data)
+        key = client.cache_key(url, data, page=ind)
+        if key is not None:
+            client.cache.set(key, content)
+    return content
+
+
+def _next_page_data_from_content(content, data=None):
+    """As _next_page_data, but scanning raw page bytes for the paging inputs."""
+    has_next = has_last = False
+    page_id = None
+    for tag in _INPUT_TAG.findall(content):
+        attrs = {k.lower(): html.unescape(v.strip(b'"\'').decode('utf8', 'replace'))
+                 for k, v in _TAG_ATTR.findall(tag)}
+        title = attrs.get(b'title')
+        if title == 'Next':
+            has_next = True
+        elif title == 'Last':
+            has_last = True
+        if page_id is None and attrs.get(b'name') == 'id':
+            page_id = attrs.get(b'value')
+    if not (has_next or has_last):
+        return None
+    return _next_page_form(page_id, data)
+
+
+def _has_result_rows(content):
+    """Whether a results page lists any sequences (each row links to its patient)."""
+    return _RESULT_ROW_LINK.search(content) is not None
+
+
+def _reported_total(content):
+    """Number of matching sequences a results page reports ('1,234 sequences found'), or None."""
+    match = _REPORTED_TOTAL.search(content)
+    return int(match.group(1).replace(b',', b'')) if match else None
+
+
+def _page_fingerprint(content):
+    """Hash of a page's table region, ignoring form inputs and whitespace.
+
+    Inputs carry per-session result ids, so two downloads of an unchanged
+    page have the same fingerprint and would parse to the same tables.
+    """
+    match = _TABLE_REGION.search(content)
+    region = match.group(0) if match else content
+    region = _WHITESPACE.sub(b' ', _INPUT_TAG.sub(b'', region))
+    return hashlib.sha256(region).hexdigest()
+
+
+def _next_page_form(page_id, data=None):
+    new_data = {} if data is None else data.copy()
+    new_data.update({'action Next.x': 1, 'action Next.y': 1, 'id': page_id})
+    return new_data
+
+
+def extract_patient_accession_timepoints(patient_id: int, client=None, engine='html'):
+    """Load large sequence accession table with timepoint information for patient_id.
+
+    engine='download' requests the table as one tab-delimited download, as
+    for search_db.
+    """
+    client = client or get_default_client()
+    time_url = client.url(_timepoints_path(patient_id))
+
+    main_cols = list(_TIMEPOINT_COLS)
+    first = None
+    if engine != 'html':
+        from alamos_extract import bulk
+        bulk.check_engine(engine)
+        df, first = bulk.timepoints_download(time_url, main_cols, client)
+        if df is not None:
+            return df.drop('patient_comb', axis=1)
 
     df_list = []
-    for ind, soup in enumerate(_soup_pager(time_url)):
+    for ind, content in enumerate(_content_pager(time_url, client=client, first=first)):
         if ind:
             _logger.info("Loading page {} for patient {}".format(ind + 1, patient_id))
-        df = _get_df_from_soup(soup, col_headers=main_cols)
+        df = _get_df_from_content(content, col_headers=main_cols)
         df_list.append(df)
+    return _concat_timepoint_pages(df_list)
+
 
+def _timepoints_path(patient_id):
+    return ("d_search.comp"
+            "?ssam_pat_id={}&ssam_postfirstsample_days=*&ssam_poststarttreatment_days=*"
+            "&ssam_postendtreatment_days=*&ssam_postseroconv_days=*&ssam_postinfect_days=*"
+            "&ssam_fiebig=*".format(patient_id))
+
+
+def _concat_timepoint_pages(df_list):
     final_cols = df_list[0].columns
-    df = pd.concat(df_list, axis=0, ignore_index=True)
+    df = _concat_results(df_list)
     df = df[final_cols]
     df.drop('patient_comb', axis=1, inplace=True)
     return df
 
 
-def _get_soup_from_url(url, data=None):
+@profiling.traced('fetch')
+def _get_soup_from_url(url, data=None, client=None):
     """Get BeautifulSoup object from HIV Database url, using POST request if data supplied."""
-    # @TODO: find a way to get around "certificate verify failed" error without verify=False
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        if data:
-            request = requests.post(url, data=data, verify=False)
-        else:
-            request = requests.get(url, verify=False)
-    content = request.content
+    client = client or get_default_client()
+    content = client.fetch(url, data=data)
+    return _get_soup_from_content(content)
+
+
+@profiling.traced('parse')
+def _get_soup_from_content(content):
+    """Parse raw HIV Database page content into a BeautifulSoup object."""
     soup = bs4.BeautifulSoup(content, features="lxml", from_encoding='utf8')
     return soup
 
 
+@profiling.traced('table')
 def _get_df_from_soup(soup, col_headers=None):
     """Extract table from html soup and verify no other tables present.
 
@@ -327,7 +821,43 @@ def _get_df_from_soup(soup, col_headers=None):
     temp = {id(t.find_parent('table')) for t in links}
     assert (len(temp) == 1), "Multiple table matches with accession links"
     # Read main table
-    df = pd.read_html(str(table))[0]
+    df = pd.read_html(StringIO(str(table)))[0]
+    ncbi_links = table(href=re.compile('nuccore'))
+    ncbi = [(i.find('img')['title'], i.attrs['href']) for i in ncbi_links]
+    blast_urls = [i['href'] for i in table.findAll('a', {'href': re.compile('blast')})]
+    return _process_results_df(df, col_headers, ncbi, blast_urls)
+
+
+@profiling.traced('parse')
+def _get_df_from_content(content, col_headers=None):
+    """Extract results table from raw page content in a single lxml pass.
+
+    Produces the same DataFrame as _get_df_from_soup(_get_soup_from_content(content)).
+
+    Args:
+        content (bytes): raw results page.
+        col_headers (list): column headers, for renaming columns (REQUIRED).
+
+    Returns:
+        df (pd.DataFrame): table of parsed data
+    """
+    if not col_headers:
+        raise Exception("Column headers must be specified for table.")
+    df, ncbi, blast_urls = tables.read_results_table(content)
+    return _process_results_df(df, col_headers, ncbi, blast_urls)
+
+
+@profiling.traced('process')
+def _process_results_df(df, col_headers, ncbi, blast_urls, typed=True):
+    """Name columns and add patient, NCBI position and SSAM_SE_id columns.
+
+    Args:
+        df (pd.DataFrame): results table as parsed by read_html.
+        col_headers (list): column headers.
+        ncbi (list): (img title, href) of each NCBI link in the table.
+        blast_urls (list): href of each blast link in the table.
+        typed (bool): apply the typed column schema, see _apply_schema.
+    """
     # allow for double colspan in 2nd column producing extra parsed column
     if len(col_headers) == len(df.columns) - 1:
         col_headers.insert(2, 'blast2')
@@ -335,18 +865,66 @@ def _get_df_from_soup(soup, col_headers=None):
     # handle case where first row contains headers
     if ''.join([str(i) for i in df.iloc[0, :2].values]) == '#Select':
         df = df.iloc[1:].copy()
-    # Split combined patient identifier column
-    patient_codes, patient_ids = zip(*df.patient_comb.apply(_get_patient_ids))
-    df.insert(2, 'patient_id', patient_ids)
-    df.insert(3, 'patient_code', patient_codes)
-    ncbi_links = table(href=re.compile('nuccore'))
-    df['pos'], df['ncbi_url'] = zip(*[_process_ncbi_link(i) for i in ncbi_links])
-    blast_urls = pd.Series([i['href'] for i in table.findAll('a', {'href': re.compile('blast')})])
-    ssam_ids = blast_urls.apply(_get_ssam_se_id)
-    df.insert(5, 'blast_ssam_se_id', ssam_ids)
+    # Split combined patient identifier column; values repeat for each of a
+    # patient's sequences, so extract from the distinct values only
+    codes, uniques = pd.factorize(df['patient_comb'].astype(str))
+    patients = pd.Series(uniques, dtype=object).str.extract(_RE_PATIENT_COMB)
+    df.insert(2, 'patient_id', pd.to_numeric(patients[1]).astype('int64').to_numpy()[codes])
+    df.insert(3, 'patient_code', patients[0].to_numpy()[codes])
+    titles = pd.Series([title for title, _ in ncbi], dtype=object)
+    positions = titles.str.extract(_RE_NCBI_POS)
+    # titles without a position are kept whole as pos
+    df['pos'] = (positions[0] + ':' + positions[1]).fillna(titles).to_numpy()
+    df['pos_start'] = pd.to_numeric(positions[0]).astype('Int64').array
+    df['pos_stop'] = pd.to_numeric(positions[1]).astype('Int64').array
+    df['ncbi_url'] = [href for _, href in ncbi]
+    ssam_ids = pd.Series(blast_urls, dtype=object).str.extract(_RE_SSAM_SE_ID)[0]
+    df.insert(5, 'blast_ssam_se_id', pd.to_numeric(ssam_ids).astype('int64').to_numpy())
+    if typed:
+        df = _apply_schema(df)
     return df
 
 
+def _apply_schema(df):
+    """Convert parsed text columns to compact typed columns, in place.
+
+    Day offsets, years and lengths become nullable Int64, fiebig_stage an
+    ordered categorical, subtype/country/region/organism categoricals, and
+    accession ids interned strings (only where strings are Python objects).
+    Columns that are already typed are left unchanged, so it is safe to
+    re-apply after concatenating tables.
+    """
+    for col in _INT_COLS:
+        if col in df.columns and str(df[col].dtype) != 'Int64':
+            ints = pd.to_numeric(df[col], errors='coerce')
+            n_bad = int((ints.isna() & df[col].notna()).sum())
+            if n_bad:
+                _logger.warning("%d non-integer values in column %s set to NA", n_bad, col)
+            df[col] = ints.astype('Int64')
+    for col in _CATEGORY_COLS:
+        if col in df.columns and not isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype('category')
+    if 'fiebig_stage' in df.columns:
+        stages = df['fiebig_stage']
+        extra = sorted(set(stages.dropna().astype(str)).difference(_FIEBIG_STAGES))
+        if extra:
+            _logger.warning("Unrecognised Fiebig stages ordered after VI: %s", extra)
+        dtype = pd.CategoricalDtype(_FIEBIG_STAGES + tuple(extra), ordered=True)
+        if stages.dtype != dtype:
+            df['fiebig_stage'] = stages.astype(object).astype(dtype)
+    for col in _INTERNED_COLS:
+        if col in df.columns and (df[col].dtype == object or getattr(df[col].dtype, 'storage', None) == 'python'):
+            df[col] = pd.array([sys.intern(v) if isinstance(v, str) else v for v in df[col]],
+                               dtype=df[col].dtype)
+    return df
+
+
+@profiling.traced('concat')
+def _concat_results(df_list):
+    """Concatenate results tables, restoring categoricals that pd.concat widens to text."""
+    return _apply_schema(pd.concat(df_list, axis=0, ignore_index=True))
+
+
 def _has_next_page_not_final(soup):
     """Test for additional results pages, and """
     input_obj = soup.find('input', title="Next")
@@ -374,9 +952,12 @@ def _process_ncbi_link(link):
     Args:
         link (:obj:`bs4.element.Tag`): contains NCBI link.
     """
-    title = link.find('img')['title']
-    href = link.attrs['href']
-    match = re.match('Start: (\d+)\s+Stop: (\d+). Link to NCBI sequence viewer', title)
+    return _process_ncbi_title(link.find('img')['title'], link.attrs['href'])
+
+
+def _process_ncbi_title(title, href):
+    """Get 'start:stop' position from NCBI link image title."""
+    match = _RE_NCBI_POS.match(title)
     pos = ':'.join(match.groups()) if match else title
     return pos, href
 
@@ -388,7 +969,7 @@ def _get_patient_ids(patient_comb: str):
         patient_id is unique, and used for patient lookups.
         https://www.hiv.lanl.gov/components/sequence/HIV/search/patient.comp?pat_id=9008
     """
-    r = re.match('([^\(]*)\(([^\)]*)\)', patient_comb.strip())
+    r = _RE_PATIENT_COMB.match(patient_comb.strip())
     patient_code, patient_id = r.groups()
     patient_id = int(patient_id.strip())
     return patient_code, patient_id
@@ -399,6 +980,5 @@ def _get_ssam_se_id(blast_url: str):
 
     Example: https://www.hiv.lanl.gov/cgi-bin/BASIC_BLAST/basic_blast_pg.cgi?SSAM_SE_id=149746
     """
-    val = re.findall('\_SE\_id\=(\d+)', blast_url)[0]
-    return val
+    return int(_RE_SSAM_SE_ID.search(blast_url).group(1))
 
@@ -0,0 +1,218 @@
+"""Transmission networks: clusters and patients reachable from a seed cluster.
+
+:func:`expand_network` runs a breadth-first search over the links between
+clusters and their patients. Cluster pages list a cluster's patients, and
+patient pages list every cluster a patient belongs to. Each level's pages are
+fetched concurrently. Clusters and patients are tracked in visited sets, so
+each page is fetched once, however many paths lead to it. Patient pages also
+go through the PatientRegistry, shared with Cluster.
+
+The result, a :class:`Network`, gives node and edge tables and the merged
+accession table of all its patients. :func:`write_network` writes them,
+together with a GraphML file for graph tools.
+"""
+
+import logging
+import os
+import time
+import xml.etree.ElementTree as ET
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from alamos_extract import profiling
+from alamos_extract.client import get_default_client
+from alamos_extract.export import write_table
+from alamos_extract.load_data import Cluster, _concat_results
+from alamos_extract.registry import get_patient_registry
+
+__author__ = "Stephen Gaffney"
+__copyright__ = "Stephen Gaffney"
+__license__ = "gpl3"
+
+_logger = logging.getLogger(__name__)
+
+NODE_COLS = ('node', 'kind', 'id', 'label', 'depth')
+EDGE_COLS = ('source', 'target', 'cluster_id', 'patient_id', 'patient_code')
+
+
+def cluster_node(cluster_id):
+    return 'c{}'.format(cluster_id)
+
+
+def patient_node(patient_id):
+    return 'p{}'.format(patient_id)
+
+
+class Network:
+    """Clusters and patients found by expand_network.
+
+    Attributes:
+        seed (int): seed cluster id.
+        clusters (OrderedDict): cluster_id -> Cluster, in breadth-first order.
+        patients (OrderedDict): patient_id -> Patient, in breadth-first order.
+        depths (dict): node name -> number of patient hops from the seed
+            cluster. A patient has the depth of the first cluster listing it.
+        truncated (bool): whether the depth or size limits left linked
+            clusters or patients out.
+        seconds (float): time taken by the expansion.
+    """
+    def __init__(self, seed):
+        self.seed = seed
+        self.clusters = OrderedDict()
+        self.patients = OrderedDict()
+        self.depths = {}
+        self.truncated = False
+        self.seconds = 0.0
+        self.max_workers = None
+
+    @property
+    def nodes_df(self):
+        """One row per cluster and patient: node, kind, id, label (name or code), depth."""
+        rows = [(cluster_node(i), 'cluster', i, c.cluster_name, self.depths[cluster_node(i)])
+                for i, c in self.clusters.items()]
+        rows += [(patient_node(i), 'patient', i, p.patient_code, self.depths[patient_node(i)])
+                 for i, p in self.patients.items()]
+        df = pd.DataFrame(rows, columns=list(NODE_COLS))
+        df['kind'] = df['kind'].astype(pd.CategoricalDtype(['cluster', 'patient']))
+        return df
+
+    @property
+    def edges_df(self):
+        """One row per cluster membership: source (cluster node), target (patient node),
+        cluster_id, patient_id and the patient's code in that cluster."""
+        rows = [(cluster_node(cluster_id), patient_node(patient_id), cluster_id, patient_id, code)
+                for cluster_id, cluster in self.clusters.items()
+                for code, patient_id in cluster.comb_patients.items() if patient_id in self.patients]
+        return pd.DataFrame(rows, columns=list(EDGE_COLS))
+
+    def accession_df(self, timepoints=True):
+        """Accessions of all patients, in node order. Fetches the pages still needed.
+
+        Args:
+            timepoints (bool): the timepoint tables, as Cluster.acc_df. If
+                False, the patient pages' accession listing, as
+                Cluster.accession_list_df.
+        """
+        patients = list(self.patients.values())
+        load = (lambda p: p.accession_df) if timepoints else (lambda p: p.accession_list)
+        with profiling.span('Network.accessions', 'build', seed=self.seed, timepoints=timepoints):
+            if self.max_workers and self.max_workers > 1 and len(patients) > 1:
+                with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+                    tables = list(pool.map(load, patients))
+            else:
+                tables = [load(p) for p in patients]
+        if timepoints:
+            return _concat_results(tables)
+        rows = [(p.patient_id, accession_id, se_id) for p, table in zip(patients, tables)
+                for accession_id, se_id in table]
+        return pd.DataFrame(rows, columns=['patient_id', 'accession_id', 'blast_ssam_se_id'])
+
+    def to_graphml(self, path):
+        """Write the network as an undirected GraphML graph."""
+        ns = 'http://graphml.graphdrawing.org/xmlns'
+        root = ET.Element('graphml', xmlns=ns)
+        for key, target, name, type_ in (('d0', 'node', 'kind', 'string'), ('d1', 'node', 'id', 'long'),
+                                         ('d2', 'node', 'label', 'string'), ('d3', 'node', 'depth', 'int'),
+                                         ('d4', 'edge', 'patient_code', 'string')):
+            ET.SubElement(root, 'key', {'id': key, 'for': target, 'attr.name': name, 'attr.type': type_})
+        graph = ET.SubElement(root, 'graph', id='cluster_{}'.format(self.seed), edgedefault='undirected')
+        for row in self.nodes_df.itertuples(index=False):
+            node = ET.SubElement(graph, 'node', id=row.node)
+            for key, value in (('d0', row.kind), ('d1', row.id), ('d2', row.label), ('d3', row.depth)):
+                if value is not None:
+                    ET.SubElement(node, 'data', key=key).text = str(value)
+        for row in self.edges_df.itertuples(index=False):
+            edge = ET.SubElement(graph, 'edge', source=row.source, target=row.target)
+            ET.SubElement(edge, 'data', key='d4').text = str(row.patient_code)
+        ET.ElementTree(root).write(path, encoding='utf-8', xml_declaration=True)
+        return path
+
+
+def expand_network(cluster_id, depth=1, max_clusters=None, max_patients=None, client=None, max_workers=4,
+                   registry=None, engine='html'):
+    """Breadth-first expansion over cluster -> patients -> clusters links.
+
+    Level 0 is the seed cluster. Each level fetches the pages of its new
+    clusters, then the pages of the patients they list. Clusters those
+    patients also belong to form the next level. Within a level, new ids are
+    taken in ascending order, so limits cut the same nodes on every run.
+
+    Args:
+        cluster_id (int): seed cluster id.
+        depth (int): patient hops to follow; 0 gives the seed cluster alone.
+        max_clusters, max_patients (int): stop adding clusters or patients
+            beyond these counts. None for no limit.
+        client (HivClient): HTTP client to use. Defaults to the shared client.
+        max_workers (int): pages fetched concurrently.
+        registry (PatientRegistry): patient registry to use. Defaults to the
+            process-wide registry.
+        engine (str): 'html' or 'download', how timepoint tables are fetched.
+
+    Returns:
+        network (Network): clusters and patients found, with timepoint
+            tables still to be fetched (see Network.accession_df).
+    """
+    client = client or get_default_client()
+    registry = registry if registry is not None else get_patient_registry()
+    network = Network(cluster_id)
+    network.max_workers = max_workers
+    start = time.perf_counter()
+    frontier = [cluster_id]
+    level = 0
+    with profiling.span('network', 'build', seed=cluster_id, depth=depth), \
+            ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while frontier:
+            clusters = list(pool.map(lambda i: Cluster(i, client=client, registry=registry, engine=engine),
+                                     frontier))
+            new_patients = []
+            for cluster in clusters:
+                network.clusters[cluster.cluster_id] = cluster
+                network.depths[cluster_node(cluster.cluster_id)] = level
+                for patient_id, patient in cluster.patient_dict.items():
+                    if patient_id in network.patients:
+                        continue
+                    if max_patients is not None and len(network.patients) >= max_patients:
+                        network.truncated = True
+                        continue
+                    network.patients[patient_id] = patient
+                    network.depths[patient_node(patient_id)] = level
+                    new_patients.append(patient)
+            _logger.info("Depth %d: %d clusters, %d new patients", level, len(clusters), len(new_patients))
+            linked = {i for patient in pool.map(lambda p: p._load_info(), new_patients)
+                      for _, i in patient['clusters']}
+            linked = sorted(linked.difference(network.clusters))
+            if level >= depth:
+                network.truncated = network.truncated or bool(linked)
+                break
+            if max_clusters is not None and len(network.clusters) + len(linked) > max_clusters:
+                network.truncated = True
+                linked = linked[:max(0, max_clusters - len(network.clusters))]
+            frontier = linked
+            level += 1
+    network.seconds = time.perf_counter() - start
+    return network
+
+
+def write_network(network, stem, fmt='tsv', timepoints=True):
+    """Write GraphML and node, edge and accession tables for a network.
+
+    Args:
+        network (Network): as returned by expand_network.
+        stem (str): output path prefix, e.g. 'network_684'.
+        fmt (str): table format, one of export.FORMATS.
+        timepoints (bool): see Network.accession_df.
+
+    Returns:
+        paths (dict): 'graphml', 'nodes', 'edges' and 'accessions' -> path written.
+    """
+    directory = os.path.dirname(stem)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    return {
+        'graphml': network.to_graphml(stem + '.graphml'),
+        'nodes': write_table(network.nodes_df, stem + '_nodes', fmt),
+        'edges': write_table(network.edges_df, stem + '_edges', fmt),
+        'accessions': write_table(network.accession_df(timepoints), stem + '_accessions', fmt),
+    }
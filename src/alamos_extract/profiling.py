@@ -0,0 +1,192 @@
+"""Per-stage timing and request tracing.
+
+Fetches, parses, table builds, post-processing, concatenation and the
+Cluster/Patient constructors are wrapped in named spans. While a
+:class:`Profiler` is enabled, each span records its wall time, thread and
+details such as bytes transferred and HTTP status; result pages are recorded
+as instant events. The timeline can be written as a Chrome trace (open it in
+chrome://tracing or https://ui.perfetto.dev) and summarised per stage.
+
+While no profiler is enabled, :func:`span` returns a shared no-op context
+manager, so instrumented code pays only a global lookup and a call.
+"""
+
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter, OrderedDict
+
+__author__ = "Stephen Gaffney"
+__copyright__ = "Stephen Gaffney"
+__license__ = "gpl3"
+
+_logger = logging.getLogger(__name__)
+
+
+class _Span:
+    __slots__ = ('profiler', 'name', 'cat', 'args', 'start')
+
+    def __init__(self, profiler, name, cat, args):
+        self.profiler = profiler
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def set(self, **args):
+        """Add details, e.g. bytes or status, to the span."""
+        self.args.update(args)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter()
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        self.profiler.add(self.name, self.cat, self.start, end - self.start, self.args)
+        return False
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def set(self, **args):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Profiler:
+    """Collects spans and instant events from all threads."""
+    def __init__(self):
+        self.events = []  # (name, cat, start, duration or None for instants, thread, args)
+        self._lock = threading.Lock()
+        self._t0 = time.perf_counter()
+        self._threads = {}
+
+    def span(self, name, cat, **args):
+        return _Span(self, name, cat, args)
+
+    def instant(self, name, cat, **args):
+        self.add(name, cat, time.perf_counter(), None, args)
+
+    def add(self, name, cat, start, duration, args):
+        thread = threading.get_ident()
+        with self._lock:
+            tid = self._threads.setdefault(thread, len(self._threads) + 1)
+            self.events.append((name, cat, start, duration, tid, args))
+
+    def chrome_trace(self):
+        """Events in Chrome trace event format, as a dict."""
+        pid = os.getpid()
+        trace = []
+        with self._lock:
+            events = list(self.events)
+        for name, cat, start, duration, tid, args in events:
+            event = {'name': name, 'cat': cat, 'ts': round((start - self._t0) * 1e6, 1),
+                     'pid': pid, 'tid': tid, 'args': args}
+            if duration is None:
+                event.update(ph='i', s='t')
+            else:
+                event.update(ph='X', dur=round(duration * 1e6, 1))
+            trace.append(event)
+        return {'traceEvents': trace, 'displayTimeUnit': 'ms'}
+
+    def write(self, path):
+        """Write the Chrome trace JSON to path."""
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+        _logger.info("Profile with %d events written to %s", len(self.events), path)
+
+    def summary(self):
+        """Totals per stage, in order of first occurrence.
+
+        Returns:
+            stages (OrderedDict): name -> dict of category, calls, seconds,
+                max_seconds, bytes and status (Counter of HTTP status codes).
+        """
+        stages = OrderedDict()
+        with self._lock:
+            events = list(self.events)
+        for name, cat, _, duration, _, args in events:
+            stage = stages.setdefault(name, {'cat': cat, 'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0,
+                                             'bytes': 0, 'status': Counter()})
+            stage['calls'] += 1
+            if duration is not None:
+                stage['seconds'] += duration
+                stage['max_seconds'] = max(stage['max_seconds'], duration)
+            stage['bytes'] += args.get('bytes', 0)
+            if 'status' in args:
+                stage['status'][args['status']] += 1
+        return stages
+
+    def format_summary(self):
+        """Summary as a text table. Nested stages overlap, so times don't add up."""
+        lines = ['{:<28} {:<8} {:>7} {:>10} {:>10} {:>10} {:>12}  {}'.format(
+            'stage', 'category', 'calls', 'total s', 'mean ms', 'max ms', 'bytes', 'status')]
+        for name, s in self.summary().items():
+            mean_ms = 1000 * s['seconds'] / s['calls']
+            status = ' '.join('{}x{}'.format(n, code) for code, n in sorted(s['status'].items()))
+            lines.append('{:<28} {:<8} {:>7} {:>10.3f} {:>10.2f} {:>10.2f} {:>12}  {}'.format(
+                name, s['cat'], s['calls'], s['seconds'], mean_ms, 1000 * s['max_seconds'],
+                s['bytes'] or '', status))
+        return '\n'.join(lines)
+
+
+_profiler = None
+
+
+def enable(profiler=None):
+    """Start recording into profiler (default: a new Profiler) and return it."""
+    global _profiler
+    _profiler = profiler or Profiler()
+    return _profiler
+
+
+def disable():
+    """Stop recording and return the profiler that was enabled, if any."""
+    global _profiler
+    profiler, _profiler = _profiler, None
+    return profiler
+
+
+def span(name, cat, **args):
+    """Context manager timing a stage while profiling is enabled."""
+    profiler = _profiler
+    if profiler is None:
+        return _NULL_SPAN
+    return profiler.span(name, cat, **args)
+
+
+def instant(name, cat, **args):
+    """Record a point event, e.g. a result page, while profiling is enabled."""
+    profiler = _profiler
+    if profiler is not None:
+        profiler.instant(name, cat, **args)
+
+
+def traced(cat, name=None):
+    """Decorator running the function in a span named after it."""
+    def decorator(func):
+        span_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            profiler = _profiler
+            if profiler is None:
+                return func(*args, **kwargs)
+            with profiler.span(span_name, cat):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,239 @@
+"""Client-side rate limiting and adaptive concurrency for HIV Database requests.
+
+A :class:`RateLimiter` holds one :class:`Throttle` for all requests and
+optionally one per endpoint (``cluster.comp``, ``patient.comp``,
+``search.comp``, ``d_search.comp``). A request must get a slot from its
+endpoint's throttle and from the global one before it is sent.
+
+Each throttle combines an optional token bucket, capping requests per
+second, with an AIMD (additive increase, multiplicative decrease) limit on
+requests in flight. The limit grows by about one per round of requests while
+latency stays near the best seen, and is cut on 429 and 5xx responses and on
+timeouts or connection errors. A Retry-After header pauses new requests for
+the time the server asks.
+"""
+
+import logging
+import threading
+import time
+from urllib.parse import urlsplit
+
+__author__ = "Stephen Gaffney"
+__copyright__ = "Stephen Gaffney"
+__license__ = "gpl3"
+
+_logger = logging.getLogger(__name__)
+
+ENDPOINTS = ('cluster.comp', 'patient.comp', 'search.comp', 'd_search.comp')
+OVERLOAD_STATUSES = (429, 500, 502, 503, 504)
+MIN_BACKOFF_INTERVAL = 0.05  # seconds
+
+
+class TokenBucket:
+    """Allow rate acquisitions per second on average, in bursts of up to burst."""
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1.0, rate)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, sleeping until one is available."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class Throttle:
+    """Token bucket plus AIMD limit on requests in flight.
+
+    Args:
+        rate (float): maximum requests per second, or None for no cap.
+        burst (float): token bucket size (default: one second of rate).
+        initial_concurrency (int): starting in-flight limit.
+        min_concurrency, max_concurrency (int): bounds for the in-flight limit.
+        latency_tolerance (float): the limit only grows while latency is within
+            this multiple of the lowest latency seen.
+        decrease (float): factor applied to the limit on overload.
+
+    Attributes:
+        limit (float): current in-flight limit; int(limit) requests may run.
+        n_backoffs (int): number of times the limit was cut.
+    """
+    def __init__(self, rate=None, burst=None, initial_concurrency=4, min_concurrency=1, max_concurrency=16,
+                 latency_tolerance=2.0, decrease=0.5):
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.limit = float(min(max(initial_concurrency, min_concurrency), max_concurrency))
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.latency_tolerance = latency_tolerance
+        self.decrease = decrease
+        self.in_flight = 0
+        self.n_backoffs = 0
+        self._baseline = None
+        self._smoothed = None
+        self._last_decrease = float('-inf')
+        self._paused_until = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """Wait for an in-flight slot (and a token, if rate limited)."""
+        with self._cond:
+            while True:
+                pause = self._paused_until - time.monotonic()
+                if pause > 0:
+                    self._cond.wait(pause)
+                elif self.in_flight < int(self.limit):
+                    break
+                else:
+                    self._cond.wait()
+            self.in_flight += 1
+        if self.bucket is not None:
+            self.bucket.acquire()
+
+    def release(self, latency=None, overloaded=False, retry_after=None):
+        """Free a slot, adjusting the limit from the request's outcome."""
+        with self._cond:
+            self.in_flight -= 1
+            if overloaded:
+                self._backoff(retry_after)
+            elif latency is not None:
+                self._grow(latency)
+            self._cond.notify_all()
+
+    def backoff(self, retry_after=None):
+        """Cut the limit, and pause for retry_after seconds if given."""
+        with self._cond:
+            self._backoff(retry_after)
+            self._cond.notify_all()
+
+    def _backoff(self, retry_after):
+        now = time.monotonic()
+        if retry_after:
+            self._paused_until = max(self._paused_until, now + retry_after)
+        # requests in flight together fail together: cut once per round trip
+        if now - self._last_decrease >= max(self._smoothed or 0.0, MIN_BACKOFF_INTERVAL):
+            self.limit = max(self.min_concurrency, self.limit * self.decrease)
+            self._last_decrease = now
+            self.n_backoffs += 1
+            _logger.debug("Backing off to %d requests in flight", int(self.limit))
+
+    def _grow(self, latency):
+        self._smoothed = latency if self._smoothed is None else 0.8 * self._smoothed + 0.2 * latency
+        if self._baseline is None or latency < self._baseline:
+            self._baseline = latency
+        else:
+            # let the baseline follow slow drifts in server speed
+            self._baseline += 0.01 * (latency - self._baseline)
+        if latency <= self.latency_tolerance * self._baseline:
+            self.limit = min(self.max_concurrency, self.limit + 1.0 / self.limit)
+
+    def stats(self):
+        with self._cond:
+            return {'limit': int(self.limit), 'in_flight': self.in_flight, 'backoffs': self.n_backoffs,
+                    'latency': self._smoothed}
+
+
+class RateLimiter:
+    """Global and per-endpoint throttles for HivClient requests.
+
+    Args:
+        rate, burst, initial_concurrency, min_concurrency, max_concurrency:
+            settings of the global Throttle.
+        endpoints (dict): endpoint name (e.g. 'search.comp') -> dict of
+            Throttle keyword arguments for requests to that endpoint.
+
+    Example:
+        >>> limiter = RateLimiter(rate=10, endpoints={'search.comp': {'rate': 1, 'max_concurrency': 2}})
+        >>> client = HivClient(limiter=limiter)
+    """
+    def __init__(self, rate=None, burst=None, initial_concurrency=4, min_concurrency=1, max_concurrency=16,
+                 endpoints=None):
+        self.throttle = Throttle(rate, burst, initial_concurrency, min_concurrency, max_concurrency)
+        self.endpoints = {name: Throttle(**kwargs) for name, kwargs in (endpoints or {}).items()}
+
+    def throttles(self, url):
+        """Throttles a request to url must pass, endpoint first."""
+        endpoint = self.endpoints.get(_endpoint(url))
+        return [self.throttle] if endpoint is None else [endpoint, self.throttle]
+
+    def slot(self, url):
+        """Context manager holding a request slot for url.
+
+        Call done() on the returned slot with the response status and
+        Retry-After header. OSErrors raised inside (including requests'
+        timeouts and connection errors) count as overload.
+        """
+        return _Slot(self.throttles(url))
+
+    def backoff(self, url, retry_after=None):
+        """Report an overload signal for url, e.g. a response about to be retried."""
+        for throttle in self.throttles(url):
+            throttle.backoff(retry_after)
+
+    def stats(self):
+        """Current limit, requests in flight, backoffs and smoothed latency per throttle."""
+        stats = {'global': self.throttle.stats()}
+        for name, throttle in self.endpoints.items():
+            stats[name] = throttle.stats()
+        return stats
+
+
+class _Slot:
+    def __init__(self, throttles):
+        self.throttles = throttles
+        self.overloaded = False
+        self.retry_after = None
+
+    def done(self, status, retry_after=None):
+        if status in OVERLOAD_STATUSES:
+            self.overloaded = True
+            self.retry_after = parse_retry_after(retry_after)
+
+    def __enter__(self):
+        acquired = []
+        try:
+            for throttle in self.throttles:
+                throttle.acquire()
+                acquired.append(throttle)
+        except BaseException:
+            for throttle in acquired:
+                throttle.release()
+            raise
+        self._start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        latency = time.monotonic() - self._start
+        overloaded = self.overloaded or (exc_type is not None and issubclass(exc_type, OSError))
+        for throttle in self.throttles:
+            throttle.release(None if exc_type else latency, overloaded, self.retry_after)
+        return False
+
+
+def _endpoint(url):
+    return urlsplit(url).path.rsplit('/', 1)[-1]
+
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header value (seconds or HTTP date), or None."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    import email.utils
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
@@ -0,0 +1,121 @@
+"""Process-wide memo of downloaded patient data shared between clusters.
+
+Patients often belong to several clusters. :class:`Cluster` asks the registry
+for each patient's info and timepoint tables, so a patient shared by
+overlapping clusters is downloaded once per process. Concurrent builds asking
+for the same patient while it is being fetched wait for that one fetch
+(single-flight) instead of starting their own.
+"""
+
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+__author__ = "Stephen Gaffney"
+__copyright__ = "Stephen Gaffney"
+__license__ = "gpl3"
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_MAXSIZE = 1024
+
+
+class PatientRegistry:
+    """Size-bounded LRU of loaded values with single-flight loading.
+
+    Args:
+        maxsize (int): number of entries kept. 0 keeps nothing, but still
+            coalesces concurrent loads of the same key.
+
+    Attributes:
+        hits (int): lookups answered from the registry.
+        misses (int): lookups that ran the loader.
+        coalesced (int): lookups that waited for another thread's load.
+    """
+    def __init__(self, maxsize=DEFAULT_MAXSIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, loader, refresh=False):
+        """Value for key, calling loader() if it is not held or being loaded.
+
+        Args:
+            key: hashable registry key.
+            loader (callable): returns the value for key. Exceptions are raised
+                to the caller and to every waiting caller, and nothing is stored.
+            refresh (bool): ignore a held value and load again.
+        """
+        with self._lock:
+            if not refresh and key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = Future()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+        if not owner:
+            return future.result()
+        try:
+            value = loader()
+        except BaseException as e:
+            with self._lock:
+                del self._inflight[key]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            del self._inflight[key]
+            if self.maxsize > 0:
+                self._entries[key] = value
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+        future.set_result(value)
+        return value
+
+    def stats(self):
+        """Counters and current size, as a dict."""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'coalesced': self.coalesced,
+                    'size': len(self._entries)}
+
+    def clear(self):
+        """Drop all held values and reset counters."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.coalesced = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+
+_default_registry = None
+_default_lock = threading.Lock()
+
+
+def get_patient_registry():
+    """Get the process-wide registry used by Cluster when none is passed."""
+    global _default_registry
+    with _default_lock:
+        if _default_registry is None:
+            _default_registry = PatientRegistry()
+        return _default_registry
+
+
+def set_patient_registry(registry):
+    """Replace the process-wide registry, e.g. with a different maxsize."""
+    global _default_registry
+    with _default_lock:
+        _default_registry = registry
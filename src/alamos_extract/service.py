@@ -0,0 +1,279 @@
+"""Local HTTP/JSON lookup service with coalescing and warm caches (load_hiv serve).
+
+:class:`LookupService` answers cluster, cluster name, patient and search
+lookups with JSON bodies. Bodies are held in memory in a
+:class:`~alamos_extract.registry.PatientRegistry`, an LRU with single-flight
+loading, so identical concurrent lookups share one scrape. They are also
+written to a disk cache under the response cache directory, so a restarted
+service answers from disk without re-parsing pages. Page downloads go
+through the client's own response cache as usual.
+
+Entries looked up at least ``hot_hits`` times since they were loaded are
+reloaded in the background once they are ``refresh_after`` seconds old,
+from a client that re-downloads pages, so hot entries stay current without
+a caller waiting on the scrape.
+
+Routes (GET):
+    /cluster/<cluster_id>
+    /cluster?name=<cluster name>
+    /patient/<patient_id>
+    /search?virus=HIV-1&subtype=B&region=gp120&max_rec=100  (form_dicts choice names)
+    /stats
+"""
+
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import requests
+
+from alamos_extract.cache import request_key
+from alamos_extract.form_dicts import region_dict, subtype_dict, virus_dict
+from alamos_extract.load_data import Cluster, Patient, search_db
+from alamos_extract.registry import PatientRegistry
+
+__author__ = "Stephen Gaffney"
+__copyright__ = "Stephen Gaffney"
+__license__ = "gpl3"
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_PORT = 8707
+KINDS = ('cluster', 'cluster_name', 'patient', 'search')
+
+
+class LookupService:
+    """Cached, coalesced JSON lookups of clusters, patients and searches.
+
+    Args:
+        client (HivClient): client for lookups.
+        refresh_client (HivClient): client for background refreshes, which
+            should re-download pages (refresh=True). Defaults to client.
+        maxsize (int): bodies held in memory.
+        disk_cache (ResponseCache): store for bodies across restarts, or None.
+        refresh_after (float): seconds after which a hot entry is reloaded.
+        hot_hits (int): lookups since loading that make an entry hot.
+        max_workers (int): patient pages fetched concurrently per cluster.
+        engine (str): 'html' or 'download', see load_data.search_db.
+    """
+    def __init__(self, client, refresh_client=None, maxsize=256, disk_cache=None, refresh_after=3600,
+                 hot_hits=2, max_workers=4, engine='html'):
+        self.client = client
+        self.refresh_client = refresh_client or client
+        self.memory = PatientRegistry(maxsize=maxsize)
+        self.disk_cache = disk_cache
+        self.refresh_after = refresh_after
+        self.hot_hits = hot_hits
+        self.max_workers = max_workers
+        self.engine = engine
+        self.n_disk_hits = 0
+        self.n_refreshed = 0
+        self._usage = {}  # key -> [loaded at, lookups since]
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._refresher = None
+
+    def lookup(self, kind, *params):
+        """JSON body (bytes) for a lookup, e.g. lookup('cluster', 701).
+
+        Raises:
+            ValueError: unknown kind or invalid parameters.
+            requests.HTTPError: the database answered with an error.
+        """
+        if kind not in KINDS:
+            raise ValueError("Unknown lookup {!r}".format(kind))
+        key = (kind,) + params
+        body = self.memory.get(key, lambda: self._load_cached(key))
+        with self._lock:
+            usage = self._usage.setdefault(key, [time.monotonic(), 0])
+            usage[1] += 1
+        return body
+
+    def _load_cached(self, key):
+        if self.disk_cache is not None:
+            body = self.disk_cache.get(_disk_key(key))
+            if body is not None:
+                with self._lock:
+                    self.n_disk_hits += 1
+                return body
+        return self._load(key, self.client)
+
+    def _load(self, key, client):
+        kind, params = key[0], key[1:]
+        start = time.perf_counter()
+        result = getattr(self, '_' + kind)(client, *params)
+        body = json.dumps(result, separators=(',', ':')).encode('utf8')
+        _logger.info("Loaded %s %s in %.2f s", kind, params, time.perf_counter() - start)
+        if self.disk_cache is not None:
+            self.disk_cache.set(_disk_key(key), body)
+        with self._lock:
+            self._usage[key] = [time.monotonic(), 0]
+        return body
+
+    def _cluster(self, client, cluster_id):
+        c = Cluster(cluster_id, client=client, max_workers=self.max_workers, registry=_registry(client),
+                    engine=self.engine).load()
+        patients = c.desc_df.T
+        patients.index.name = 'patient_id'
+        return {'cluster_id': c.cluster_id, 'cluster_name': c.cluster_name, 'description': c.description,
+                'patients': _records(patients.reset_index()), 'accessions': _records(c.acc_df)}
+
+    def _cluster_name(self, client, cluster_name):
+        df = search_db(max_rec=100, virus=virus_dict['HIV-1'], subtype=subtype_dict['any'], region=None,
+                       cluster_name=cluster_name, client=client, engine=self.engine)
+        return {'cluster_name': cluster_name, 'sequences': _records(df.drop(columns=['blast', 'blast2']))}
+
+    def _patient(self, client, patient_id):
+        p = Patient(patient_id, client=client, registry=_registry(client), engine=self.engine)
+        return {'patient_id': patient_id, 'desc': json.loads(p.desc.to_json()),
+                'clusters': [{'cluster_name': name, 'cluster_id': i} for name, i in p.clusters],
+                'accessions': _records(p.accession_df)}
+
+    def _search(self, client, virus, subtype, region, max_rec):
+        df = search_db(max_rec=max_rec, virus=virus_dict[virus], subtype=subtype_dict[subtype],
+                       region=region_dict[region], client=client, engine=self.engine)
+        return {'virus': virus, 'subtype': subtype, 'region': region, 'max_rec': max_rec,
+                'sequences': _records(df.drop(columns=['blast', 'blast2']))}
+
+    def refresh_hot(self):
+        """Reload entries that are hot and older than refresh_after. Returns the number reloaded."""
+        now = time.monotonic()
+        with self._lock:
+            for key in [k for k in self._usage if k not in self.memory]:
+                del self._usage[key]  # evicted from memory
+            due = [k for k, (loaded, hits) in self._usage.items()
+                   if hits >= self.hot_hits and now - loaded >= self.refresh_after]
+        n = 0
+        for key in due:
+            try:
+                self.memory.get(key, lambda: self._load(key, self.refresh_client), refresh=True)
+            except Exception as e:
+                _logger.warning("Background refresh of %s failed: %r", key, e)
+                continue
+            n += 1
+        with self._lock:
+            self.n_refreshed += n
+        return n
+
+    def start_refresher(self, interval=60):
+        """Run refresh_hot every interval seconds on a daemon thread."""
+        def loop():
+            while not self._stop.wait(interval):
+                self.refresh_hot()
+        self._refresher = threading.Thread(target=loop, name='lookup-refresh', daemon=True)
+        self._refresher.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self):
+        """Memory cache counters, disk hits, refreshes and client request counts."""
+        stats = self.memory.stats()
+        with self._lock:
+            stats.update(disk_hits=self.n_disk_hits, refreshed=self.n_refreshed)
+        stats.update(requests=self.client.n_requests, page_cache_hits=self.client.n_cache_hits)
+        return stats
+
+
+def _registry(client):
+    # refreshes must not be answered from the shared patient registry
+    return PatientRegistry(maxsize=0) if client.refresh else None
+
+
+def _records(df):
+    return json.loads(df.to_json(orient='records'))
+
+
+def _disk_key(key):
+    return request_key('lookup:' + '/'.join(map(str, key)))
+
+
+class LookupHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        _logger.debug("%s - %s", self.address_string(), format % args)
+
+    def do_GET(self):
+        service = self.server.service
+        parts = urlsplit(self.path)
+        path = [p for p in parts.path.split('/') if p]
+        query = {k: v[-1] for k, v in parse_qs(parts.query).items()}
+        stats = path == ['stats']
+        try:
+            args = None if stats else _route(path, query)
+        except (ValueError, KeyError) as e:
+            return self._send(400, _error('Bad request: {}'.format(e)))
+        if args is None and not stats:
+            return self._send(404, _error('Unknown route {}'.format(parts.path)))
+        # only a malformed request is the client's fault; lookup errors are ours
+        try:
+            body = json.dumps(service.stats()).encode('utf8') if stats else service.lookup(*args)
+        except requests.HTTPError as e:
+            status = e.response.status_code if e.response is not None else None
+            return self._send(404 if status == 404 else 502, _error('Database error: {}'.format(e)))
+        except Exception as e:
+            _logger.exception("Lookup %s failed", self.path)
+            return self._send(500, _error(repr(e)))
+        self._send(200, body)
+
+    def _send(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def _route(path, query):
+    """Lookup arguments for a request path and query, or None for an unknown route."""
+    if path[:1] == ['cluster'] and len(path) == 2:
+        return 'cluster', int(path[1])
+    if path == ['cluster'] and 'name' in query:
+        return 'cluster_name', query['name']
+    if path[:1] == ['patient'] and len(path) == 2:
+        return 'patient', int(path[1])
+    if path == ['search']:
+        virus, subtype, region = (query.get('virus', 'HIV-1'), query.get('subtype', 'any'),
+                                  query.get('region', 'any'))
+        for name, choices in ((virus, virus_dict), (subtype, subtype_dict), (region, region_dict)):
+            if name not in choices:
+                raise ValueError("unknown choice {!r}".format(name))
+        return 'search', virus, subtype, region, int(query.get('max_rec', 100))
+    return None
+
+
+def _error(message):
+    return json.dumps({'error': message}).encode('utf8')
+
+
+class LookupServer(ThreadingHTTPServer):
+    """Threaded HTTP server for a LookupService, usable as a context manager.
+
+    Args:
+        service (LookupService): lookups to serve.
+        host, port: address to listen on; port 0 picks a free port.
+    """
+    daemon_threads = True
+
+    def __init__(self, service, host='127.0.0.1', port=DEFAULT_PORT):
+        super().__init__((host, port), LookupHandler)
+        self.service = service
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://{}:{}/'.format(*self.server_address[:2])
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.service.stop()
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,355 @@
+"""Single-pass lxml extraction of HIV Database pages.
+
+The bs4 parsers in :mod:`alamos_extract.load_data` build a soup, serialise
+tables back to HTML for :func:`pandas.read_html` and then search the soup
+again for links. The functions here parse each page once with lxml, read
+cell text and link attributes from the same tree, and build DataFrames with
+the same text normalisation and type inference as read_html.
+
+Type inference uses pandas' TextParser, the parser behind read_html, which is
+not public API. Outside the pandas versions it has been checked against,
+tables are rebuilt as plain HTML and handed to read_html instead.
+"""
+
+import html
+import logging
+import re
+from collections import OrderedDict
+from io import StringIO
+
+import lxml.etree
+import lxml.html
+import pandas as pd
+from pandas.errors import EmptyDataError
+
+try:
+    from pandas.io.parsers import TextParser
+except ImportError:
+    TextParser = None
+
+from alamos_extract.profiling import traced
+
+__author__ = "Stephen Gaffney"
+__copyright__ = "Stephen Gaffney"
+__license__ = "gpl3"
+
+_logger = logging.getLogger(__name__)
+
+# pandas versions whose TextParser gives read_html's results (tests/test_tables.py)
+TEXT_PARSER_PANDAS = ((1, 2), (4, 0))
+
+# same whitespace normalisation as pandas.read_html
+_RE_WHITESPACE = re.compile(r"[\r\n]+|\s{2,}")
+_RE_ANY_TEXT = re.compile(r".+")
+_RE_PATIENT_LINK = re.compile('patient.comp')
+_RE_PATIENT_ID = re.compile(r"patient.comp\?pat_id=(\d+)")
+_RE_SE_ID = re.compile(r"query_one.comp\?se_id=(\d+)")
+_RE_CLUSTER_LINK = re.compile('cluster.comp')
+_RE_CLUSTER_ID = re.compile(r"clu_id=(\d+)")
+_RE_PATIENT_SE_ID = re.compile(r"se_id=(\d+)")
+
+_PARSER = lxml.html.HTMLParser(encoding='utf-8')
+
+
+def _pandas_version():
+    return tuple(int(part) for part in re.findall(r'\d+', pd.__version__)[:2])
+
+
+_USE_TEXT_PARSER = TextParser is not None and TEXT_PARSER_PANDAS[0] <= _pandas_version() < TEXT_PARSER_PANDAS[1]
+if not _USE_TEXT_PARSER:
+    _logger.warning("pandas %s is outside the versions checked for TextParser; tables go through read_html",
+                    pd.__version__)
+
+
+def parse_page(content):
+    """Parse raw page bytes into an lxml document."""
+    return lxml.html.document_fromstring(content, parser=_PARSER)
+
+
+def _cell_text(cell):
+    # itertext rather than text_content, so plain etree elements work too
+    return _RE_WHITESPACE.sub(" ", "".join(cell.itertext()).strip())
+
+
+def _drop_tree(elem):
+    """Remove elem and its children, keeping its tail text (lxml.html drop_tree)."""
+    parent = elem.getparent()
+    if elem.tail:
+        previous = elem.getprevious()
+        if previous is None:
+            parent.text = (parent.text or '') + elem.tail
+        else:
+            previous.tail = (previous.tail or '') + elem.tail
+    parent.remove(elem)
+
+
+def _drop_hidden(table):
+    """Remove elements that read_html ignores (displayed_only=True)."""
+    for elem in table.xpath(".//style"):
+        _drop_tree(elem)
+    for elem in table.xpath(".//*[@style]"):
+        if "display:none" in elem.attrib.get("style", "").replace(" ", ""):
+            _drop_tree(elem)
+
+
+def _row_texts(tr):
+    texts = []
+    for cell in tr.xpath('./td|./th'):
+        text = _cell_text(cell)
+        texts.extend([text] * int(cell.get('colspan') or 1))
+    return texts
+
+
+def _table_rows(table):
+    """Header and body text rows of table, as read_html splits them."""
+    head = table.xpath('./thead/tr')
+    body = table.xpath('./tbody/tr|./tr')
+    foot = table.xpath('./tfoot/tr')
+    if not head:
+        while body and all(c.tag == 'th' for c in body[0].xpath('./td|./th')):
+            head.append(body.pop(0))
+
+    return [_row_texts(tr) for tr in head], [_row_texts(tr) for tr in body + foot]
+
+
+def frame_from_table(table):
+    """DataFrame equal to pandas.read_html(StringIO(str(table)))[0].
+
+    Raises:
+        EmptyDataError: table has no rows.
+    """
+    _drop_hidden(table)
+    head, body = _table_rows(table)
+    return frame_from_rows(head, body)
+
+
+@traced('table')
+def frame_from_rows(head, body):
+    """Build DataFrame from header and body text rows as read_html does.
+
+    Raises:
+        EmptyDataError: no rows.
+    """
+    header = None
+    if head:
+        body = head + body
+        header = 0 if len(head) == 1 else [i for i, row in enumerate(head) if any(row)]
+    if not body:
+        raise EmptyDataError("Table has no rows")
+    width = max(len(row) for row in body)
+    body = [row + [''] * (width - len(row)) for row in body]
+    if not _USE_TEXT_PARSER:
+        return _read_html_rows(body, len(head) if head else 0)
+    with TextParser(body, header=header, skiprows=0, thousands=',', decimal='.',
+                    keep_default_na=True, parse_dates=False) as parser:
+        return parser.read()
+
+
+def _read_html_rows(rows, n_head):
+    """frame_from_rows by way of read_html, for rows of cell text, the first n_head of them headers."""
+    def tr(row):
+        return '<tr>{}</tr>'.format(''.join('<td>{}</td>'.format(html.escape(text)) for text in row))
+
+    table = '<table><thead>{}</thead><tbody>{}</tbody></table>'.format(
+        ''.join(tr(row) for row in rows[:n_head]), ''.join(tr(row) for row in rows[n_head:]))
+    return pd.read_html(StringIO(table))[0]
+
+
+@traced('parse')
+def read_results_table(content):
+    """Extract the search results grid from a results page.
+
+    Returns:
+        df (pd.DataFrame): table cells as read_html would parse them.
+        ncbi (list): (img title, href) for each NCBI sequence viewer link.
+        blast_urls (list): href of each blast link.
+    """
+    doc = parse_page(content)
+    links = [e for e in doc.xpath('//*[@href]') if _RE_PATIENT_LINK.search(e.get('href'))]
+    tables = {id(_nearest_table(e)): _nearest_table(e) for e in links}
+    # Verify that there was only one such table
+    assert (len(tables) == 1), "Multiple table matches with accession links"
+    table = _nearest_table(links[0])
+    ncbi = []
+    blast_urls = []
+    for elem in table.xpath('.//*[@href]'):
+        href = elem.get('href')
+        if 'nuccore' in href:
+            img = elem.find('.//img')
+            ncbi.append((img.get('title'), href))
+        if elem.tag == 'a' and 'blast' in href:
+            blast_urls.append(href)
+    df = frame_from_table(table)
+    return df, ncbi, blast_urls
+
+
+def _nearest_table(elem):
+    return next(elem.iterancestors('table'))
+
+
+@traced('parse')
+def read_cluster_page(content):
+    """Cluster name, description, patients and accessions from cluster page content.
+
+    Same output as load_data._parse_cluster.
+    """
+    doc = parse_page(content)
+    main_table = [t for t in doc.iter('table') if 'Cluster Name' in t.text_content()]
+    assert len(main_table) == 1, 'Failed to find main table: multiple have cluster name field'
+    patients = OrderedDict()
+    seqs = OrderedDict()
+    for elem in doc.xpath('//*[@href]'):
+        href = elem.get('href')
+        match = _RE_PATIENT_ID.search(href)
+        if match:
+            patients[elem.text_content().strip()] = int(match.group(1))
+        match = _RE_SE_ID.search(href)
+        if match:
+            seqs[elem.text_content().strip()] = int(match.group(1))
+    df = frame_from_table(main_table[0])
+    df = df.set_index([0]).transpose()
+    return {
+        'cluster_name': df['Cluster Name'].iloc[0],
+        'description': df['Cluster Description'].iloc[0].strip(""" '" """),
+        'patients': patients,
+        'accessions': seqs,
+    }
+
+
+@traced('parse')
+def read_patient_page(content, patient_id):
+    """Patient description, accessions and clusters from patient page content.
+
+    Same output as load_data._parse_patient_info.
+    """
+    doc = parse_page(content)
+    accessions = []
+    clusters = []
+    for elem in doc.xpath('//*[@href]'):
+        href = elem.get('href')
+        if 'asearch/query_one' in href:
+            accessions.append((elem.text_content().strip(), int(_RE_PATIENT_SE_ID.findall(href)[0])))
+        if _RE_CLUSTER_LINK.search(href):
+            clusters.append((elem.text_content().strip(), int(_RE_CLUSTER_ID.findall(href)[0])))
+    # read_html(match='.+') keeps tables with text and skips empty ones
+    ptables = []
+    for table in doc.iter('table'):
+        if not any(_RE_ANY_TEXT.search(t) for t in table.itertext()):
+            continue
+        try:
+            ptables.append(frame_from_table(table))
+        except EmptyDataError:
+            continue
+        if len(ptables) == 2:
+            break
+    desc = ptables[1].iloc[:, :2]
+    desc = desc.rename(columns={0: 'var', 1: 'val'})
+    desc = desc.loc[:desc.query("var == 'Accession(s)'").index.values[0]-1].set_index('var')['val']
+    desc.name = patient_id
+
+    return {'desc': desc,
+            'accessions': accessions,
+            'clusters': clusters,
+            }
+
+
+class ResultsStreamParser:
+    """Incremental parser for results pages fed in chunks.
+
+    Rows are emitted as soon as their closing tag is parsed and are then
+    removed from the tree, so memory use does not grow with the number of
+    rows. Paging controls are picked up from the same stream.
+
+    Attributes:
+        head (list): leading all-<th> text rows of the results table.
+        pre_rows (list): other text rows before the first result row.
+        has_next, has_last (bool): Next/Last paging inputs seen.
+        page_id (str): server-side result id for requesting the next page.
+    """
+    def __init__(self):
+        self._parser = lxml.etree.HTMLPullParser(events=('end',), tag=('tr', 'input'),
+                                                 encoding='utf-8')
+        self._pending = {}  # table element -> [(is_all_th, texts)] before first result row
+        self._results_table = None
+        self.head = []
+        self.pre_rows = []
+        self.has_next = self.has_last = False
+        self.page_id = None
+
+    def feed(self, chunk):
+        """Parse chunk of page bytes.
+
+        Returns:
+            rows (list): (texts, ncbi, blast_urls) for each completed result
+                row, with ncbi and blast_urls as in read_results_table.
+        """
+        self._parser.feed(chunk)
+        return self._read_rows()
+
+    def close(self):
+        """Finish parsing and return any remaining rows."""
+        self._parser.close()
+        return self._read_rows()
+
+    def _read_rows(self):
+        rows = []
+        for _, elem in self._parser.read_events():
+            if elem.tag == 'input':
+                self._read_input(elem)
+                continue
+            if elem.find('.//table') is not None:
+                continue  # layout row around a nested table
+            table = elem.getparent()
+            if table is not None and table.tag in ('tbody', 'thead', 'tfoot'):
+                table = table.getparent()
+            row = self._read_row(elem)
+            if row is not None:
+                if self._results_table is None:
+                    self._results_table = table
+                    pre = self._pending.pop(table, [])
+                    while pre and pre[0][0]:
+                        self.head.append(pre.pop(0)[1])
+                    self.pre_rows = [texts for _, texts in pre]
+                    self._pending = {}
+                rows.append(row)
+            elif self._results_table is None and table is not None:
+                all_th = all(c.tag == 'th' for c in elem.xpath('./td|./th'))
+                _drop_hidden(elem)
+                self._pending.setdefault(table, []).append((all_th, _row_texts(elem)))
+            # free parsed rows
+            elem.clear()
+            parent = elem.getparent()
+            if parent is not None:
+                while elem.getprevious() is not None:
+                    del parent[0]
+        return rows
+
+    def _read_input(self, elem):
+        title = elem.get('title')
+        if title == 'Next':
+            self.has_next = True
+        elif title == 'Last':
+            self.has_last = True
+        if self.page_id is None and elem.get('name') == 'id':
+            self.page_id = elem.get('value')
+
+    def _read_row(self, tr):
+        """(texts, ncbi, blast_urls) if tr is a result row, else None."""
+        is_result = False
+        ncbi = []
+        blast_urls = []
+        for elem in tr.iter():
+            href = elem.get('href')
+            if href is None:
+                continue
+            if _RE_PATIENT_LINK.search(href):
+                is_result = True
+            if 'nuccore' in href:
+                img = elem.find('.//img')
+                ncbi.append((img.get('title'), href))
+            if elem.tag == 'a' and 'blast' in href:
+                blast_urls.append(href)
+        if not is_result:
+            return None
+        _drop_hidden(tr)
+        return _row_texts(tr), ncbi, blast_urls
@@ -0,0 +1,536 @@
+"""Local SQLite warehouse of clusters, patients and accessions.
+
+:func:`sync_clusters` and :func:`sync_search` download pages and upsert the
+parsed results into normalized tables. Only rows whose values changed are
+written, and rows that disappeared upstream are deleted. Cluster and patient
+pages whose table fingerprint matches the last sync are not parsed at all. :meth:`Cluster.from_warehouse
+<alamos_extract.load_data.Cluster.from_warehouse>` and :meth:`Patient.from_warehouse
+<alamos_extract.load_data.Patient.from_warehouse>` then rebuild objects from the
+warehouse without any HTTP requests.
+"""
+
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from alamos_extract.cache import request_key
+from alamos_extract.client import get_default_client
+from alamos_extract import tables
+from alamos_extract.load_data import (_TIMEPOINT_COLS, _apply_schema, _cluster_path, _concat_timepoint_pages,
+                                      _content_pager, _get_df_from_content, _page_fingerprint,
+                                      _patient_path, _search_form, _timepoints_path, search_db)
+
+__author__ = "Stephen Gaffney"
+__copyright__ = "Stephen Gaffney"
+__license__ = "gpl3"
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_PATH = 'alamos_extract.sqlite'
+
+# Results table columns, by SQL type. Tables store whichever of these a page has.
+_RESULT_INT_COLS = (
+    'patient_id', 'blast_ssam_se_id', 'sampling_year', 'days_from_first_sample',
+    'days_from_treatment_end', 'days_from_treatment_start', 'days_from_infection',
+    'days_from_seroconversion', 'seq_length', 'pos_start', 'pos_stop',
+)
+_RESULT_TEXT_COLS = (
+    'row_id', 'blast', 'patient_code', 'blast2', 'patient_comb', 'accession_id', 'accession',
+    'seq_name', 'subtype', 'country', 'fiebig_stage', 'cluster_comb', 'genomic_region',
+    'organism', 'pos', 'ncbi_url',
+)
+
+
+def _result_columns_sql():
+    return ',\n'.join(['{} INTEGER'.format(c) for c in _RESULT_INT_COLS] +
+                      ['{} TEXT'.format(c) for c in _RESULT_TEXT_COLS])
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS clusters (
+    cluster_id INTEGER PRIMARY KEY,
+    cluster_name TEXT,
+    description TEXT,
+    page_hash TEXT,
+    synced_at REAL
+);
+CREATE TABLE IF NOT EXISTS cluster_patients (
+    cluster_id INTEGER,
+    patient_id INTEGER,
+    patient_code TEXT,
+    position INTEGER,
+    PRIMARY KEY (cluster_id, patient_id)
+);
+CREATE TABLE IF NOT EXISTS cluster_accessions (
+    cluster_id INTEGER,
+    se_id INTEGER,
+    accession TEXT,
+    position INTEGER,
+    PRIMARY KEY (cluster_id, se_id)
+);
+CREATE TABLE IF NOT EXISTS patients (
+    patient_id INTEGER PRIMARY KEY,
+    description TEXT,
+    timepoint_columns TEXT,
+    page_hash TEXT,
+    synced_at REAL
+);
+CREATE TABLE IF NOT EXISTS patient_accessions (
+    patient_id INTEGER,
+    se_id INTEGER,
+    accession TEXT,
+    position INTEGER,
+    PRIMARY KEY (patient_id, se_id)
+);
+CREATE TABLE IF NOT EXISTS patient_clusters (
+    patient_id INTEGER,
+    cluster_id INTEGER,
+    cluster_name TEXT,
+    position INTEGER,
+    PRIMARY KEY (patient_id, cluster_id)
+);
+CREATE TABLE IF NOT EXISTS timepoints (
+    position INTEGER,
+    {result_columns},
+    PRIMARY KEY (blast_ssam_se_id)
+);
+CREATE TABLE IF NOT EXISTS searches (
+    query_key TEXT PRIMARY KEY,
+    params TEXT,
+    result_columns TEXT,
+    synced_at REAL
+);
+CREATE TABLE IF NOT EXISTS search_results (
+    query_key TEXT,
+    position INTEGER,
+    {result_columns},
+    PRIMARY KEY (query_key, position)
+);
+CREATE INDEX IF NOT EXISTS cluster_patients_patient ON cluster_patients (patient_id);
+CREATE INDEX IF NOT EXISTS cluster_accessions_se_id ON cluster_accessions (se_id);
+CREATE INDEX IF NOT EXISTS cluster_accessions_accession ON cluster_accessions (accession);
+CREATE INDEX IF NOT EXISTS patient_accessions_se_id ON patient_accessions (se_id);
+CREATE INDEX IF NOT EXISTS patient_accessions_accession ON patient_accessions (accession);
+CREATE INDEX IF NOT EXISTS patient_clusters_cluster ON patient_clusters (cluster_id);
+CREATE INDEX IF NOT EXISTS timepoints_patient ON timepoints (patient_id);
+CREATE INDEX IF NOT EXISTS timepoints_accession ON timepoints (accession_id);
+CREATE INDEX IF NOT EXISTS search_results_se_id ON search_results (blast_ssam_se_id);
+CREATE INDEX IF NOT EXISTS search_results_accession ON search_results (accession);
+""".format(result_columns=_result_columns_sql())
+
+# Columns added since the first schema version: (table, column, type)
+_ADDED_COLUMNS = (
+    ('clusters', 'page_hash', 'TEXT'),
+    ('patients', 'page_hash', 'TEXT'),
+)
+
+
+def _sql_value(value):
+    """Python value for SQLite from a DataFrame cell."""
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return None
+    if hasattr(value, 'item'):  # numpy scalar
+        return value.item()
+    return value
+
+
+class Warehouse:
+    """SQLite store of parsed cluster, patient and search results.
+
+    Args:
+        path (str): database file, created if missing.
+    """
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(_SCHEMA)
+        for table, column, type_ in _ADDED_COLUMNS:
+            columns = [row[1] for row in self.conn.execute('PRAGMA table_info({})'.format(table))]
+            if column not in columns:
+                self.conn.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(table, column, type_))
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # Writing
+
+    def _replace_rows(self, table, scope, key_cols, rows, counts):
+        """Make table's rows in scope equal rows, writing only what changed.
+
+        Args:
+            table (str): table name.
+            scope (dict): column values selecting the rows being replaced.
+            key_cols (tuple): primary key columns.
+            rows (list): dicts of column values, including scope columns.
+            counts (dict): table -> {'inserted', 'updated', 'deleted', 'unchanged'}
+                counters to add to.
+        """
+        where = ' AND '.join('{} = ?'.format(c) for c in scope)
+        existing = set(self.conn.execute('SELECT {} FROM {} WHERE {}'.format(
+            ', '.join(key_cols), table, where), tuple(scope.values())))
+        new_keys = set()
+        n_inserted = n_updated = 0
+        for row in rows:
+            key = tuple(row[c] for c in key_cols)
+            new_keys.add(key)
+            cols = list(row)
+            other = [c for c in cols if c not in key_cols]
+            sql = 'INSERT INTO {} ({}) VALUES ({}) ON CONFLICT ({}) DO '.format(
+                table, ', '.join(cols), ', '.join('?' * len(cols)), ', '.join(key_cols))
+            if other:
+                sql += 'UPDATE SET {} WHERE ({}) IS NOT ({})'.format(
+                    ', '.join('{0} = excluded.{0}'.format(c) for c in other),
+                    ', '.join('{}.{}'.format(table, c) for c in other),
+                    ', '.join('excluded.{}'.format(c) for c in other))
+            else:
+                sql += 'NOTHING'
+            changes = self.conn.total_changes
+            self.conn.execute(sql, [row[c] for c in cols])
+            if self.conn.total_changes > changes:
+                if key in existing:
+                    n_updated += 1
+                else:
+                    n_inserted += 1
+        stale = existing - new_keys
+        for key in stale:
+            self.conn.execute('DELETE FROM {} WHERE {}'.format(
+                table, ' AND '.join('{} = ?'.format(c) for c in key_cols)), key)
+        c = counts[table]
+        c['inserted'] += n_inserted
+        c['updated'] += n_updated
+        c['deleted'] += len(stale)
+        c['unchanged'] += len(rows) - n_inserted - n_updated
+
+    def store_cluster(self, cluster_id, data, counts=None, page_hash=None):
+        """Upsert cluster page data as returned by load_data.load_cluster."""
+        counts = counts if counts is not None else _new_counts()
+        with self._lock, self.conn:
+            self._replace_rows('clusters', {'cluster_id': cluster_id}, ('cluster_id',), [
+                {'cluster_id': cluster_id, 'cluster_name': data['cluster_name'],
+                 'description': data['description']}], counts)
+            self._replace_rows('cluster_patients', {'cluster_id': cluster_id}, ('cluster_id', 'patient_id'), [
+                {'cluster_id': cluster_id, 'patient_id': patient_id, 'patient_code': code, 'position': i}
+                for i, (code, patient_id) in enumerate(data['patients'].items())], counts)
+            self._replace_rows('cluster_accessions', {'cluster_id': cluster_id}, ('cluster_id', 'se_id'), [
+                {'cluster_id': cluster_id, 'se_id': se_id, 'accession': accession, 'position': i}
+                for i, (accession, se_id) in enumerate(data['accessions'].items())], counts)
+            self.conn.execute('UPDATE clusters SET synced_at = ?, page_hash = ? WHERE cluster_id = ?',
+                              (time.time(), page_hash, cluster_id))
+        return counts
+
+    def store_patient(self, patient_id, data, accession_df, counts=None, page_hash=None):
+        """Upsert patient info (see extract_patient_info) and timepoints table."""
+        counts = counts if counts is not None else _new_counts()
+        desc = data['desc']
+        description = json.dumps([[str(k), _sql_value(v)] for k, v in desc.items()])
+        with self._lock, self.conn:
+            self._replace_rows('patients', {'patient_id': patient_id}, ('patient_id',), [
+                {'patient_id': patient_id, 'description': description,
+                 'timepoint_columns': _columns_json(accession_df)}], counts)
+            self._replace_rows('patient_accessions', {'patient_id': patient_id}, ('patient_id', 'se_id'), [
+                {'patient_id': patient_id, 'se_id': se_id, 'accession': accession, 'position': i}
+                for i, (accession, se_id) in enumerate(data['accessions'])], counts)
+            self._replace_rows('patient_clusters', {'patient_id': patient_id}, ('patient_id', 'cluster_id'), [
+                {'patient_id': patient_id, 'cluster_id': cluster_id, 'cluster_name': name, 'position': i}
+                for i, (name, cluster_id) in enumerate(data['clusters'])], counts)
+            self._replace_rows('timepoints', {'patient_id': patient_id}, ('blast_ssam_se_id',),
+                               _result_rows(accession_df, {'patient_id': patient_id}), counts)
+            self.conn.execute('UPDATE patients SET synced_at = ?, page_hash = ? WHERE patient_id = ?',
+                              (time.time(), page_hash, patient_id))
+        return counts
+
+    def store_search(self, query_key, params, df, counts=None):
+        """Upsert search_db results under query_key."""
+        counts = counts if counts is not None else _new_counts()
+        with self._lock, self.conn:
+            self._replace_rows('searches', {'query_key': query_key}, ('query_key',), [
+                {'query_key': query_key, 'params': json.dumps(params, sort_keys=True),
+                 'result_columns': _columns_json(df)}], counts)
+            self._replace_rows('search_results', {'query_key': query_key}, ('query_key', 'position'),
+                               _result_rows(df, {'query_key': query_key}), counts)
+            self.conn.execute('UPDATE searches SET synced_at = ? WHERE query_key = ?', (time.time(), query_key))
+        return counts
+
+    def touch(self, table, key):
+        """Mark an unchanged entity as synced now."""
+        with self._lock, self.conn:
+            self.conn.execute('UPDATE {} SET synced_at = ? WHERE {} = ?'.format(table, _KEY_COLS[table]),
+                              (time.time(), key))
+
+    # Reading
+
+    def _sync_info(self, table, key, column):
+        with self._lock:
+            row = self.conn.execute('SELECT {} FROM {} WHERE {} = ?'.format(column, table, _KEY_COLS[table]),
+                                    (key,)).fetchone()
+        return row[0] if row else None
+
+    def synced_at(self, table, key):
+        """Time an entity was last synced, or None. table is 'clusters', 'patients' or 'searches'."""
+        return self._sync_info(table, key, 'synced_at')
+
+    def page_hash(self, table, key):
+        """Page fingerprint stored at the last sync of a cluster or patient, or None."""
+        return self._sync_info(table, key, 'page_hash')
+
+    def _fetchall(self, sql, params=()):
+        with self._lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def load_cluster(self, cluster_id):
+        """Cluster data in the form returned by load_data.load_cluster.
+
+        Raises:
+            KeyError: cluster has not been synced.
+        """
+        row = self._fetchall('SELECT cluster_name, description FROM clusters WHERE cluster_id = ?',
+                             (cluster_id,))
+        if not row:
+            raise KeyError("Cluster {} is not in warehouse {}".format(cluster_id, self.path))
+        cluster_name, description = row[0]
+        patients = self._fetchall('SELECT patient_code, patient_id FROM cluster_patients '
+                                  'WHERE cluster_id = ? ORDER BY position', (cluster_id,))
+        accessions = self._fetchall('SELECT accession, se_id FROM cluster_accessions '
+                                    'WHERE cluster_id = ? ORDER BY position', (cluster_id,))
+        return {
+            'cluster_name': cluster_name,
+            'description': description,
+            'patients': OrderedDict(patients),
+            'accessions': OrderedDict(accessions),
+        }
+
+    def load_patient_info(self, patient_id):
+        """Patient data in the form returned by load_data.extract_patient_info.
+
+        Raises:
+            KeyError: patient has not been synced.
+        """
+        row = self._fetchall('SELECT description FROM patients WHERE patient_id = ?', (patient_id,))
+        if not row:
+            raise KeyError("Patient {} is not in warehouse {}".format(patient_id, self.path))
+        pairs = json.loads(row[0][0])
+        desc = pd.Series([v for _, v in pairs], index=pd.Index([k for k, _ in pairs], name='var'),
+                         name=patient_id)
+        accessions = self._fetchall('SELECT accession, se_id FROM patient_accessions '
+                                    'WHERE patient_id = ? ORDER BY position', (patient_id,))
+        clusters = self._fetchall('SELECT cluster_name, cluster_id FROM patient_clusters '
+                                  'WHERE patient_id = ? ORDER BY position', (patient_id,))
+        return {'desc': desc, 'accessions': accessions, 'clusters': clusters}
+
+    def load_timepoints(self, patient_id):
+        """Timepoints table as returned by load_data.extract_patient_accession_timepoints."""
+        row = self._fetchall('SELECT timepoint_columns FROM patients WHERE patient_id = ?', (patient_id,))
+        if not row:
+            raise KeyError("Patient {} is not in warehouse {}".format(patient_id, self.path))
+        return self._load_results('timepoints', 'patient_id', patient_id, row[0][0])
+
+    def load_search(self, query_key):
+        """search_db results stored under query_key."""
+        row = self._fetchall('SELECT result_columns FROM searches WHERE query_key = ?', (query_key,))
+        if not row:
+            raise KeyError("Search {} is not in warehouse {}".format(query_key, self.path))
+        return self._load_results('search_results', 'query_key', query_key, row[0][0])
+
+    def _load_results(self, table, scope_col, scope_val, columns_json):
+        columns = json.loads(columns_json)
+        names = [name for name, _ in columns]
+        rows = self._fetchall('SELECT {} FROM {} WHERE {} = ? ORDER BY position'.format(
+            ', '.join(names), table, scope_col), (scope_val,))
+        df = pd.DataFrame.from_records(rows, columns=names)
+        for name, dtype in columns:
+            if dtype not in ('category', 'object'):
+                df[name] = df[name].astype(dtype)
+        return _apply_schema(df)
+
+
+_KEY_COLS = {'clusters': 'cluster_id', 'patients': 'patient_id', 'searches': 'query_key'}
+
+
+def _new_counts():
+    return defaultdict(lambda: dict(inserted=0, updated=0, deleted=0, unchanged=0))
+
+
+def _columns_json(df):
+    return json.dumps([[str(c), str(df[c].dtype)] for c in df.columns])
+
+
+def _result_rows(df, extra):
+    """Rows of a parsed results table for timepoints/search_results."""
+    known = set(_RESULT_INT_COLS + _RESULT_TEXT_COLS)
+    unknown = [c for c in df.columns if c not in known]
+    if unknown:
+        _logger.warning("Columns not stored in warehouse: %s", unknown)
+    cols = [c for c in df.columns if c in known]
+    rows = []
+    for position, values in enumerate(df[cols].itertuples(index=False, name=None)):
+        row = dict(extra, position=position)
+        row.update((c, _sql_value(v)) for c, v in zip(cols, values))
+        rows.append(row)
+    return rows
+
+
+def summarize_counts(counts):
+    """Total inserted/updated/deleted/unchanged rows over all tables."""
+    total = dict(inserted=0, updated=0, deleted=0, unchanged=0)
+    for table_counts in counts.values():
+        for k, v in table_counts.items():
+            total[k] += v
+    return total
+
+
+def _change_status(stored_hash, page_hash):
+    if stored_hash is None:
+        return 'new'
+    return 'unchanged' if stored_hash == page_hash else 'changed'
+
+
+def _fetch_cluster(cluster_id, warehouse, client):
+    """Cluster page fingerprint, change status and parsed data (None if unchanged)."""
+    content = client.fetch(client.url(_cluster_path(cluster_id)))
+    page_hash = _page_fingerprint(content)
+    status = _change_status(warehouse.page_hash('clusters', cluster_id), page_hash)
+    data = None if status == 'unchanged' else tables.read_cluster_page(content)
+    return page_hash, status, data
+
+
+def _fetch_patient(patient_id, warehouse, client):
+    """Patient pages fingerprint, change status and parsed (info, timepoints), or None if unchanged."""
+    info_content = client.fetch(client.url(_patient_path(patient_id)))
+    pages = list(_content_pager(client.url(_timepoints_path(patient_id)), client=client))
+    page_hash = hashlib.sha256(' '.join(_page_fingerprint(c) for c in [info_content] + pages)
+                               .encode('ascii')).hexdigest()
+    status = _change_status(warehouse.page_hash('patients', patient_id), page_hash)
+    if status == 'unchanged':
+        return page_hash, status, None
+    data = tables.read_patient_page(info_content, patient_id)
+    accession_df = _concat_timepoint_pages([_get_df_from_content(c, list(_TIMEPOINT_COLS)) for c in pages])
+    return page_hash, status, (data, accession_df)
+
+
+def sync_clusters(cluster_ids, warehouse, client=None, max_workers=4, max_age=None):
+    """Download clusters and their patients into warehouse, upserting changed rows.
+
+    Pages are fingerprinted (see load_data._page_fingerprint) and compared
+    with the last sync. Unchanged clusters and patients are not parsed or
+    written. Run with a refreshing client (HivClient(refresh=True)) to
+    re-download pages rather than reuse the response cache.
+
+    Args:
+        cluster_ids (list): cluster IDs to sync.
+        warehouse (Warehouse): destination.
+        client (HivClient): HTTP client to use. Defaults to the shared client.
+        max_workers (int): number of clusters or patients fetched concurrently.
+        max_age (float): skip clusters and patients synced less than this many
+            seconds ago. None syncs everything.
+
+    Returns:
+        report (dict): 'counts' (per-table inserted/updated/deleted/unchanged
+            rows), 'entities' (new/changed/unchanged clusters and patients),
+            'clusters' and 'patients' synced, 'skipped' entities, 'not_modified'
+            pages revalidated by the server, 'failed' (id -> error) and 'seconds'.
+    """
+    client = client or get_default_client()
+    t0 = time.perf_counter()
+    now = time.time()
+    not_modified_before = client.n_not_modified
+
+    def fresh(table, key):
+        synced = warehouse.synced_at(table, key)
+        return max_age is not None and synced is not None and now - synced < max_age
+
+    counts = _new_counts()
+    entities = {'clusters': dict(new=0, changed=0, unchanged=0),
+                'patients': dict(new=0, changed=0, unchanged=0)}
+    failed = {}
+    n_skipped = 0
+    patient_ids = OrderedDict()
+    todo = []
+    for cluster_id in cluster_ids:
+        if fresh('clusters', cluster_id):
+            n_skipped += 1
+            patient_ids.update((i, None) for i in warehouse.load_cluster(cluster_id)['patients'].values())
+        else:
+            todo.append(cluster_id)
+    n_clusters = n_patients = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [(i, pool.submit(_fetch_cluster, i, warehouse, client)) for i in todo]
+        for cluster_id, future in futures:
+            try:
+                page_hash, status, data = future.result()
+            except Exception as e:
+                _logger.error("Cluster %d failed: %r", cluster_id, e)
+                failed['cluster {}'.format(cluster_id)] = repr(e)
+                continue
+            if data is None:
+                warehouse.touch('clusters', cluster_id)
+                data = warehouse.load_cluster(cluster_id)
+            else:
+                warehouse.store_cluster(cluster_id, data, counts, page_hash=page_hash)
+            entities['clusters'][status] += 1
+            n_clusters += 1
+            patient_ids.update((i, None) for i in data['patients'].values())
+
+        patient_todo = []
+        for patient_id in patient_ids:
+            if fresh('patients', patient_id):
+                n_skipped += 1
+            else:
+                patient_todo.append(patient_id)
+        futures = [(i, pool.submit(_fetch_patient, i, warehouse, client)) for i in patient_todo]
+        for patient_id, future in futures:
+            try:
+                page_hash, status, parsed = future.result()
+                if parsed is None:
+                    warehouse.touch('patients', patient_id)
+                else:
+                    warehouse.store_patient(patient_id, *parsed, counts, page_hash=page_hash)
+            except Exception as e:
+                _logger.error("Patient %d failed: %r", patient_id, e)
+                failed['patient {}'.format(patient_id)] = repr(e)
+                continue
+            entities['patients'][status] += 1
+            n_patients += 1
+    return {
+        'counts': dict(counts),
+        'entities': entities,
+        'clusters': n_clusters,
+        'patients': n_patients,
+        'skipped': n_skipped,
+        'not_modified': client.n_not_modified - not_modified_before,
+        'failed': failed,
+        'seconds': time.perf_counter() - t0,
+    }
+
+
+def search_key(client, max_rec=100, virus='HIV-1', subtype='A1*', region='GENOME', cluster_name=None):
+    """Warehouse key of a search_db query."""
+    form, _ = _search_form(max_rec, virus, subtype, region, cluster_name)
+    return request_key(client.url('search.comp'), form)
+
+
+def sync_search(warehouse, client=None, **search_kwargs):
+    """Run search_db and upsert its results into warehouse.
+
+    Returns:
+        query_key (str): key for Warehouse.load_search.
+        counts (dict): per-table inserted/updated/deleted/unchanged rows.
+    """
+    client = client or get_default_client()
+    df = search_db(client=client, **search_kwargs)
+    query_key = search_key(client, **search_kwargs)
+    return query_key, dict(warehouse.store_search(query_key, search_kwargs, df))
@@ -1,11 +1,34 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 """
-    Dummy conftest.py for alamos_extract.
+    Shared fixtures for alamos_extract tests.
 
-    If you don't know what this is for, just leave it empty.
-    Read more about conftest.py under:
-    https://pytest.org/latest/plugins.html
+    Offline tests run against the local stand-in server in stand_in.py.
 """
 
-# import pytest
+import pytest
+
+from alamos_extract.client import HivClient
+from alamos_extract.registry import get_patient_registry
+from stand_in import StandInData, StandInServer
+
+
+@pytest.fixture(autouse=True)
+def patient_registry():
+    # stand-in servers of different tests may reuse a port
+    registry = get_patient_registry()
+    registry.clear()
+    yield registry
+    registry.clear()
+
+
+@pytest.fixture
+def stand_in():
+    with StandInServer(StandInData(), page_size=5) as server:
+        yield server
+
+
+@pytest.fixture
+def client(stand_in):
+    with HivClient(base_url=stand_in.base_url, retries=0) as client:
+        yield client
@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Recorded response corpus and a replay server for offline benchmarks.
+
+    record_corpus drives the normal alamos_extract API through a recording
+    client, so the corpus holds exactly the cluster, patient, search and
+    multi-page timepoint responses the package requests, in the order it
+    requests them. ReplayServer serves a corpus back with configurable latency
+    and jitter, issuing fresh single-use result ids so Next-page requests
+    follow the same stateful protocol as the real site.
+
+    Re-record the checked-in corpus (from the stand-in server) with:
+
+        python tests/replay.py record tests/corpus
+
+    or from the live site with --base-url https://www.hiv.lanl.gov/components/sequence/HIV/search/
+"""
+
+import argparse
+import gzip
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from http.server import ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+from alamos_extract.cache import SESSION_FIELDS
+from alamos_extract.client import HivClient
+from alamos_extract.load_data import Cluster, search_db, _next_page_data_from_content
+from alamos_extract.registry import PatientRegistry
+from stand_in import StandInData, StandInHandler, StandInServer
+
+__author__ = "Stephen Gaffney"
+__copyright__ = "Stephen Gaffney"
+__license__ = "gpl3"
+
+CORPUS_DIR = os.path.join(os.path.dirname(__file__), 'corpus')
+INDEX = 'index.json'
+
+# Stand-in data the checked-in corpus was recorded from
+CORPUS_DATA = dict(n_clusters=3, patients_per_cluster=4, seqs_per_patient=60)
+CORPUS_PAGE_SIZE = 25
+CORPUS_CLUSTERS = (700, 701, 702)
+CORPUS_CLUSTER_NAMES = ('SC_cluster_701',)
+CORPUS_MAX_REC = 200
+
+
+def _query_key(method, path, form):
+    """Key of a request that starts a result chain: method, path and form without session fields."""
+    return [method, path, sorted([k, v] for k, v in form if k not in SESSION_FIELDS)]
+
+
+def _request_form(request):
+    body = request.body or ''
+    if isinstance(body, bytes):
+        body = body.decode('utf8')
+    return parse_qsl(body, keep_blank_values=True)
+
+
+def _request_path(url):
+    parts = urlsplit(url)
+    return parts.path + ('?' + parts.query if parts.query else '')
+
+
+class RecordingClient(HivClient):
+    """HivClient that saves every response body it receives, uncached."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.entries = []
+        self.bodies = []
+        self._chains = {}  # result id -> (query key, page)
+        self._record_lock = threading.Lock()
+
+    def request(self, url, data=None, headers=None):
+        response = super().request(url, data, headers)
+        form = _request_form(response.request)
+        method = response.request.method
+        page_id = dict(form).get('id')
+        with self._record_lock:
+            if page_id is not None:
+                key, page = self._chains.pop(page_id)
+                page += 1
+            else:
+                key, page = _query_key(method, _request_path(response.request.url), form), 0
+            next_data = _next_page_data_from_content(response.content)
+            next_id = next_data['id'] if next_data else None
+            if next_id is not None:
+                self._chains[next_id] = (key, page)
+            self.entries.append({'key': key, 'page': page, 'page_id': next_id,
+                                 'file': '{:04d}.html.gz'.format(len(self.entries))})
+            self.bodies.append(response.content)
+        return response
+
+
+def record_corpus(client, corpus_dir, cluster_ids=CORPUS_CLUSTERS, cluster_names=CORPUS_CLUSTER_NAMES,
+                  max_rec=CORPUS_MAX_REC):
+    """Record the responses for building clusters and running searches into corpus_dir.
+
+    Args:
+        client (RecordingClient): client pointed at the site to record.
+
+    Returns:
+        n_entries (int): number of responses recorded.
+    """
+    for cluster_id in cluster_ids:
+        Cluster(cluster_id, client=client, registry=PatientRegistry(maxsize=0)).load()
+    for name in cluster_names:
+        search_db(cluster_name=name, client=client)
+    search_db(max_rec=max_rec, client=client)
+
+    os.makedirs(corpus_dir, exist_ok=True)
+    for entry, body in zip(client.entries, client.bodies):
+        with open(os.path.join(corpus_dir, entry['file']), 'wb') as f:
+            f.write(gzip.compress(body, mtime=0))
+    index = {'base_path': urlsplit(client.base_url).path, 'entries': client.entries}
+    with open(os.path.join(corpus_dir, INDEX), 'w') as f:
+        json.dump(index, f, indent=1)
+    return len(client.entries)
+
+
+def load_corpus(corpus_dir=CORPUS_DIR):
+    """Recorded entries of a corpus, with their decompressed bodies under 'body'."""
+    with open(os.path.join(corpus_dir, INDEX)) as f:
+        index = json.load(f)
+    for entry in index['entries']:
+        with open(os.path.join(corpus_dir, entry['file']), 'rb') as f:
+            entry['body'] = gzip.decompress(f.read())
+    return index
+
+
+class ReplayHandler(StandInHandler):
+    def _dispatch(self, form):
+        server = self.server
+        with server.lock:
+            server.n_requests += 1
+            overload = server.overloads.pop(0) if server.overloads else None
+        server.delay()
+        if overload is not None:
+            return self._send(overload[0], b'Busy', retry_after=overload[1])
+        form = list(form.items())
+        page_id = dict(form).get('id')
+        if page_id is not None:
+            with server.lock:
+                chain = server.sessions.pop(page_id, None)
+            entry = None if chain is None else server.entries.get((chain[0], chain[1] + 1))
+        else:
+            method = 'POST' if form else 'GET'
+            key = json.dumps(_query_key(method, self.path, form))
+            entry = server.entries.get((key, 0))
+        if entry is None:
+            return self._send(404, b'Not found')
+        self._send(200, server.issue_page_id(entry))
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self._dispatch(dict(parse_qsl(self.rfile.read(length).decode(), keep_blank_values=True)))
+
+
+class ReplayServer(ThreadingHTTPServer):
+    """Threaded server replaying a recorded corpus, usable as a context manager.
+
+    Args:
+        corpus_dir (str): directory written by record_corpus.
+        latency (float): seconds added before each response.
+        jitter (float): latency varies uniformly by up to +/- jitter seconds.
+        seed (int): seed for the jitter, so runs are repeatable.
+
+    Result ids are single use, as on the real site: each replayed page carries
+    a fresh id for its Next request, and replaying an old id gets a 404.
+    """
+    daemon_threads = True
+
+    def __init__(self, corpus_dir=CORPUS_DIR, latency=0.0, jitter=0.0, seed=0):
+        super().__init__(('127.0.0.1', 0), ReplayHandler)
+        index = load_corpus(corpus_dir)
+        self.base_path = index['base_path']
+        self.entries = {(json.dumps(e['key']), e['page']): e for e in index['entries']}
+        self.latency = latency
+        self.jitter = jitter
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.n_connections = 0
+        self.n_requests = 0
+        self.etags = False
+        self.overloads = []
+        self._rng = random.Random(seed)
+        self._thread = None
+
+    @property
+    def base_url(self):
+        return 'http://{}:{}{}'.format(*self.server_address, self.base_path)
+
+    def delay(self):
+        if not (self.latency or self.jitter):
+            return
+        with self.lock:
+            offset = self._rng.uniform(-self.jitter, self.jitter)
+        time.sleep(max(0.0, self.latency + offset))
+
+    def issue_page_id(self, entry):
+        """Body of entry with its recorded result id replaced by a fresh one."""
+        body = entry['body']
+        if entry['page_id'] is not None:
+            page_id = uuid.uuid4().hex
+            with self.lock:
+                self.sessions[page_id] = (json.dumps(entry['key']), entry['page'])
+            body = body.replace(entry['page_id'].encode(), page_id.encode())
+        return body
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Record a response corpus for ReplayServer.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    record = subparsers.add_parser('record')
+    record.add_argument('corpus_dir')
+    record.add_argument('--base-url', help="site to record (default: a local stand-in server)")
+    args = parser.parse_args(args)
+
+    if args.base_url:
+        with RecordingClient(base_url=args.base_url) as client:
+            n = record_corpus(client, args.corpus_dir)
+    else:
+        with StandInServer(StandInData(**CORPUS_DATA), page_size=CORPUS_PAGE_SIZE) as server:
+            with RecordingClient(base_url=server.base_url, retries=0) as client:
+                n = record_corpus(client, args.corpus_dir)
+    print('{} responses recorded in {}'.format(n, args.corpus_dir))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,402 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Local stand-in for the Los Alamos HIV Database search pages.
+
+    Serves synthetic cluster.comp, patient.comp, search.comp and d_search.comp
+    pages laid out the way alamos_extract.load_data expects, including
+    server-side result paging with single-use ``id`` tokens, so tests and
+    benchmarks can run without hiv.lanl.gov.
+"""
+
+import fnmatch
+import gzip
+import hashlib
+import html
+import itertools
+import random
+import re
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+__author__ = "Stephen Gaffney"
+__copyright__ = "Stephen Gaffney"
+__license__ = "gpl3"
+
+SEARCH_PATH = '/components/sequence/HIV/search/'
+FIEBIG = ['I', 'II', 'III', 'IV', 'V', 'VI', '']
+SUBTYPES = ['B', 'C', 'A1', '01_AE', '02_AG']
+COUNTRIES = ['US', 'ZA', 'ZM', 'TH', 'UG']
+REGIONS = ['GENOME', 'ENV', 'GAG', 'POL', 'NEF']
+
+
+class StandInData:
+    """Deterministic synthetic clusters, patients and sequences.
+
+    Consecutive clusters share one patient, so patients belong to several
+    clusters as on the real site.
+    """
+    def __init__(self, n_clusters=3, patients_per_cluster=3, seqs_per_patient=12,
+                 first_cluster_id=700, seed=0):
+        rng = random.Random(seed)
+        self.clusters = {}
+        self.patients = {}
+        self.seqs = {}
+        pat_ids = itertools.count(9000)
+        se_ids = itertools.count(149000)
+        shared = None
+        for c in range(n_clusters):
+            clu_id = first_cluster_id + c
+            members = [] if shared is None else [shared]
+            while len(members) < patients_per_cluster:
+                pat_id = next(pat_ids)
+                self.patients[pat_id] = self._make_patient(pat_id, rng, seqs_per_patient, se_ids)
+                members.append(pat_id)
+            self.clusters[clu_id] = {
+                'name': 'SC_cluster_{}'.format(clu_id),
+                'description': 'Source patient and {} partners.'.format(len(members) - 1),
+                'patients': members,
+            }
+            for pat_id in members:
+                self.patients[pat_id]['clusters'].append(clu_id)
+            shared = members[-1]
+
+    def _make_patient(self, pat_id, rng, n_seqs, se_ids):
+        seq_ids = []
+        subtype = rng.choice(SUBTYPES)
+        country = rng.choice(COUNTRIES)
+        for i in range(n_seqs):
+            se_id = next(se_ids)
+            start = rng.randint(1, 8000)
+            first_day = rng.choice([None, rng.randint(0, 2000)])
+            self.seqs[se_id] = {
+                'se_id': se_id,
+                'pat_id': pat_id,
+                'accession': 'AB{:06d}'.format(se_id),
+                'seq_name': 'p{}_s{}'.format(pat_id, i),
+                'subtype': subtype,
+                'country': country,
+                'sampling_year': rng.randint(1990, 2015),
+                'days_from_first_sample': first_day,
+                'fiebig_stage': rng.choice(FIEBIG),
+                'days_from_treatment_end': None,
+                'days_from_treatment_start': rng.choice([None, rng.randint(-500, 500)]),
+                'days_from_infection': rng.choice([None, rng.randint(10, 3000)]),
+                'days_from_seroconversion': rng.choice([None, rng.randint(0, 3000)]),
+                'genomic_region': rng.choice(REGIONS),
+                'seq_length': rng.randint(200, 9000),
+                'organism': 'HIV-1',
+                'start': start,
+                'stop': start + rng.randint(200, 1500),
+            }
+            seq_ids.append(se_id)
+        return {
+            'code': 'P{}'.format(pat_id),
+            'sex': rng.choice(['M', 'F']),
+            'country': country,
+            'risk': rng.choice(['MSM', 'HET', 'IDU']),
+            'seqs': seq_ids,
+            'clusters': [],
+        }
+
+    def cluster_seqs(self, clu_id):
+        return [s for p in self.clusters[clu_id]['patients'] for s in self.patients[p]['seqs']]
+
+
+def _cell(value):
+    return '<td>{}</td>'.format('' if value is None else html.escape(str(value)))
+
+
+def render_cluster(data, clu_id):
+    clu = data.clusters[clu_id]
+    pat_links = ' '.join('<a href="patient.comp?pat_id={}">{}</a>'.format(p, data.patients[p]['code'])
+                         for p in clu['patients'])
+    acc_links = ' '.join(
+        '<a href="/components/sequence/HIV/asearch/query_one.comp?se_id={}">{}</a>'
+        .format(s, data.seqs[s]['accession']) for s in data.cluster_seqs(clu_id))
+    return ('<html><body>'
+            '<table><tr><td><a href="/">Search</a></td><td>Tools</td></tr></table>'
+            '<table>'
+            '<tr><td>Cluster Name</td><td>{name}</td></tr>'
+            '<tr><td>Cluster Description</td><td>"{desc}"</td></tr>'
+            '<tr><td>Patient(s)</td><td>{pats}</td></tr>'
+            '<tr><td>Accession(s)</td><td>{accs}</td></tr>'
+            '</table></body></html>').format(name=clu['name'], desc=clu['description'],
+                                             pats=pat_links, accs=acc_links)
+
+
+def render_patient(data, pat_id):
+    pat = data.patients[pat_id]
+    clu_links = ' '.join('<a href="cluster.comp?clu_id={}">{}</a>'.format(c, data.clusters[c]['name'])
+                         for c in pat['clusters'])
+    acc_rows = ''.join(
+        '<tr><td><a href="/components/sequence/HIV/asearch/query_one.comp?se_id={}">{}</a></td><td>{}</td></tr>'
+        .format(s, data.seqs[s]['accession'], data.seqs[s]['genomic_region']) for s in pat['seqs'])
+    return ('<html><body>'
+            '<table><tr><td><a href="/">Search</a></td><td>Tools</td></tr></table>'
+            '<table>'
+            '<tr><td>Patient Code</td><td>{code}</td></tr>'
+            '<tr><td>Patient Id</td><td>{pat_id}</td></tr>'
+            '<tr><td>Sex</td><td>{sex}</td></tr>'
+            '<tr><td>Country</td><td>{country}</td></tr>'
+            '<tr><td>Risk Factor</td><td>{risk}</td></tr>'
+            '<tr><td>Accession(s)</td><td>{n}</td></tr>'
+            '<tr><td>Cluster(s)</td><td>{clusters}</td></tr>'
+            '</table>'
+            '<table>{accs}</table>'
+            '</body></html>').format(code=pat['code'], pat_id=pat_id, sex=pat['sex'],
+                                     country=pat['country'], risk=pat['risk'], n=len(pat['seqs']),
+                                     clusters=clu_links, accs=acc_rows)
+
+
+SEARCH_FIELDS = ['accession', 'seq_name', 'subtype', 'country', 'sampling_year',
+                 'genomic_region', 'seq_length', 'organism']
+CLUSTER_SEARCH_FIELDS = ['accession', 'seq_name', 'subtype', 'country', 'sampling_year',
+                         'cluster_comb', 'genomic_region', 'seq_length', 'organism']
+TIMEPOINT_FIELDS = ['accession', 'seq_name', 'subtype', 'country', 'sampling_year',
+                    'days_from_first_sample', 'fiebig_stage', 'days_from_treatment_end',
+                    'days_from_treatment_start', 'days_from_infection', 'days_from_seroconversion',
+                    'genomic_region', 'seq_length', 'organism']
+# Column headers of the tab-delimited downloads
+DOWNLOAD_HEADERS = {
+    'accession': 'Accession', 'seq_name': 'Name', 'subtype': 'Subtype', 'country': 'Country',
+    'sampling_year': 'Sampling Year', 'cluster_comb': 'Cluster', 'days_from_first_sample': 'Days from first sample',
+    'fiebig_stage': 'Fiebig stage', 'days_from_treatment_end': 'Days from treatment end',
+    'days_from_treatment_start': 'Days from treatment start', 'days_from_infection': 'Days from infection',
+    'days_from_seroconversion': 'Days from seroconversion', 'genomic_region': 'Genomic Region',
+    'seq_length': 'Sequence Length', 'organism': 'Organism',
+}
+
+
+def render_download(data, se_ids, fields, cluster_id=None):
+    """Render a whole result set as a tab-delimited download."""
+    header = ['SE id', 'Patient Code', 'Patient Id'] + [DOWNLOAD_HEADERS[f] for f in fields] + ['Start', 'Stop']
+    lines = ['\t'.join(header)]
+    for se_id in se_ids:
+        seq = data.seqs[se_id]
+        values = dict(seq)
+        if cluster_id is not None:
+            values['cluster_comb'] = '{}({})'.format(data.clusters[cluster_id]['name'], cluster_id)
+        row = [se_id, data.patients[seq['pat_id']]['code'], seq['pat_id']] + [values[f] for f in fields]
+        lines.append('\t'.join('' if v is None else str(v) for v in row + [seq['start'], seq['stop']]))
+    return '\n'.join(lines) + '\n'
+
+
+_RESULT_ID = re.compile(rb'<input type="hidden" name="id" value="[^"]*">')
+
+
+def render_results(data, se_ids, fields, first_row, page_id=None, has_next=False, has_last=False,
+                   cluster_id=None, total=None):
+    """Render one page of a search results grid with paging controls and, if given, the match count."""
+    header = '<tr><td>#</td><td colspan="2">Select</td><td>Patient</td>{}</tr>'.format(
+        ''.join('<td>{}</td>'.format(f) for f in fields))
+    rows = []
+    for row_id, se_id in enumerate(se_ids, start=first_row):
+        seq = data.seqs[se_id]
+        pat = data.patients[seq['pat_id']]
+        values = dict(seq)
+        if cluster_id is not None:
+            values['cluster_comb'] = '{}({})'.format(data.clusters[cluster_id]['name'], cluster_id)
+        rows.append(
+            '<tr><td>{row_id}</td>'
+            '<td><a href="/cgi-bin/BASIC_BLAST/basic_blast_pg.cgi?SSAM_SE_id={se_id}">'
+            '<img title="BLAST"></a></td>'
+            '<td><a href="http://www.ncbi.nlm.nih.gov/nuccore/{acc}?report=graph">'
+            '<img title="Start: {start}  Stop: {stop}. Link to NCBI sequence viewer"></a></td>'
+            '<td><a href="patient.comp?pat_id={pat_id}">{code}({pat_id})</a></td>'
+            '{cells}</tr>'.format(row_id=row_id, se_id=se_id, acc=seq['accession'], start=seq['start'],
+                                  stop=seq['stop'], pat_id=seq['pat_id'], code=pat['code'],
+                                  cells=''.join(_cell(values[f]) for f in fields)))
+    controls = []
+    if page_id is not None:
+        controls.append('<input type="hidden" name="id" value="{}">'.format(page_id))
+    if has_next:
+        controls.append('<input type="image" name="action Next" title="Next" src="next.gif">')
+    if has_last:
+        controls.append('<input type="image" name="action Last" title="Last" src="last.gif">')
+    found = '' if total is None else '<p>{} sequences found</p>'.format(total)
+    return ('<html><body><form method="post">'
+            '<table><tr><td>Search results</td></tr></table>{found}'
+            '<table>{header}{rows}</table>{controls}'
+            '</form></body></html>').format(header=header, rows=''.join(rows), controls=''.join(controls),
+                                            found=found)
+
+
+def _matches(seq, form):
+    """Whether seq matches a search form's virus, subtype ('A1* or Astar') and region fields."""
+    virus = form.get('master', '')
+    if virus not in ('', 'Any') and seq['organism'] != virus:
+        return False
+    region = form.get('Genomic Region', '')
+    if region and seq['genomic_region'] != region:
+        return False
+    subtype = form.get('slave', '')
+    return not subtype or any(fnmatch.fnmatchcase(seq['subtype'], p) for p in subtype.split(' or '))
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.n_connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._dispatch({})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        form = {k: v[0] for k, v in parse_qs(self.rfile.read(length).decode()).items()}
+        self._dispatch(form)
+
+    def _dispatch(self, form):
+        server = self.server
+        with server.lock:
+            server.n_requests += 1
+            overload = server.overloads.pop(0) if server.overloads else None
+        if overload is not None:
+            return self._send(overload[0], b'Busy', retry_after=overload[1])
+        parts = urlsplit(self.path)
+        query = {k: v[0] for k, v in parse_qs(parts.query).items()}
+        endpoint = parts.path.rsplit('/', 1)[-1]
+        try:
+            if 'id' in form:
+                body = server.next_page(form['id'])
+            elif endpoint == 'cluster.comp':
+                body = render_cluster(server.data, int(query['clu_id']))
+            elif endpoint == 'patient.comp':
+                body = render_patient(server.data, int(query['pat_id']))
+            elif endpoint == 'search.comp':
+                body = server.search(form)
+            elif endpoint == 'd_search.comp':
+                body = server.timepoints(int(query['ssam_pat_id']), query.get('download_format'))
+            else:
+                return self._send(404, b'Not found')
+        except (KeyError, ValueError):
+            return self._send(404, b'Not found')
+        body = body.encode('utf8')
+        etag = None
+        if server.etags and not form:
+            tagged = _RESULT_ID.sub(b'', body) if server.etags_ignore_ids else body
+            etag = '"{}"'.format(hashlib.sha1(tagged).hexdigest())
+            if self.headers.get('If-None-Match') == etag:
+                with server.lock:
+                    server.n_not_modified += 1
+                return self._send(304, b'', etag)
+        self._send(200, body, etag)
+
+    def _send(self, status, body, etag=None, retry_after=None):
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        if etag:
+            self.send_header('ETag', etag)
+        if retry_after is not None:
+            self.send_header('Retry-After', str(retry_after))
+        if body and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class StandInServer(ThreadingHTTPServer):
+    """Threaded stand-in server, usable as a context manager.
+
+    Result ids are single use: each page issues a fresh id for its Next
+    request, and replaying an old id gets a 404. With etags=True, GET pages
+    carry an ETag and honour If-None-Match. With etags_ignore_ids as well,
+    the ETag leaves out the result id, as on servers that tag only the rows.
+    Searches and timepoint queries with download_format=tab get the whole
+    result set as a tab-delimited download instead of paged HTML, unless
+    downloads=False, when the field is ignored. With filters=True, searches keep
+    only sequences matching the virus, subtype and region fields, up to
+    max_rec of them, in pages of page_size, and report the number of matches. Responses queued in overloads, as
+    (status, Retry-After value or None), are sent before any other page.
+    next_page_requested is set when the first Next request arrives.
+    """
+    daemon_threads = True
+
+    def __init__(self, data=None, page_size=100):
+        super().__init__(('127.0.0.1', 0), StandInHandler)
+        self.data = data or StandInData()
+        self.page_size = page_size
+        self.lock = threading.Lock()
+        self.n_connections = 0
+        self.n_requests = 0
+        self.n_not_modified = 0
+        self.etags = False
+        self.etags_ignore_ids = False
+        self.filters = False
+        self.downloads = True
+        self.overloads = []
+        self.next_page_requested = threading.Event()
+        self._results = {}
+        self._thread = None
+
+    @property
+    def base_url(self):
+        return 'http://{}:{}{}'.format(*self.server_address, SEARCH_PATH)
+
+    def search(self, form):
+        page_size = int(form.get('max_rec', self.page_size))
+        download = self.downloads and form.get('download_format') == 'tab'
+        name = form.get('value cluster clu_name 1')
+        if name is not None:
+            clu_id = next(c for c, v in self.data.clusters.items() if v['name'] == name)
+            se_ids = self.data.cluster_seqs(clu_id)
+            if download:
+                return render_download(self.data, se_ids, CLUSTER_SEARCH_FIELDS, clu_id)
+            return self._start(se_ids, CLUSTER_SEARCH_FIELDS, page_size, clu_id)
+        if self.filters:
+            se_ids = [s for s in sorted(self.data.seqs) if _matches(self.data.seqs[s], form)]
+            if download:
+                return render_download(self.data, se_ids[:page_size], SEARCH_FIELDS)
+            return self._start(se_ids[:page_size], SEARCH_FIELDS, self.page_size, total=len(se_ids))
+        se_ids = sorted(self.data.seqs)[:page_size]
+        if download:
+            return render_download(self.data, se_ids, SEARCH_FIELDS)
+        return self._start(se_ids, SEARCH_FIELDS, page_size)
+
+    def timepoints(self, pat_id, download_format=None):
+        se_ids = self.data.patients[pat_id]['seqs']
+        if self.downloads and download_format == 'tab':
+            return render_download(self.data, se_ids, TIMEPOINT_FIELDS)
+        return self._start(se_ids, TIMEPOINT_FIELDS, self.page_size)
+
+    def _start(self, se_ids, fields, page_size, cluster_id=None, total=None):
+        return self._page((se_ids, fields, page_size, cluster_id, total), 0)
+
+    def next_page(self, page_id):
+        self.next_page_requested.set()
+        with self.lock:
+            query, page = self._results.pop(page_id)
+        return self._page(query, page + 1)
+
+    def _page(self, query, page):
+        se_ids, fields, page_size, cluster_id, total = query
+        start = page * page_size
+        n_pages = max(1, -(-len(se_ids) // page_size))
+        page_id = uuid.uuid4().hex
+        with self.lock:
+            self._results[page_id] = (query, page)
+        remaining = n_pages - page - 1
+        return render_results(self.data, se_ids[start:start + page_size], fields, start + 1,
+                              page_id=page_id, has_next=remaining > 1, has_last=remaining > 0,
+                              cluster_id=cluster_id, total=total)
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import contextlib
+
+import pandas as pd
+import pytest
+
+from alamos_extract import aio
+from alamos_extract.load_data import Cluster, search_db
+
+pytest.importorskip('aiohttp')
+
+__author__ = "Stephen Gaffney"
+__copyright__ = "Stephen Gaffney"
+__license__ = "gpl3"
+
+
+def test_async_cluster_matches_sync(stand_in, client):
+    async def build():
+        async with aio.AsyncHivClient(base_url=stand_in.base_url, max_concurrency=4) as aclient:
+            return await Cluster.create(701, client=aclient)
+
+    expected = Cluster(701, client=client)
+    cluster = asyncio.run(build())
+    assert cluster.cluster_name == expected.cluster_name
+    assert list(cluster.patient_dict) == list(expected.patient_dict)
+    pd.testing.assert_frame_equal(cluster.desc_df, expected.desc_df)
+    pd.testing.assert_frame_equal(cluster.acc_df, expected.acc_df)
+
+
+def test_async_search_pages(stand_in, client):
+    async def search():
+        async with aio.AsyncHivClient(base_url=stand_in.base_url) as aclient:
+            return await aio.search_db(cluster_name='SC_cluster_702', client=aclient)
+
+    pd.testing.assert_frame_equal(asyncio.run(search()),
+                                  search_db(cluster_name='SC_cluster_702', client=client))
+
+
+def test_backoff_releases_concurrency_slot(stand_in):
+    async def fetch_both():
+        async with aio.AsyncHivClient(base_url=stand_in.base_url, max_concurrency=1, retries=1,
+                                      backoff_factor=1.0) as aclient:
+            stand_in.overloads.append((503, None))
+            retried = asyncio.ensure_future(aclient.fetch(aclient.url('cluster.comp?clu_id=700')))
+            await asyncio.sleep(0.2)  # first attempt answered 503, now backing off
+            loop = asyncio.get_running_loop()
+            start = loop.time()
+            await aclient.fetch(aclient.url('cluster.comp?clu_id=701'))
+            waited = loop.time() - start
+            await retried
+            return waited
+
+    assert asyncio.run(fetch_both()) < 0.5
+
+
+def test_content_pager_cancels_prefetch_when_closed(stand_in):
+    async def first_page():
+        async with aio.AsyncHivClient(base_url=stand_in.base_url) as aclient:
+            url = aclient.url('d_search.comp?ssam_pat_id=9000')
+            async with contextlib.aclosing(aio.content_pager(url, client=aclient)) as pages:
+                async for _ in pages:
+                    break
+            await asyncio.sleep(0)
+            return [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+
+    assert asyncio.run(first_page()) == []
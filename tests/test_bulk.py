@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pandas.testing as pdt
+import pytest
+
+from alamos_extract.bulk import is_download, read_download
+from alamos_extract.cache import ResponseCache
+from alamos_extract.client import HivClient
+from alamos_extract.load_data import (Cluster, extract_patient_accession_timepoints, search_db, _TIMEPOINT_COLS,
+                                      _timepoints_path)
+from alamos_extract.registry import PatientRegistry
+
+__author__ = "Stephen Gaffney"
+__copyright__ = "Stephen Gaffney"
+__license__ = "gpl3"
+
+
+@pytest.mark.parametrize('cluster_name', [None, 'SC_cluster_701'])
+def test_search_download_matches_html(stand_in, client, cluster_name):
+    html = search_db(cluster_name=cluster_name, client=client).reset_index(drop=True)
+    before = stand_in.n_requests
+    download = search_db(cluster_name=cluster_name, client=client, engine='download')
+    assert stand_in.n_requests - before == 1
+    pdt.assert_frame_equal(download, html)
+
+
+def test_timepoints_download_matches_html(stand_in, client):
+    html = extract_patient_accession_timepoints(9000, client=client)
+    before = stand_in.n_requests
+    download = extract_patient_accession_timepoints(9000, client=client, engine='download')
+    assert stand_in.n_requests - before == 1
+    pdt.assert_frame_equal(download, html)
+
+
+def test_cluster_with_download_engine(stand_in, client):
+    html = Cluster(700, client=client, registry=PatientRegistry()).acc_df
+    before = stand_in.n_requests
+    download = Cluster(700, client=client, registry=PatientRegistry(), engine='download').acc_df
+    # cluster page, patient pages, and one download per patient instead of paged tables
+    assert stand_in.n_requests - before == 7
+    pdt.assert_frame_equal(download, html)
+
+
+def test_download_falls_back_to_html(stand_in, client, caplog):
+    caplog.set_level('INFO')
+    stand_in.overloads.append((404, None))
+    df = search_db(cluster_name='SC_cluster_701', client=client, engine='download')
+    assert len(df) == 36
+    assert 'using the HTML pages' in caplog.text
+    with pytest.raises(ValueError):
+        search_db(client=client, engine='csv')
+
+
+@pytest.mark.parametrize('options', [{'engine': 'download', 'stream': True},
+                                     {'engine': 'download', 'partition_by': 'subtype'},
+                                     {'stream': True, 'partition_by': 'subtype'}])
+def test_search_options_that_conflict(stand_in, client, options):
+    with pytest.raises(ValueError, match="can't be combined"):
+        search_db(subtype='', region='', client=client, **options)
+    assert stand_in.n_requests == 0
+
+
+@pytest.mark.parametrize('cluster_name', [None, 'SC_cluster_701'])
+def test_ignored_download_field_starts_html_pages(stand_in, client, cluster_name):
+    html = search_db(cluster_name=cluster_name, client=client)
+    n_html = stand_in.n_requests
+    stand_in.downloads = False
+    df = search_db(cluster_name=cluster_name, client=client, engine='download')
+    # the grid sent back for the download request is used as page 1
+    assert stand_in.n_requests - n_html == n_html
+    pdt.assert_frame_equal(df, html)
+
+
+def test_ignored_download_field_is_not_cached(stand_in, tmp_path):
+    stand_in.downloads = False
+    with HivClient(base_url=stand_in.base_url, retries=0, cache=ResponseCache(str(tmp_path))) as client:
+        extract_patient_accession_timepoints(9000, client=client, engine='download')
+        url = '{}&download_format=tab'.format(client.url(_timepoints_path(9000)))
+        assert client.cache.get(client.cache_key(url)) is None
+        stand_in.downloads = True
+        before = stand_in.n_requests
+        extract_patient_accession_timepoints(9000, client=client, engine='download')
+        assert stand_in.n_requests - before == 1
+
+
+def test_read_download_checks_columns():
+    assert not is_download(b'<html><body>No results</body></html>')
+    assert is_download(b'SE id\tAccession\n1\tAB1\n')
+    with pytest.raises(ValueError, match='seq_name'):
+        read_download(b'SE id\tAccession\tPatient Id\tPatient Code\tStart\tStop\n', list(_TIMEPOINT_COLS))
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import time
+
+import pandas as pd
+
+from alamos_extract.cache import ResponseCache, request_key
+from alamos_extract.client import HivClient
+from alamos_extract.load_data import Cluster, extract_patient_accession_timepoints, _timepoints_path
+from alamos_extract.registry import PatientRegistry
+
+__author__ = "Stephen Gaffney"
+__copyright__ = "Stephen Gaffney"
+__license__ = "gpl3"
+
+
+def test_request_key_canonical():
+    assert request_key('u', {'a': 1, 'b': 'x'}) == request_key('u', {'b': 'x', 'a': '1'})
+    assert request_key('u', {'a': 1, 'id': 'abc'}, page=2) == request_key('u', {'a': 1}, page=2)
+    assert request_key('u', {'a': 1}, page=1) != request_key('u', {'a': 1}, page=2)
+    assert request_key('u') != request_key('u', {'a': 1})
+
+
+def test_ttl_expiry(tmp_path):
+    cache = ResponseCache(str(tmp_path), ttl=60)
+    cache.set('ab12', b'content')
+    assert cache.get('ab12') == b'content'
+    cache.ttl = -1
+    assert cache.get('ab12') is None
+
+
+def test_lru_eviction(tmp_path):
+    cache = ResponseCache(str(tmp_path))
+    for key in ['aa', 'bb', 'cc']:
+        cache.set(key, os.urandom(1000))
+        os.utime(cache._path(key), (time.time() - 100, time.time() - 100))
+    cache.get('aa')  # most recently used
+    cache.max_bytes = 2 * os.path.getsize(cache._path('aa'))
+    cache.set('dd', os.urandom(1000))
+    assert [k for k in ['aa', 'bb', 'cc', 'dd'] if cache.get(k) is not None] == ['aa', 'dd']
+
+
+def test_warm_rerun_is_offline(stand_in, tmp_path):
+    client = HivClient(base_url=stand_in.base_url, cache=ResponseCache(str(tmp_path)))
+    # fresh registries, so patient pages come from the disk cache, not from memory
+    cold = Cluster(700, client=client, registry=PatientRegistry()).load()
+    n_requests = stand_in.n_requests
+    warm = Cluster(700, client=client, registry=PatientRegistry()).load()
+    assert stand_in.n_requests == n_requests
+    pd.testing.assert_frame_equal(warm.acc_df, cold.acc_df)
+
+    client.refresh = True
+    Cluster(700, client=client, registry=PatientRegistry()).load()
+    assert stand_in.n_requests == 2 * n_requests
+
+
+def test_partial_page_cache_replays_session(stand_in, tmp_path):
+    client = HivClient(base_url=stand_in.base_url, cache=ResponseCache(str(tmp_path)))
+    expected = extract_patient_accession_timepoints(9000, client=client)
+    url = client.url(_timepoints_path(9000))
+    os.remove(client.cache._path(client.cache_key(url, page=2)))
+    # cached page 2's result id has been used already; a replay must not resend it
+    df = extract_patient_accession_timepoints(9000, client=client)
+    pd.testing.assert_frame_equal(df, expected)
+    assert client.lookup(client.cache_key(url, page=2)) is not None
+
+
+def test_refresh_revalidates_with_etag(stand_in, tmp_path):
+    stand_in.etags = True
+    cache = ResponseCache(str(tmp_path))
+    url_path = 'cluster.comp?clu_id=701'
+    with HivClient(base_url=stand_in.base_url, retries=0, cache=cache) as client:
+        content = client.fetch(client.url(url_path))
+    with HivClient(base_url=stand_in.base_url, retries=0, cache=cache, refresh=True) as client:
+        assert client.fetch(client.url(url_path)) == content
+        assert (client.n_not_modified, stand_in.n_not_modified) == (1, 1)
+    stand_in.data.clusters[701]['name'] = 'renamed'
+    with HivClient(base_url=stand_in.base_url, retries=0, cache=cache, refresh=True) as client:
+        assert b'renamed' in client.fetch(client.url(url_path))
+        assert client.n_not_modified == 0
+
+
+def test_refresh_fetches_paged_results_live(stand_in, tmp_path):
+    # ETags that leave out the result id would let a 304 hand back page 1 with a spent id
+    stand_in.etags = stand_in.etags_ignore_ids = True
+    cache = ResponseCache(str(tmp_path))
+    with HivClient(base_url=stand_in.base_url, retries=0, cache=cache) as client:
+        expected = extract_patient_accession_timepoints(9000, client=client)
+    with HivClient(base_url=stand_in.base_url, retries=0, cache=cache, refresh=True) as client:
+        df = extract_patient_accession_timepoints(9000, client=client)
+        assert client.n_not_modified == 0
+    pd.testing.assert_frame_equal(df, expected)
+    assert stand_in.n_not_modified == 0
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pandas as pd
+import pytest
+import requests
+
+from alamos_extract.load_data import Cluster, load_cluster, search_db
+from alamos_extract.registry import PatientRegistry
+
+__author__ = "Stephen Gaffney"
+__copyright__ = "Stephen Gaffney"
+__license__ = "gpl3"
+
+
+def test_cluster_reuses_connection(stand_in, client):
+    c = Cluster(700, client=client)
+    assert c.cluster_name == 'SC_cluster_700'
+    assert list(c.patient_dict) == [9000, 9001, 9002]
+    assert len(c.acc_df) == 36
+    # cluster page, then patient page + 3 timepoint pages for each patient
+    assert stand_in.n_requests == 13
+    assert stand_in.n_connections == 1
+
+
+def test_search_pages_with_client(client):
+    df = search_db(cluster_name='SC_cluster_701', client=client)
+    assert len(df) == 36
+    assert df.row_id.tolist() == [str(i) for i in range(1, 37)]
+    assert set(df.patient_id) == {9002, 9003, 9004}
+
+
+def test_http_errors_raise(client):
+    with pytest.raises(requests.HTTPError):
+        load_cluster(1, client=client)
+
+
+def test_concurrent_cluster_matches_serial(client):
+    serial = Cluster(701, client=client, registry=PatientRegistry())
+    # a fresh registry, so the concurrent build fetches its own patient pages
+    concurrent = Cluster(701, client=client, registry=PatientRegistry(), max_workers=4)
+    assert list(concurrent.patient_dict) == list(serial.patient_dict)
+    pd.testing.assert_frame_equal(concurrent.desc_df, serial.desc_df)
+    pd.testing.assert_frame_equal(concurrent.acc_df, serial.acc_df)
+
+
+def test_cluster_fetches_only_what_is_accessed(stand_in, client):
+    c = Cluster(700, client=client)
+    assert c.cluster_name == 'SC_cluster_700'
+    assert list(c.patient_dict) == [9000, 9001, 9002]
+    assert stand_in.n_requests == 1
+    assert c.desc_df.shape[1] == 3
+    assert len(c.accession_list_df) == 36
+    assert stand_in.n_requests == 4
+    assert len(c.acc_df) == 36
+    # 3 timepoint pages for each patient
+    assert stand_in.n_requests == 13
+    assert c.acc_df is c.acc_df
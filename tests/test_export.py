@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+
+import pandas as pd
+import pytest
+
+from alamos_extract.export import write_table
+from alamos_extract.harvest import harvest_clusters
+from alamos_extract.load_data import Cluster
+
+pa = pytest.importorskip('pyarrow')
+import pyarrow.dataset as pa_dataset  # noqa: E402
+import pyarrow.feather as pa_feather  # noqa: E402
+import pyarrow.parquet as pa_parquet  # noqa: E402
+
+__author__ = "Stephen Gaffney"
+__copyright__ = "Stephen Gaffney"
+__license__ = "gpl3"
+
+
+@pytest.mark.parametrize('fmt', ['parquet', 'feather', 'arrow'])
+def test_columnar_schema(client, tmp_path, fmt):
+    cluster = Cluster(701, client=client)
+    path = write_table(cluster.acc_df, str(tmp_path / 'acc'), fmt)
+    assert path.endswith('.' + fmt)
+    if fmt == 'parquet':
+        table = pa_parquet.read_table(path)
+    else:
+        table = pa_feather.read_table(path, memory_map=True)
+    schema = table.schema
+    for col in ('patient_id', 'blast_ssam_se_id', 'pos_start', 'seq_length', 'days_from_infection'):
+        assert schema.field(col).type == pa.int64()
+    assert pa.types.is_dictionary(schema.field('subtype').type)
+    assert table.num_rows == len(cluster.acc_df)
+    expected = pd.to_numeric(cluster.acc_df.days_from_infection).astype('Int64').tolist()
+    assert table.column('days_from_infection').to_pandas().astype('Int64').tolist() == expected
+
+
+def test_harvest_partitioned(client, tmp_path):
+    out_dir = str(tmp_path)
+    harvest_clusters([700, 701], out_dir=out_dir, client=client, fmt='parquet',
+                     partition_cols=('subtype', 'country'))
+    assert os.path.exists(os.path.join(out_dir, 'cluster_701_clinical.parquet'))
+    dataset = pa_dataset.dataset(os.path.join(out_dir, 'accessions'), format='parquet',
+                                 partitioning='hive')
+    table = dataset.to_table()
+    n_expected = sum(len(Cluster(i, client=client).acc_df) for i in (700, 701))
+    assert table.num_rows == n_expected
+    subset = dataset.to_table(filter=pa_dataset.field('country') == 'US')
+    assert 0 < subset.num_rows < n_expected
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pandas as pd
+import pytest
+
+from alamos_extract import grid
+from alamos_extract.grid import grid_queries, plan_partitions, search_grid
+from alamos_extract.load_data import search_db
+
+__author__ = "Stephen Gaffney"
+__copyright__ = "Stephen Gaffney"
+__license__ = "gpl3"
+
+
+@pytest.fixture
+def filtered(stand_in):
+    stand_in.filters = True
+    return stand_in
+
+
+def test_grid_queries():
+    assert grid_queries(['HIV-1'], ['B', 'C', 'B'], ['any', 'gp120']) == [
+        ('HIV-1', 'B', 'any'), ('HIV-1', 'B', 'gp120'), ('HIV-1', 'C', 'any'), ('HIV-1', 'C', 'gp120')]
+    with pytest.raises(ValueError):
+        grid_queries(subtypes=['Z'])
+
+
+def test_search_grid_merges_and_deduplicates(filtered, client):
+    seen = []
+    df = search_grid(subtypes=['A', 'A1', 'B'], regions=['any', 'complete genome'], max_rec=20, client=client,
+                     max_workers=3, progress=lambda p: seen.append(p.stats()))
+    # each query pages through its own session: 20 rows in pages of 5
+    assert filtered.n_requests == seen[-1]['pages'] == 16
+    assert seen[-1]['done'] == 6 and seen[-1]['rows'] == 70
+    assert not df.duplicated(['accession', 'blast_ssam_se_id']).any()
+    assert isinstance(df['query_subtype'].dtype, pd.CategoricalDtype)
+    assert str(df['sampling_year'].dtype) == 'Int64'
+    # subtype A matches every A1 sequence, so A1 only adds n_queries
+    assert set(df['query_subtype']) == {'A', 'B'}
+    genome_a1 = df[(df['subtype'] == 'A1') & (df['genomic_region'] == 'GENOME')]
+    assert df['n_queries'].max() == 4 and set(genome_a1['n_queries']) <= {2, 4}
+
+    expected = [s['accession'] for _, s in sorted(filtered.data.seqs.items()) if s['subtype'] == 'B'][:20]
+    assert df.loc[df['query_subtype'] == 'B', 'accession'].tolist() == expected
+    # same parsing as a single search
+    first_page = search_db(max_rec=20, subtype='B* or Bstar', region='', client=client)
+    assert first_page['accession'].tolist() == expected[:5]
+
+
+def test_search_grid_empty_and_failed(filtered, client):
+    df = search_grid(viruses=['HIV-2'], client=client)
+    assert len(df) == 0
+
+    filtered.overloads.append((503, None))
+    with pytest.raises(RuntimeError, match='1 of 2 grid searches failed'):
+        search_grid(subtypes=['B', 'C'], client=client, max_workers=1)
+
+
+def test_plan_partitions():
+    parts = plan_partitions(by='subtype')
+    assert ('A* or Astar or A[1-2]', '') in parts and ('B* or Bstar', '') in parts
+    assert ('A1*', '') not in parts and ('01_AE*', '') in parts
+    with pytest.raises(ValueError):
+        plan_partitions(subtype='A1*', by='subtype')
+    with pytest.raises(ValueError):
+        plan_partitions(by='region')
+
+
+def test_partitioned_search_matches_serial(filtered, client, caplog):
+    all_se_ids = sorted(filtered.data.seqs)
+    df = search_db(max_rec=1000, subtype='', region='', partition_by='subtype', client=client)
+    assert sorted(df['blast_ssam_se_id']) == all_se_ids
+    assert str(df['sampling_year'].dtype) == 'Int64'
+    assert 'serially' not in caplog.text
+
+    # fewer rows than matches: the site's first max_rec rows, paged serially
+    before = filtered.n_requests
+    df = search_db(max_rec=12, subtype='', region='', partition_by='subtype', client=client)
+    assert df['blast_ssam_se_id'].tolist() == all_se_ids[:12]
+    assert filtered.n_requests - before == 3
+
+
+def test_partitioned_search_without_reported_total(filtered, client, caplog, monkeypatch):
+    # a page whose match count can't be parsed: the merge is returned, not rerun
+    monkeypatch.setattr(grid, '_reported_total', lambda content: None)
+    df = search_db(max_rec=1000, subtype='', region='', partition_by='subtype', client=client)
+    assert 'unchecked' in caplog.text and 'serially' not in caplog.text
+    assert sorted(df['blast_ssam_se_id']) == sorted(filtered.data.seqs)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import gc
+import json
+import os
+import weakref
+
+import pandas as pd
+import pytest
+
+from alamos_extract import harvest, load_data
+from alamos_extract.client import HivClient
+from alamos_extract.harvest import harvest_clusters, parse_id_ranges, write_cluster
+from stand_in import StandInData, StandInServer
+
+__author__ = "Stephen Gaffney"
+__copyright__ = "Stephen Gaffney"
+__license__ = "gpl3"
+
+
+def test_parse_id_ranges():
+    assert parse_id_ranges('1-3,1200, 2') == [1, 2, 3, 1200]
+    with pytest.raises(ValueError):
+        parse_id_ranges('5-1')
+
+
+def test_harvest_resumes_from_journal(client, tmp_path):
+    out_dir = str(tmp_path)
+    summary = harvest_clusters([700, 701, 799], out_dir=out_dir, client=client, max_workers=2)
+    assert summary['completed'] == 2
+    assert list(summary['failed']) == [799]
+    assert summary['pages_fetched'] > 0
+    assert os.path.exists(os.path.join(out_dir, 'cluster_701_accessions.tsv'))
+    with open(os.path.join(out_dir, 'clusters_journal.jsonl')) as f:
+        statuses = {e['cluster_id']: e['status'] for e in map(json.loads, f)}
+    assert statuses == {700: 'ok', 701: 'ok', 799: 'failed'}
+
+    summary = harvest_clusters([700, 701, 702], out_dir=out_dir, client=client)
+    assert (summary['completed'], summary['skipped']) == (1, 2)
+
+
+def test_harvest_without_timepoints(stand_in, client, tmp_path):
+    summary = harvest_clusters([700], out_dir=str(tmp_path), client=client, timepoints=False)
+    assert summary['completed'] == 1
+    # cluster page and one page per patient
+    assert summary['pages_fetched'] == stand_in.n_requests == 4
+    df = pd.read_csv(os.path.join(str(tmp_path), 'cluster_700_accessions.tsv'), sep='\t')
+    assert list(df.columns) == ['patient_id', 'accession_id', 'blast_ssam_se_id']
+    assert len(df) == 36
+
+
+def test_harvest_frees_written_clusters(tmp_path, monkeypatch):
+    live = weakref.WeakSet()
+    peak = []
+
+    class TrackedCluster(load_data.Cluster):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            live.add(self)
+
+    def write(cluster, *args):
+        gc.collect()
+        peak.append(len(live))
+        return write_cluster(cluster, *args)
+
+    monkeypatch.setattr(load_data, 'Cluster', TrackedCluster)
+    monkeypatch.setattr(harvest, 'write_cluster', write)
+    with StandInServer(StandInData(n_clusters=12)) as server, \
+            HivClient(base_url=server.base_url, retries=0) as client:
+        summary = harvest_clusters(list(range(700, 712)), out_dir=str(tmp_path), client=client, max_workers=1,
+                                   timepoints=False)
+    assert summary['completed'] == 12
+    # the cluster being written plus a window of 2 * max_workers submissions
+    assert max(peak) <= 3
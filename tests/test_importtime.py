@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import subprocess
+import sys
+
+__author__ = "Stephen Gaffney"
+__copyright__ = "Stephen Gaffney"
+__license__ = "gpl3"
+
+# cumulative import time allowed for the CLI entry point, in microseconds
+IMPORT_BUDGET_US = 250000
+HEAVY_MODULES = ('pandas', 'numpy', 'requests', 'bs4', 'lxml', 'pyarrow', 'pkg_resources')
+
+
+def _run(*args):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    return subprocess.run([sys.executable, '-X', 'importtime'] + list(args),
+                          env=env, capture_output=True, text=True)
+
+
+def _import_times(stderr):
+    """{module: cumulative microseconds} from -X importtime output."""
+    times = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def test_cli_import_is_light():
+    result = _run('-c', 'import alamos_extract.__main__')
+    assert result.returncode == 0, result.stderr
+    times = _import_times(result.stderr)
+    assert not [m for m in HEAVY_MODULES if m in times]
+    assert times['alamos_extract.__main__'] < IMPORT_BUDGET_US
+
+
+def test_version_and_usage_errors_skip_heavy_imports():
+    result = _run('-m', 'alamos_extract', '--version')
+    assert result.returncode == 0
+    assert result.stdout.startswith('alamos-extract ')
+    assert not [m for m in HEAVY_MODULES if m in _import_times(result.stderr)]
+
+    result = _run('-m', 'alamos_extract', 'cluster', 'not-an-id')
+    assert result.returncode == 2
+    assert not [m for m in HEAVY_MODULES if m in _import_times(result.stderr)]
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import os
+
+import pytest
+
+from alamos_extract.__main__ import main
+from alamos_extract.index import build_index, index_path, open_index
+from alamos_extract.warehouse import Warehouse, sync_clusters, sync_search
+from test_importtime import HEAVY_MODULES, _import_times, _run
+
+__author__ = "Stephen Gaffney"
+__copyright__ = "Stephen Gaffney"
+__license__ = "gpl3"
+
+
+@pytest.fixture
+def db(client, tmp_path):
+    path = str(tmp_path / 'w.sqlite')
+    with Warehouse(path) as warehouse:
+        sync_clusters([700], warehouse, client=client)
+        sync_search(warehouse, client=client, cluster_name='SC_cluster_702')
+    return path
+
+
+def test_index_lookups(stand_in, db):
+    data = stand_in.data
+    se_id = data.patients[9000]['seqs'][0]
+    accession = data.seqs[se_id]['accession']
+    with build_index(db) as index:
+        record = index.get('accession', accession)
+        assert record == index.get('se_id', se_id)
+        assert (record['se_id'], record['patient_id'], record['patient_code']) == (se_id, 9000, 'P9000')
+        assert record['clusters'] == [{'cluster_id': 700, 'cluster_name': 'SC_cluster_700'}]
+        # cluster 702 is only known from search results
+        assert index.get('cluster_name', 'SC_cluster_702')['cluster_id'] == 702
+        only_702 = data.seqs[data.patients[data.clusters[702]['patients'][-1]]['seqs'][0]]['accession']
+        assert index.get('accession', only_702)['clusters'][0]['cluster_id'] == 702
+        assert [c['cluster_id'] for c in index.get('patient_id', 9002)['clusters']] == [700, 701]
+        assert [p['patient_id'] for p in index.get('patient_code', 'P9001')] == [9001]
+        assert index.get('cluster_id', 700)['n_accessions'] == len(data.cluster_seqs(700))
+        assert index.get('accession', 'XX000000') is None
+        assert [kind for kind, _ in index.find('9000')] == ['patient_id']
+        assert len(index) > 3 * len(data.cluster_seqs(700))
+
+
+def test_index_rebuilt_when_warehouse_changes(client, db):
+    build_index(db).close()
+    with open_index(db) as index:
+        assert index.get('cluster_id', 701)['n_accessions'] == 0  # only known from patient 9002's page
+    os.utime(index_path(db), (0, 0))
+    with Warehouse(db) as warehouse:
+        sync_clusters([701], warehouse, client=client)
+    with open_index(db) as index:
+        assert index.get('cluster_id', 701)['n_accessions'] == 36
+
+
+def test_lookup_command(db, capsys):
+    main(['lookup', '--db', db, 'P9000', 'SC_cluster_700'])
+    lines = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert [(r['kind'], r['term']) for r in lines] == [('patient_code', 'P9000'), ('cluster_name', 'SC_cluster_700')]
+    with pytest.raises(SystemExit) as e:
+        main(['lookup', '--db', db, '--kind', 'se_id', '9000'])
+    assert e.value.code == 1
+    assert 'No match for 9000' in capsys.readouterr().err
+
+
+def test_lookup_command_skips_heavy_imports(db):
+    result = _run('-m', 'alamos_extract', 'lookup', '--db', db, 'P9000')
+    assert result.returncode == 0, result.stderr
+    assert json.loads(result.stdout)['patient_id'] == 9000
+    assert not [m for m in HEAVY_MODULES if m in _import_times(result.stderr)]
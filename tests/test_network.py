@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import xml.etree.ElementTree as ET
+
+import pandas as pd
+
+from alamos_extract.load_data import Cluster
+from alamos_extract.network import expand_network, write_network
+from alamos_extract.registry import PatientRegistry
+
+__author__ = "Stephen Gaffney"
+__copyright__ = "Stephen Gaffney"
+__license__ = "gpl3"
+
+
+def test_expand_network(stand_in, client):
+    # clusters 700-702 form a chain through shared patients 9002 and 9004
+    network = expand_network(700, depth=1, client=client)
+    assert list(network.clusters) == [700, 701]
+    assert list(network.patients) == [9000, 9001, 9002, 9003, 9004]
+    assert network.truncated  # 9004 also belongs to 702
+    # one cluster page per cluster, one patient page per patient
+    assert stand_in.n_requests == 2 + 5
+
+    network = expand_network(700, depth=5, client=client, registry=PatientRegistry(), max_workers=3)
+    assert list(network.clusters) == [700, 701, 702]
+    assert not network.truncated
+    assert network.depths == {'c700': 0, 'p9000': 0, 'p9001': 0, 'p9002': 0, 'c701': 1, 'p9003': 1,
+                              'p9004': 1, 'c702': 2, 'p9005': 2, 'p9006': 2}
+    edges = network.edges_df
+    assert len(edges) == 9
+    assert sorted(edges[edges.patient_id == 9002].cluster_id) == [700, 701]
+    acc = network.accession_df()
+    assert len(acc) == 7 * 12
+    assert acc.accession_id.is_unique
+    live = Cluster(701, client=client, registry=PatientRegistry()).acc_df
+    pd.testing.assert_frame_equal(acc[acc.patient_id.isin([9003])].reset_index(drop=True),
+                                  live[live.patient_id == 9003].reset_index(drop=True), check_categorical=False)
+
+
+def test_network_limits(client):
+    network = expand_network(700, depth=5, max_clusters=2, client=client)
+    assert list(network.clusters) == [700, 701]
+    network = expand_network(700, depth=5, max_patients=4, client=client)
+    assert list(network.patients) == [9000, 9001, 9002, 9003]
+    assert network.truncated
+    assert len(network.edges_df) == 5
+
+
+def test_write_network(client, tmp_path):
+    network = expand_network(701, depth=0, client=client)
+    paths = write_network(network, str(tmp_path / 'net' / 'network_701'), timepoints=False)
+    graph = ET.parse(paths['graphml']).getroot()
+    ns = {'g': 'http://graphml.graphdrawing.org/xmlns'}
+    assert len(graph.findall('g:graph/g:node', ns)) == 4
+    assert len(graph.findall('g:graph/g:edge', ns)) == 3
+    nodes = pd.read_csv(paths['nodes'], sep='\t')
+    assert list(nodes.node) == ['c701', 'p9002', 'p9003', 'p9004']
+    assert len(pd.read_csv(paths['accessions'], sep='\t')) == 36
@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from alamos_extract.load_data import (_content_pager, _get_soup_from_content, _get_results_page_id,
+                                      _has_next_page_is_final, _has_next_page_not_final,
+                                      _next_page_data_from_content, _timepoints_path)
+
+__author__ = "Stephen Gaffney"
+__copyright__ = "Stephen Gaffney"
+__license__ = "gpl3"
+
+
+def test_byte_scan_matches_soup(client):
+    pages = list(_content_pager(client.url(_timepoints_path(9000)), client=client, prefetch=False))
+    assert len(pages) == 3
+    for content in pages:
+        soup = _get_soup_from_content(content)
+        new_data = _next_page_data_from_content(content)
+        has_more = _has_next_page_not_final(soup) or _has_next_page_is_final(soup)
+        assert (new_data is not None) == has_more
+        if has_more:
+            assert new_data['id'] == _get_results_page_id(soup)
+
+
+def test_prefetch_requests_next_page_early(stand_in, client):
+    pager = _content_pager(client.url(_timepoints_path(9000)), client=client)
+    first = next(pager)
+    # page 2 is requested while page 1 is still with the caller
+    assert stand_in.next_page_requested.wait(timeout=10)
+    rest = list(pager)
+    serial = list(_content_pager(client.url(_timepoints_path(9000)), client=client, prefetch=False))
+
+    def first_table(content):
+        return str(_get_soup_from_content(content).find('table'))
+
+    assert [first_table(c) for c in [first] + rest] == [first_table(c) for c in serial]
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+
+import pytest
+
+from alamos_extract import profiling
+from alamos_extract.load_data import Cluster
+
+__author__ = "Stephen Gaffney"
+__copyright__ = "Stephen Gaffney"
+__license__ = "gpl3"
+
+
+@pytest.fixture
+def profiler():
+    profiler = profiling.enable()
+    yield profiler
+    profiling.disable()
+
+
+def test_profile_cluster_build(stand_in, client, profiler, tmp_path):
+    Cluster(700, client=client, max_workers=2).acc_df
+    stages = profiler.summary()
+    assert stages['http']['calls'] == stand_in.n_requests
+    assert stages['http']['status'] == {200: stand_in.n_requests}
+    assert stages['http']['bytes'] == client.bytes_received
+    # 3 timepoint pages per patient
+    assert stages['page']['calls'] == 9
+    assert stages['Cluster']['calls'] == 1 and stages['Patient']['calls'] == 6
+    for name in ['read_cluster_page', 'read_results_table', 'frame_from_rows', '_process_results_df',
+                 '_concat_results']:
+        assert stages[name]['calls'] > 0
+    assert 'http' in profiler.format_summary()
+
+    path = str(tmp_path / 'profile.json')
+    profiler.write(path)
+    with open(path) as f:
+        events = json.load(f)['traceEvents']
+    cluster = next(e for e in events if e['name'] == 'Cluster')
+    assert cluster['ph'] == 'X' and cluster['args'] == {'cluster_id': 700}
+    load = next(e for e in events if e['name'] == 'Cluster.load')
+    assert all(load['ts'] <= e['ts'] <= load['ts'] + load['dur'] for e in events if e['name'] == 'Patient')
+
+
+def test_disabled_profiling_records_nothing(client, monkeypatch):
+    profiler = profiling.enable()
+    profiling.disable()
+    spans = []
+
+    def span(name, cat, **args):
+        spans.append(real_span(name, cat, **args))
+        return spans[-1]
+
+    real_span = profiling.span
+    monkeypatch.setattr(profiling, 'span', span)
+    Cluster(700, client=client).load()
+    assert spans and all(s is profiling._NULL_SPAN for s in spans)
+    assert profiler.events == []
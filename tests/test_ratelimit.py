@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import requests
+
+from alamos_extract.client import HivClient
+from alamos_extract.load_data import Cluster, _timepoints_path, load_cluster
+from alamos_extract.ratelimit import RateLimiter, Throttle, TokenBucket, parse_retry_after
+
+__author__ = "Stephen Gaffney"
+__copyright__ = "Stephen Gaffney"
+__license__ = "gpl3"
+
+
+def test_token_bucket_rate():
+    bucket = TokenBucket(rate=50, burst=1)
+    start = time.monotonic()
+    for _ in range(6):
+        bucket.acquire()
+    assert time.monotonic() - start >= 0.09
+
+
+def test_aimd_grows_on_stable_latency_and_backs_off():
+    throttle = Throttle(initial_concurrency=2, max_concurrency=8)
+    for _ in range(40):
+        throttle.acquire()
+        throttle.release(latency=0.01)
+    assert throttle.limit == 8
+    throttle.acquire()
+    throttle.release(latency=0.01, overloaded=True)
+    assert throttle.limit == 4 and throttle.n_backoffs == 1
+    # slow responses hold the limit rather than growing it
+    for _ in range(10):
+        throttle.acquire()
+        throttle.release(latency=0.1)
+    assert throttle.limit == 4
+
+
+def test_throttle_bounds_in_flight_and_pauses():
+    throttle = Throttle(initial_concurrency=1, max_concurrency=1)
+    throttle.acquire()
+    waiter = threading.Thread(target=throttle.acquire)
+    waiter.start()
+    waiter.join(0.05)
+    assert waiter.is_alive()
+    throttle.release(latency=0.01)
+    waiter.join(1)
+    assert not waiter.is_alive()
+    throttle.release(latency=0.01, overloaded=True, retry_after=0.1)
+    start = time.monotonic()
+    throttle.acquire()
+    assert time.monotonic() - start >= 0.09
+
+
+def test_parse_retry_after():
+    assert parse_retry_after('2') == 2.0
+    assert parse_retry_after(None) is None
+    assert parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT') == 0.0
+
+
+def test_client_backs_off_on_overload(stand_in):
+    limiter = RateLimiter(initial_concurrency=4, endpoints={'patient.comp': {'initial_concurrency': 2}})
+    stand_in.overloads = [(429, '1'), (503, None)]
+    with HivClient(base_url=stand_in.base_url, retries=2, backoff_factor=0.01, limiter=limiter) as client:
+        start = time.monotonic()
+        assert load_cluster(700, client=client)['cluster_name'] == 'SC_cluster_700'
+        assert time.monotonic() - start >= 0.9
+        assert limiter.throttle.n_backoffs >= 1
+        assert limiter.throttle.limit < 4
+        Cluster(700, client=client, max_workers=4)
+        stats = limiter.stats()
+        assert stats['global']['in_flight'] == stats['patient.comp']['in_flight'] == 0
+        assert stats['patient.comp']['backoffs'] == 0
+
+    stand_in.overloads = [(503, None)]
+    limiter = RateLimiter()
+    with HivClient(base_url=stand_in.base_url, retries=0, limiter=limiter) as client:
+        with pytest.raises(requests.HTTPError):
+            load_cluster(700, client=client)
+    assert limiter.throttle.n_backoffs == 1
+
+
+def test_stream_holds_limiter_slot(stand_in):
+    limiter = RateLimiter(initial_concurrency=1, max_concurrency=1)
+    stand_in.overloads = [(503, None)]
+    with HivClient(base_url=stand_in.base_url, retries=0, limiter=limiter) as client:
+        url = client.url(_timepoints_path(9000))
+        with pytest.raises(requests.HTTPError):
+            list(client.stream(url))
+        assert limiter.throttle.n_backoffs == 1
+        chunks = client.stream(url, chunk_size=64)
+        first = next(chunks)
+        assert limiter.stats()['global']['in_flight'] == 1
+        body = first + b''.join(chunks)
+        assert limiter.stats()['global']['in_flight'] == 0
+    assert b'<table' in body
+
+
+def test_retry_backoff_releases_limiter_slot(stand_in):
+    limiter = RateLimiter(initial_concurrency=1, max_concurrency=1)
+    stand_in.overloads = [(503, None), (503, None)]
+    with HivClient(base_url=stand_in.base_url, retries=2, backoff_factor=1.0, limiter=limiter) as client, \
+            ThreadPoolExecutor(max_workers=1) as pool:
+        retried = pool.submit(client.fetch_live, client.url('cluster.comp?clu_id=700'))
+        while stand_in.overloads:
+            time.sleep(0.01)
+        time.sleep(0.1)  # both attempts answered 503, now backing off before the third
+        start = time.monotonic()
+        client.fetch_live(client.url('cluster.comp?clu_id=701'))
+        assert time.monotonic() - start < 0.5
+        assert b'SC_cluster_700' in retried.result()
+    assert limiter.stats()['global']['in_flight'] == 0
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from alamos_extract.harvest import harvest_clusters
+from alamos_extract.load_data import _patient_path
+from alamos_extract.registry import PatientRegistry
+
+__author__ = "Stephen Gaffney"
+__copyright__ = "Stephen Gaffney"
+__license__ = "gpl3"
+
+
+def test_registry_lru_and_single_flight():
+    registry = PatientRegistry(maxsize=2)
+    release = threading.Event()
+    calls = []
+
+    def slow_loader():
+        calls.append(1)
+        release.wait(5)
+        return 'slow'
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        futures = [pool.submit(registry.get, 'a', slow_loader) for _ in range(4)]
+        while registry.misses + registry.coalesced < 4:
+            threading.Event().wait(0.01)
+        release.set()
+        assert [f.result() for f in futures] == ['slow'] * 4
+    assert len(calls) == 1
+    assert (registry.misses, registry.coalesced) == (1, 3)
+
+    registry.get('b', lambda: 'b')
+    registry.get('a', lambda: 'x')  # hit, makes 'b' least recently used
+    registry.get('c', lambda: 'c')
+    assert 'b' not in registry and 'a' in registry and len(registry) == 2
+    assert registry.stats() == {'hits': 1, 'misses': 3, 'coalesced': 3, 'size': 2}
+
+    with pytest.raises(ValueError):
+        registry.get('d', lambda: int('bad'))
+    assert 'd' not in registry
+
+
+def test_harvest_downloads_shared_patient_once(stand_in, client, tmp_path):
+    # patient 9002 belongs to clusters 700 and 701
+    requested = []
+    request = client.request
+
+    def counting_request(url, data=None, headers=None):
+        requested.append(url)
+        return request(url, data, headers)
+
+    client.request = counting_request
+    summary = harvest_clusters([700, 701], out_dir=str(tmp_path), client=client, max_workers=2)
+    assert summary['completed'] == 2
+    assert requested.count(client.url(_patient_path(9002))) == 1
+    # patient page and timepoint table for each of 5 patients, both reused for 9002
+    assert (summary['patient_tables_fetched'], summary['patient_tables_reused']) == (10, 2)
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+
+import pandas as pd
+import pytest
+import requests
+
+from alamos_extract.client import HivClient
+from alamos_extract.load_data import Cluster, extract_patient_accession_timepoints, search_db, \
+    _next_page_data_from_content, _timepoints_path
+from replay import CORPUS_DATA, CORPUS_PAGE_SIZE, ReplayServer
+from stand_in import StandInData, StandInServer
+
+__author__ = "Stephen Gaffney"
+__copyright__ = "Stephen Gaffney"
+__license__ = "gpl3"
+
+
+@pytest.fixture(scope='module')
+def replay():
+    with ReplayServer() as server:
+        yield server
+
+
+def test_replay_matches_recorded_site(replay):
+    with StandInServer(StandInData(**CORPUS_DATA), page_size=CORPUS_PAGE_SIZE) as site, \
+            HivClient(base_url=site.base_url, retries=0) as live, \
+            HivClient(base_url=replay.base_url, retries=0) as client:
+        pd.testing.assert_frame_equal(Cluster(701, client=client).acc_df, Cluster(701, client=live).acc_df)
+        pd.testing.assert_frame_equal(search_db(cluster_name='SC_cluster_701', client=client),
+                                      search_db(cluster_name='SC_cluster_701', client=live))
+        pd.testing.assert_frame_equal(search_db(max_rec=200, client=client),
+                                      search_db(max_rec=200, client=live))
+
+
+def test_replay_result_ids_are_single_use(replay):
+    with HivClient(base_url=replay.base_url, retries=0) as client:
+        df = extract_patient_accession_timepoints(9000, client=client)
+        assert len(df) == CORPUS_DATA['seqs_per_patient']
+        url = client.url(_timepoints_path(9000))
+        next_data = _next_page_data_from_content(client.fetch(url))
+        client.fetch(url, data=next_data)
+        with pytest.raises(requests.HTTPError):
+            client.fetch(url, data=next_data)
+
+
+def test_replay_latency():
+    with ReplayServer(latency=0.05, jitter=0.01) as server, HivClient(base_url=server.base_url) as client:
+        start = time.perf_counter()
+        client.fetch(client.url('cluster.comp?clu_id=700'))
+        assert time.perf_counter() - start >= 0.04
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from alamos_extract.cache import ResponseCache
+from alamos_extract.client import HivClient
+from alamos_extract.registry import get_patient_registry
+from alamos_extract.service import LookupServer, LookupService
+
+__author__ = "Stephen Gaffney"
+__copyright__ = "Stephen Gaffney"
+__license__ = "gpl3"
+
+
+@pytest.fixture
+def server(client):
+    with LookupServer(LookupService(client), port=0) as server:
+        yield server
+
+
+def get(server, path):
+    with urllib.request.urlopen(server.url + path) as response:
+        return json.loads(response.read())
+
+
+def test_lookups(stand_in, server):
+    cluster = get(server, 'cluster/700')
+    assert cluster['cluster_name'] == 'SC_cluster_700'
+    assert [p['patient_id'] for p in cluster['patients']] == stand_in.data.clusters[700]['patients']
+    assert len(cluster['accessions']) == len(stand_in.data.cluster_seqs(700))
+    patient = get(server, 'patient/9002')
+    assert [c['cluster_id'] for c in patient['clusters']] == [700, 701]
+    assert len(patient['accessions']) == 12
+    by_name = get(server, 'cluster?name=SC_cluster_701')
+    assert len(by_name['sequences']) == 36
+    search = get(server, 'search?subtype=B&max_rec=10')
+    assert len(search['sequences']) == 10
+    with pytest.raises(urllib.error.HTTPError) as e:
+        get(server, 'search?subtype=Z')
+    assert e.value.code == 400
+    with pytest.raises(urllib.error.HTTPError) as e:
+        get(server, 'patient/1')
+    assert e.value.code == 404
+    with pytest.raises(urllib.error.HTTPError) as e:
+        get(server, 'accession/AB149000')
+    assert e.value.code == 404
+
+
+def test_lookup_failure_is_server_error(server, monkeypatch):
+    def lookup(kind, *args):
+        raise KeyError('cluster_name')
+
+    monkeypatch.setattr(server.service, 'lookup', lookup)
+    with pytest.raises(urllib.error.HTTPError) as e:
+        get(server, 'cluster/700')
+    assert e.value.code == 500
+    with pytest.raises(urllib.error.HTTPError) as e:
+        get(server, 'cluster/abc')
+    assert e.value.code == 400
+
+
+def test_concurrent_lookups_coalesce(stand_in, server):
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        bodies = list(pool.map(lambda _: get(server, 'cluster/701'), range(8)))
+    assert all(body == bodies[0] for body in bodies)
+    n_requests = stand_in.n_requests
+    stats = get(server, 'stats')
+    assert stats['misses'] == 1
+    assert stats['hits'] + stats['coalesced'] == 7
+    # one lookup made as many requests as a single cluster load
+    get_patient_registry().clear()
+    before = stand_in.n_requests
+    server.service._cluster(server.service.client, 701)
+    assert stand_in.n_requests - before == n_requests
+
+
+def test_disk_cache_survives_restart(stand_in, client, tmp_path):
+    first = LookupService(client, disk_cache=ResponseCache(str(tmp_path)))
+    body = first.lookup('cluster', 700)
+    before = stand_in.n_requests
+    second = LookupService(client, disk_cache=ResponseCache(str(tmp_path)))
+    assert second.lookup('cluster', 700) == body
+    assert stand_in.n_requests == before
+    assert second.stats()['disk_hits'] == 1
+
+
+def test_refresh_hot_entries(stand_in, client):
+    with HivClient(base_url=stand_in.base_url, retries=0, refresh=True) as refresh_client:
+        service = LookupService(client, refresh_client=refresh_client, refresh_after=0, hot_hits=2)
+        service.lookup('patient', 9000)
+        service.lookup('cluster', 700)
+        assert service.refresh_hot() == 0  # looked up once each
+        service.lookup('patient', 9000)
+        service.lookup('cluster', 700)
+        stand_in.data.patients[9000]['risk'] = 'changed'
+        assert service.refresh_hot() == 2
+        patient = json.loads(service.lookup('patient', 9000))
+        cluster = json.loads(service.lookup('cluster', 700))
+    assert 'changed' in patient['desc'].values()
+    assert 'changed' in cluster['patients'][0].values()
+    assert service.stats()['refreshed'] == 2
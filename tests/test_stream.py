@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pandas as pd
+import pytest
+
+from alamos_extract import tables
+from alamos_extract.load_data import (_TIMEPOINT_COLS, _concat_results, _get_df_from_content,
+                                      _results_batch_df, iter_search, search_db)
+from stand_in import TIMEPOINT_FIELDS, StandInData, render_results
+
+__author__ = "Stephen Gaffney"
+__copyright__ = "Stephen Gaffney"
+__license__ = "gpl3"
+
+
+@pytest.mark.parametrize('chunk_size', [7, 4096])
+def test_stream_parser_matches_page_parse(chunk_size):
+    data = StandInData()
+    content = render_results(data, data.patients[9000]['seqs'], TIMEPOINT_FIELDS, 1,
+                             page_id='abc', has_next=True).encode('utf8')
+    parser = tables.ResultsStreamParser()
+    rows = []
+    for i in range(0, len(content), chunk_size):
+        rows.extend(parser.feed(content[i:i + chunk_size]))
+    rows.extend(parser.close())
+    assert (parser.has_next, parser.page_id) == (True, 'abc')
+    df = _results_batch_df(parser, rows, _TIMEPOINT_COLS)
+    expected = _get_df_from_content(content, list(_TIMEPOINT_COLS))
+    pd.testing.assert_frame_equal(df, expected)
+
+
+def test_iter_search_batches_match_search_db(client):
+    expected = search_db(cluster_name='SC_cluster_701', client=client)
+    batches = list(iter_search(cluster_name='SC_cluster_701', batch_size=7, client=client))
+    assert [len(b) for b in batches[:-1]] == [7] * (len(batches) - 1)
+    pd.testing.assert_frame_equal(_concat_results(batches), expected)
+    streamed = search_db(cluster_name='SC_cluster_701', client=client, stream=True)
+    pd.testing.assert_frame_equal(streamed, expected)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import glob
+import gzip
+import os
+from io import StringIO
+
+import lxml.html
+import pandas as pd
+import pytest
+
+from alamos_extract import tables
+from alamos_extract.load_data import (_TIMEPOINT_COLS, _get_df_from_content, _get_df_from_soup,
+                                      _get_soup_from_content, _parse_cluster, _parse_patient_info,
+                                      _search_form)
+from replay import CORPUS_DIR
+from stand_in import (CLUSTER_SEARCH_FIELDS, TIMEPOINT_FIELDS, StandInData, render_cluster,
+                      render_patient, render_results)
+
+__author__ = "Stephen Gaffney"
+__copyright__ = "Stephen Gaffney"
+__license__ = "gpl3"
+
+DATA = StandInData()
+
+
+def _results_pages():
+    seqs = DATA.patients[9000]['seqs']
+    timepoints = render_results(DATA, seqs, TIMEPOINT_FIELDS, 1, page_id='x', has_next=True)
+    th_header = timepoints.replace('<tr><td>#</td><td colspan="2">Select</td>',
+                                   '<tr><th>#</th><th colspan="2">Select</th>')
+    th_header = th_header.replace('<td>Patient</td>', '<th>Patient</th>')
+    for f in TIMEPOINT_FIELDS:
+        th_header = th_header.replace('<td>{}</td>'.format(f), '<th>{}</th>'.format(f))
+    cluster = render_results(DATA, DATA.cluster_seqs(701), CLUSTER_SEARCH_FIELDS, 1, cluster_id=701)
+    return [
+        (timepoints, list(_TIMEPOINT_COLS)),
+        (th_header, list(_TIMEPOINT_COLS)),
+        (cluster, _search_form(100, 'HIV-1', 'B', None, 'SC_cluster_701')[1]),
+    ]
+
+
+@pytest.mark.parametrize('page,cols', _results_pages())
+def test_results_table_matches_bs4(page, cols):
+    content = page.encode('utf8')
+    expected = _get_df_from_soup(_get_soup_from_content(content), list(cols))
+    pd.testing.assert_frame_equal(_get_df_from_content(content, list(cols)), expected)
+
+
+def test_ssam_se_id_aligned_with_rows():
+    page, cols = _results_pages()[0]
+    df = _get_df_from_content(page.encode('utf8'), cols)
+    assert df.accession_id.str[2:].astype(int).tolist() == df.blast_ssam_se_id.tolist()
+
+
+def test_cluster_page_matches_bs4():
+    content = render_cluster(DATA, 701).encode('utf8')
+    assert tables.read_cluster_page(content) == _parse_cluster(_get_soup_from_content(content))
+
+
+def test_patient_page_matches_bs4():
+    content = render_patient(DATA, 9002).encode('utf8')
+    data = tables.read_patient_page(content, 9002)
+    expected = _parse_patient_info(_get_soup_from_content(content), 9002)
+    pd.testing.assert_series_equal(data.pop('desc'), expected.pop('desc'))
+    assert data == expected
+
+
+def test_results_postprocessing_dtypes():
+    page, cols = _results_pages()[0]
+    df = _get_df_from_content(page.encode('utf8'), cols)
+    assert df.patient_id.dtype == 'int64'
+    assert df.blast_ssam_se_id.dtype == 'int64'
+    assert str(df.pos_start.dtype) == str(df.pos_stop.dtype) == 'Int64'
+    assert df.pos.tolist() == ['{}:{}'.format(a, b) for a, b in zip(df.pos_start, df.pos_stop)]
+    assert (df.patient_id == 9000).all()
+
+
+def test_timepoint_schema(client):
+    from alamos_extract.load_data import extract_patient_accession_timepoints
+    df = extract_patient_accession_timepoints(9000, client=client)
+    assert str(df.days_from_infection.dtype) == 'Int64'
+    assert str(df.seq_length.dtype) == 'Int64'
+    assert df.fiebig_stage.cat.ordered
+    assert df.fiebig_stage.cat.categories[:3].tolist() == ['I', 'I/II', 'II']
+    for col in ('subtype', 'country', 'genomic_region'):
+        assert isinstance(df[col].dtype, pd.CategoricalDtype)
+    seqs = [DATA.seqs[i] for i in DATA.patients[9000]['seqs']]
+    assert df.seq_length.tolist() == [int(s['seq_length']) for s in seqs]
+
+
+def _corpus_tables():
+    for path in sorted(glob.glob(os.path.join(CORPUS_DIR, '*.html.gz'))):
+        with gzip.open(path) as f:
+            doc = tables.parse_page(f.read())
+        for table in doc.iter('table'):
+            yield lxml.html.tostring(table, encoding='unicode')
+
+
+@pytest.mark.parametrize('text_parser', [True, False])
+def test_corpus_tables_match_read_html(monkeypatch, text_parser):
+    # TextParser is pandas internals: check it against read_html under the installed pandas
+    monkeypatch.setattr(tables, '_USE_TEXT_PARSER', text_parser)
+    n_tables = 0
+    for html in _corpus_tables():
+        expected = pd.read_html(StringIO(html))[0]
+        pd.testing.assert_frame_equal(tables.frame_from_table(lxml.html.fragment_fromstring(html)), expected)
+        n_tables += 1
+    assert n_tables > 50
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pandas as pd
+
+from alamos_extract.load_data import Cluster, search_db
+from alamos_extract.warehouse import Warehouse, summarize_counts, sync_clusters, sync_search
+
+__author__ = "Stephen Gaffney"
+__copyright__ = "Stephen Gaffney"
+__license__ = "gpl3"
+
+
+def test_sync_and_hydrate(stand_in, client, tmp_path):
+    with Warehouse(str(tmp_path / 'w.sqlite')) as warehouse:
+        report = sync_clusters([700, 701], warehouse, client=client, max_workers=2)
+        assert (report['clusters'], report['patients']) == (2, 5)
+        n_requests = stand_in.n_requests
+        cluster = Cluster.from_warehouse(701, warehouse)
+        assert stand_in.n_requests == n_requests
+        live = Cluster(701, client=client)
+        assert cluster.comb_patients == live.comb_patients
+        pd.testing.assert_frame_equal(cluster.acc_df, live.acc_df)
+        pd.testing.assert_frame_equal(cluster.desc_df, live.desc_df)
+        assert cluster.patient_dict[9002].clusters == live.patient_dict[9002].clusters
+
+        # unchanged upstream: nothing parsed or written
+        report = sync_clusters([700, 701], warehouse, client=client)
+        assert summarize_counts(report['counts']) == dict(inserted=0, updated=0, deleted=0, unchanged=0)
+        assert report['entities']['patients'] == dict(new=0, changed=0, unchanged=5)
+
+        # one changed value, then one removed accession
+        seqs = stand_in.data.patients[9003]['seqs']
+        stand_in.data.seqs[seqs[0]]['country'] = 'XX'
+        report = sync_clusters([701], warehouse, client=client)
+        assert report['counts']['timepoints'] == dict(inserted=0, updated=1, deleted=0, unchanged=11)
+        assert report['entities']['patients'] == dict(new=0, changed=1, unchanged=2)
+        stand_in.data.patients[9003]['seqs'] = seqs[:-1]
+        report = sync_clusters([701], warehouse, client=client)
+        assert report['counts']['timepoints'] == dict(inserted=0, updated=0, deleted=1, unchanged=11)
+        assert report['counts']['patient_accessions']['deleted'] == 1
+        assert warehouse.load_timepoints(9003).country.iloc[0] == 'XX'
+
+        report = sync_clusters([701], warehouse, client=client, max_age=3600)
+        assert report['skipped'] == 4 and report['clusters'] == 0
+
+
+def test_sync_search(client, tmp_path):
+    with Warehouse(str(tmp_path / 'w.sqlite')) as warehouse:
+        key, counts = sync_search(warehouse, client=client, cluster_name='SC_cluster_701')
+        assert counts['search_results']['inserted'] > 0
+        expected = search_db(cluster_name='SC_cluster_701', client=client)
+        pd.testing.assert_frame_equal(warehouse.load_search(key), expected)